@@ -34,7 +34,6 @@ setuptools.setup(
     ],
     install_requires=[
         "locate",
-        "download",
         "pathvalidate",
         "py7zr",
         "deprecation",
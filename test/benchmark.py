@@ -0,0 +1,344 @@
+"""
+Benchmarks of the packaging stages on synthetic VBA projects.
+
+    python benchmark.py --output results.json
+    python benchmark.py --compare results.json
+
+Each stage is timed `--repeat` times on every corpus, without the token cache, as is importing the package in a fresh
+interpreter (stage "import"), and the results are written as JSON (to stdout by default). With `--compare`, the
+minimum times are also compared against the results of an earlier run, e.g. of another commit.
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict
+from unittest import mock
+
+import locate
+
+with locate.prepend_sys_path(".."):
+    from zebra_vba_packager import Config, Source, token_cache
+    from zebra_vba_packager.bas_combining import (
+        compile_bas_sources_into_single_file,
+        find_all_code_sections,
+    )
+    from zebra_vba_packager.match_tokens import compile_token_pattern
+    from zebra_vba_packager.vba_renaming import (
+        NameTransformer,
+        bas_create_namespaced_classes,
+        cls_renaming_dict,
+        do_renaming,
+    )
+    from zebra_vba_packager.vba_tokenizer import tokenize, tokenize_stream
+    from zebra_vba_packager.virtual_tree import VirtualTree
+
+
+def _module(name: str, body: str) -> str:
+    return f'Attribute VB_Name = "{name}"\nOption Explicit\n\n{body}'
+
+
+def _functions(rng: random.Random, module: str, count: int, others) -> str:
+    # Public functions calling each other across modules, with private helpers, constants, strings and comments
+    code = [
+        f"Private Const LIMIT As Long = {rng.randint(1, 100)}",
+        f"Public {module}Counter As Long",
+        "",
+    ]
+    for i in range(count):
+        other = rng.choice(others)
+        code += [
+            f"' Function {i} of {module}",
+            f"Public Function {module}Fn{i}(ByVal x As Long, "
+            f'Optional ByVal s As String = "a ""quoted"" {i}") As Long',
+            "    Dim total As Long",
+            f"    total = x + LIMIT + Helper{i}(x) ' add the limit",
+            f"    If total > {i} Then total = {other}.{other}Fn0(total)",
+            f"    {module}Counter = {module}Counter + 1",
+            f"    {module}Fn{i} = total",
+            "End Function",
+            "",
+            f"Private Function Helper{i}(ByVal y As Long) As Long",
+            f"    Helper{i} = y * {rng.randint(2, 9)}",
+            "End Function",
+            "",
+        ]
+    return "\n".join(code)
+
+
+def many_small_modules(scale: float = 1.0) -> Dict[str, str]:
+    """
+    Hundreds of modules with a few functions each, and some classes.
+    """
+    rng = random.Random(1)
+    names = [f"Small{i}" for i in range(max(2, int(400 * scale)))]
+    files = {}
+    for i, name in enumerate(names):
+        if i % 5 == 4:
+            files[f"{name}.cls"] = _module(
+                name, f"Private m{name} As Long\n\n" + _functions(rng, name, 2, names)
+            )
+        else:
+            files[f"{name}.bas"] = _module(name, _functions(rng, name, 5, names))
+    return files
+
+
+def few_huge_modules(scale: float = 1.0) -> Dict[str, str]:
+    """
+    A few modules with thousands of functions each.
+    """
+    rng = random.Random(2)
+    names = [f"Huge{i}" for i in range(3)]
+    return {
+        f"{name}.bas": _module(
+            name, _functions(rng, name, max(1, int(1500 * scale)), names)
+        )
+        for name in names
+    }
+
+
+def deep_hashif(scale: float = 1.0) -> Dict[str, str]:
+    """
+    Modules with deeply nested `#If` blocks around declarations and functions.
+    """
+    rng = random.Random(3)
+    names = [f"HashIf{i}" for i in range(max(1, int(20 * scale)))]
+    files = {}
+    for name in names:
+        depth = 30
+        code = []
+        for level in range(depth):
+            code += [
+                f"{'  ' * level}#If Win64 And Level{level} Then",
+                f"{'  ' * level}Private Declare PtrSafe Function Api{level} Lib "
+                f'"kernel32" (ByVal x As LongPtr) As Long',
+                f"{'  ' * level}#ElseIf VBA7 Then",
+                f"{'  ' * level}Private Declare Function Api{level} Lib "
+                f'"kernel32" (ByVal x As Long) As Long',
+                f"{'  ' * level}#Else",
+            ]
+        code.append(_functions(rng, name, 3, names))
+        for level in reversed(range(depth)):
+            code.append(f"{'  ' * level}#End If")
+        code.append(_functions(rng, name + "After", 3, names))
+        files[f"{name}.bas"] = _module(name, "\n".join(code))
+    return files
+
+
+def long_continuations(scale: float = 1.0) -> Dict[str, str]:
+    """
+    Modules with statements continued over many lines.
+    """
+    names = [f"Continued{i}" for i in range(max(1, int(20 * scale)))]
+    files = {}
+    for name in names:
+        code = []
+        for i in range(20):
+            parts = " & _\n        ".join(f'"part {j}" & x{j}' for j in range(60))
+            args = ", _\n    ".join(f"ByVal x{j} As String" for j in range(60))
+            code += [
+                f"Public Function {name}Join{i}( _\n    {args}) As String",
+                f"    {name}Join{i} = {parts}",
+                "End Function",
+                "",
+            ]
+        files[f"{name}.bas"] = _module(name, "\n".join(code))
+    return files
+
+
+corpora = {
+    "many_small_modules": many_small_modules,
+    "few_huge_modules": few_huge_modules,
+    "deep_hashif": deep_hashif,
+    "long_continuations": long_continuations,
+}
+
+
+def _stages(files: Dict[str, str], tmpdir: Path) -> Dict[str, Callable[[], None]]:
+    # Each stage gets its input prepared beforehand, so that only the stage itself is timed
+    streams = {i: tokenize_stream(j) for i, j in files.items()}
+    bas = {i: j for i, j in files.items() if i.lower().endswith(".bas")}
+    patterns = [
+        compile_token_pattern("[public] [declare] property|sub|function|enum|const .*"),
+        compile_token_pattern("#if", on_line_start=True),
+        compile_token_pattern("end function|sub|property", on_line_start=True),
+    ]
+
+    def tree():
+        return VirtualTree.from_data({i: j.encode("latin-1") for i, j in files.items()})
+
+    def renaming():
+        tree_ = tree()
+        transformer = NameTransformer({})
+        do_renaming(tree_, NameTransformer(cls_renaming_dict(tree_, transformer)))
+
+    def config_run():
+        project = tmpdir.joinpath("project")
+        if not project.is_dir():
+            for i, j in files.items():
+                project.joinpath(i).parent.mkdir(parents=True, exist_ok=True)
+                project.joinpath(i).write_text(j, encoding="latin-1")
+
+        Config(
+            Source(path_source=project, glob_include="**/*", combine_bas_files=True)
+        ).run(tmpdir.joinpath("output"))
+
+    return {
+        "tokenize": lambda: [tokenize_stream(i) for i in files.values()],
+        "tokenize_list": lambda: [tokenize(i) for i in files.values()],
+        "match_tokens": lambda: [
+            list(i.finditer(j)) for i in patterns for j in streams.values()
+        ],
+        "code_sections": lambda: [find_all_code_sections(i) for i in streams.values()],
+        "renaming": renaming,
+        "combining": lambda: compile_bas_sources_into_single_file(bas) if bas else None,
+        "namespacing": lambda: bas_create_namespaced_classes(tree()),
+        "config_run": config_run,
+    }
+
+
+def _time(stage: Callable[[], None], repeat: int, tmpdir: Path):
+    runs = []
+    for _ in range(repeat):
+        # Nothing is reused from earlier runs through the token cache
+        token_cache._memory_cache.clear()
+        with mock.patch.object(
+            token_cache, "token_cache_dir", Path(tempfile.mkdtemp(dir=tmpdir))
+        ):
+            start = time.perf_counter()
+            stage()
+            runs.append(time.perf_counter() - start)
+
+    return {
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "runs": runs,
+    }
+
+
+def _import_time(repeat: int):
+    # E.g. pre-commit hooks that only tokenize or fix casing import the package many times
+    code = (
+        "import time; start = time.perf_counter(); "
+        "from zebra_vba_packager import fix_casing, tokenize; "
+        "print(time.perf_counter() - start)"
+    )
+    runs = [
+        float(
+            subprocess.check_output(
+                [sys.executable, "-c", code], cwd=locate.this_dir().parent
+            )
+        )
+        for _ in range(repeat)
+    ]
+    return {
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "runs": runs,
+    }
+
+
+def _commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=locate.this_dir(),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("utf-8")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    repeat: int = 5, scale: float = 1.0, corpus=None, stage=None
+) -> dict:
+    """
+    Time the stages (all, or those named in `stage`) on the corpora (all, or those named in `corpus`), each made
+    `scale` times as large as the default.
+    """
+    results = {}
+    for name, generate in corpora.items():
+        if corpus and name not in corpus:
+            continue
+
+        files = generate(scale)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stages = _stages(files, Path(tmpdir))
+            results[name] = {
+                "files": len(files),
+                "bytes": sum(len(i) for i in files.values()),
+                "stages": {
+                    i: _time(j, repeat, Path(tmpdir))
+                    for i, j in stages.items()
+                    if not stage or i in stage
+                },
+            }
+
+    return {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "scale": scale,
+        "results": results,
+        **({"import": _import_time(repeat)} if not stage or "import" in stage else {}),
+    }
+
+
+def compare(new: dict, old: dict) -> str:
+    """
+    Table of the minimum times of `new` next to those of `old`.
+    """
+    lines = [f"{'corpus':20} {'stage':15} {'old':>9} {'new':>9} {'ratio':>6}"]
+    for corpus, result in new["results"].items():
+        for stage, times in result["stages"].items():
+            try:
+                before = old["results"][corpus]["stages"][stage]["min"]
+            except KeyError:
+                continue
+            lines.append(
+                f"{corpus:20} {stage:15} {before:9.4f} {times['min']:9.4f} "
+                f"{times['min'] / before:6.2f}"
+            )
+
+    if "import" in new and "import" in old:
+        before, after = old["import"]["min"], new["import"]["min"]
+        lines.append(
+            f"{'':20} {'import':15} {before:9.4f} {after:9.4f} {after / before:6.2f}"
+        )
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--corpus", nargs="*", choices=list(corpora))
+    parser.add_argument("--stage", nargs="*")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--compare", help="JSON file with earlier results")
+    args = parser.parse_args(args)
+
+    results = run_benchmarks(args.repeat, args.scale, args.corpus, args.stage)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=1), encoding="utf-8")
+    else:
+        print(json.dumps(results, indent=1))
+
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        print(compare(results, old), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,54 @@
 import tempfile
+import json
 from textwrap import dedent
 import shutil
 import locate
 import unittest
 from pathlib import Path
 import os
+import subprocess
+import sys
 import zipfile
+import gzip
+import hashlib
+import io
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import py7zr
 
 with locate.prepend_sys_path(".."):
     from zebra_vba_packager.bas_combining import (
         compile_code_into_sections,
         compile_bas_sources_into_single_file,
     )
-    from zebra_vba_packager.vba_tokenizer import tokens_to_str, tokenize
-    from zebra_vba_packager.match_tokens import match_tokens
+    from zebra_vba_packager.vba_tokenizer import (
+        tokens_to_str,
+        tokenize,
+        tokenize_legacy,
+        tokenize_lexer,
+        tokenize_stream,
+        iter_tokenize,
+        TokenStream,
+    )
+    from zebra_vba_packager.vba_renaming import (
+        NameTransformer,
+        replace_all_names,
+        do_renaming,
+        bas_create_namespaced_classes,
+        write_tokens,
+    )
+    from zebra_vba_packager import artifact_store, downloader, token_cache
+    from zebra_vba_packager import util, zebra_config
+    from zebra_vba_packager.extraction import extract_archive
+    from zebra_vba_packager.instrumentation import SpanRecorder
+    from zebra_vba_packager.git_backend import GitRepo, read_worktree
+    from zebra_vba_packager.virtual_tree import VirtualTree
+    from zebra_vba_packager.match_tokens import compile_token_pattern, match_tokens
     from zebra_vba_packager.util import to_unix_line_endings
     from zebra_vba_packager import Source, Config
     from zebra_vba_packager.fix_casing import fix_casing
@@ -23,6 +58,633 @@ def lstripdedent(s):
     return dedent(s).lstrip()
 
 
+def git(*args, cwd=None):
+    return (
+        subprocess.check_output(
+            [
+                "git",
+                "-c",
+                "user.name=zebra",
+                "-c",
+                "user.email=zebra@example.com",
+                *args,
+            ],
+            cwd=cwd,
+            stderr=subprocess.DEVNULL,
+        )
+        .decode("utf-8")
+        .strip()
+    )
+
+
+def make_git_repo(path, commits):
+    """
+    A repository at `path` with a commit on `main` for each dict of `{filename: content}`; returns the commit ids.
+    """
+    git("init", "--quiet", "--initial-branch=main", str(path))
+    git("config", "uploadpack.allowFilter", "true", cwd=path)
+    ids = []
+    for files in commits:
+        for name, content in files.items():
+            Path(path, name).parent.mkdir(parents=True, exist_ok=True)
+            Path(path, name).write_text(content)
+        git("add", "--all", cwd=path)
+        git("commit", "--quiet", "--allow-empty", "-m", f"commit {len(ids)}", cwd=path)
+        ids.append(git("rev-parse", "HEAD", cwd=path))
+    return ids
+
+
+class FileServer(ThreadingHTTPServer):
+    """
+    Serves `content` at every path with an ETag, honouring Range/If-Range and If-None-Match. The next response is
+    cut off after `cut_after` bytes if that is set, and the next partial response claims to start at
+    `content_range_start` if that is set. Headers of all requests are kept in `requests`.
+    """
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.etag = '"v1"'
+        self.cut_after = None
+        self.content_range_start = None
+        self.requests = []
+        super().__init__(("127.0.0.1", 0), self.Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/file.zip"
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            server = self.server
+            server.requests.append(dict(self.headers))
+            if self.headers.get("If-None-Match") == server.etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            start = 0
+            if (range_ := self.headers.get("Range")) and self.headers.get(
+                "If-Range"
+            ) == server.etag:
+                start = int(range_[len("bytes=") : -1])
+            body = server.content[start:]
+
+            self.send_response(206 if start else 200)
+            if start:
+                if server.content_range_start is not None:
+                    start, server.content_range_start = server.content_range_start, None
+                self.send_header(
+                    "Content-Range",
+                    f"bytes {start}-{len(server.content) - 1}/{len(server.content)}",
+                )
+            self.send_header("ETag", server.etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+
+            if server.cut_after is not None:
+                body, server.cut_after = body[: server.cut_after], None
+                self.close_connection = True
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+
+class TestTokenizer(unittest.TestCase):
+    def test_lexer_matches_legacy_on_test_files(self):
+        for i in locate.this_dir().rglob("*"):
+            if i.suffix.lower() in (".bas", ".cls"):
+                txt = i.read_text(encoding="latin-1")
+                self.assertEqual(tokenize_legacy(txt), tokenize_lexer(txt), str(i))
+
+    def test_lexer_matches_legacy_on_edge_cases(self):
+        txts = [
+            "rem a\nrem b\nrem c\n  Rem d _\n e\n",
+            "x = 1 _\n  + 2 ' comment _\n continued\ny = 3: rem also a comment",
+            'Attribute VB_Name = "Foo"\r\n#If a Then\n#ElseIf b\n#Else\n#End If \' end if\n',
+            '#End If "if" if: x\n#end if\n#endif\n',
+            's = "a^b" & "c""d" & """"\nt = "unterminated\n',
+            "If a<b Then x=y.z(1)-w:GoTo err_\nerr_:\n",
+        ]
+        for txt in txts:
+            self.assertEqual(tokenize_legacy(txt), tokenize_lexer(txt), txt)
+            self.assertEqual(tokens_to_str(tokenize(txt)), txt.replace("\r\n", "\n"))
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            tokenize("Dim x", engine="nope")
+
+    def test_iter_tokenize_matches_tokenize(self):
+        txts = [
+            i.read_bytes().decode("latin-1")
+            for i in locate.this_dir().rglob("*")
+            if i.suffix.lower() in (".bas", ".cls")
+        ] + [
+            "rem a\nrem b\nrem c\n  Rem d _\n e\nrem f",
+            'Attribute VB_Name = "A"\r\nAttribute VB_Name = "B"\r\r\n#End _\r\n If\r',
+            'x = "a"" _\nb" _\n_\n_ _\n',
+        ]
+        for txt in txts:
+            for chunk_size in [7, 1 << 16]:
+                self.assertEqual(
+                    list(iter_tokenize(io.StringIO(txt, newline=""), chunk_size)),
+                    tokenize(txt),
+                )
+            self.assertEqual(
+                list(iter_tokenize(io.BytesIO(txt.encode("latin-1")))), tokenize(txt)
+            )
+
+    def test_iter_tokenize_bounded_memory(self):
+        # A generated lookup table module of ~2 MB; tokenizing it as a whole takes several times that
+        def lookup_table():
+            yield b'Attribute VB_Name = "Lookup"\r\nPublic Function Lookup(i)\r\n'
+            for i in range(30000):
+                yield f'    If i = {i} Then Lookup = "value {i}" \' row {i}\r\n'.encode()
+            yield b"End Function\r\n"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source, dest = Path(tmpdir, "Lookup.bas"), Path(tmpdir, "out", "Lookup.bas")
+            with open(source, "wb") as f:
+                f.writelines(lookup_table())
+            dest.parent.mkdir()
+
+            tracemalloc.start()
+            try:
+                with open(source, "rb") as f:
+                    write_tokens(dest, iter_tokenize(f))
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+            self.assertLess(peak, source.stat().st_size / 2)
+            self.assertEqual(
+                dest.read_bytes(),
+                source.read_bytes().replace(b"\r\n", os.linesep.encode()),
+            )
+
+
+class TestTokenStream(unittest.TestCase):
+    txt = lstripdedent(
+        """
+        Attribute VB_Name = "MiscArray"
+        Option Explicit
+
+        Private Function Bla(arr As Variant) ' comment
+            Bla = "a""b" & arr(1)
+        End Function
+        """
+    )
+
+    def test_same_tokens_as_tokenize(self):
+        for i in locate.this_dir().rglob("*"):
+            if i.suffix.lower() in (".bas", ".cls"):
+                txt = i.read_text(encoding="latin-1")
+                stream = tokenize_stream(txt)
+                self.assertEqual(stream, tokenize(txt), str(i))
+                self.assertEqual(tokens_to_str(stream), txt.replace("\r\n", "\n"))
+
+    def test_overrides_slices_and_concatenation(self):
+        stream = tokenize_stream(self.txt)
+        tokens = tokenize(self.txt)
+
+        for t_stream, t_list in zip(stream, tokens):
+            if t_list.type == "name":
+                t_stream.text = t_list.text = t_list.text.upper()
+
+        self.assertEqual(stream, tokens)
+        self.assertEqual(stream.to_list(), tokens)
+        self.assertEqual(tokens_to_str(stream), tokens_to_str(tokens))
+        self.assertEqual(tokens_to_str(stream[5:-3]), tokens_to_str(tokens[5:-3]))
+        self.assertEqual(
+            tokens_to_str(stream[:7] + stream[-9:]),
+            tokens_to_str(tokens[:7] + tokens[-9:]),
+        )
+        self.assertEqual(
+            tokens_to_str(tokens[:7] + stream[-9:]),
+            tokens_to_str(tokens[:7] + tokens[-9:]),
+        )
+        self.assertEqual(stream[::2], tokens[::2])
+        self.assertEqual(TokenStream.from_tokens(tokens), tokens)
+
+    def test_copy_is_independent(self):
+        stream = tokenize_stream(self.txt)
+        renamed = replace_all_names(stream, NameTransformer({"bla": "Foo"}))
+
+        self.assertIn("Bla = ", tokens_to_str(stream))
+        self.assertIn("Foo = ", tokens_to_str(renamed))
+        self.assertEqual(
+            renamed,
+            replace_all_names(tokenize(self.txt), NameTransformer({"bla": "Foo"})),
+        )
+
+
+class TestMatchTokens(unittest.TestCase):
+    txt = lstripdedent(
+        """
+        Attribute VB_Name = "Shapes"
+        Option Explicit
+
+        Private Const PI As Double = 3.14
+        Public Declare PtrSafe Function GetTickCount Lib "kernel32" () As Long
+        Dim counter As Long
+        Public area As New Collection
+
+        Public Function Area(r As Double) As Double
+            Area = PI * r * r ' Function Area
+        End Function
+
+        Private Sub Reset()
+            counter = 0
+        End Sub
+
+        Enum Kind
+            Round = 1
+        End Enum
+
+        Property Get Name() As String
+            Name = "shape"
+        End Property
+        """
+    )
+
+    def assertMatches(self, expected, pattern, **kwargs):
+        # Same matches for token lists and streams, and for compiled and uncompiled patterns
+        for tokens in [tokenize(self.txt), tokenize_stream(self.txt)]:
+            for pattern_ in [pattern, compile_token_pattern(pattern, **kwargs)]:
+                self.assertEqual(
+                    [
+                        (i, j, tokens_to_str(tokens[i:j]))
+                        for i, j in match_tokens(tokens, pattern_, **kwargs)
+                    ],
+                    expected,
+                )
+
+    def test_package_patterns(self):
+        self.assertMatches(
+            [
+                (17, 20, "Const PI"),
+                (35, 38, "Function GetTickCount"),
+                (68, 73, "Public Function Area"),
+                (70, 73, "Function Area"),
+                (104, 106, "Function\n"),
+                (109, 112, "Sub Reset"),
+                (123, 125, "Sub\n"),
+                (126, 129, "Enum Kind"),
+                (139, 141, "Enum\n"),
+                (142, 145, "Property Get"),
+                (162, 164, "Property\n"),
+            ],
+            "[public] [declare] property|sub|function|enum|const .*",
+        )
+        self.assertMatches(
+            [(15, 20, "Private Const PI"), (107, 112, "Private Sub Reset")],
+            "private [static] function|sub|parameter|enum|const .*",
+            on_line_start=True,
+        )
+        self.assertMatches(
+            [
+                (68, 71, "Public Function"),
+                (107, 110, "Private Sub"),
+                (126, 127, "Enum"),
+                (142, 143, "Property"),
+            ],
+            "[private|public] property|sub|function|enum",
+            on_line_start=True,
+        )
+        self.assertMatches(
+            [(0, 1, "Attribute"), (10, 11, "Option"), (29, 32, "Public Declare")],
+            "[private|public] declare|option|attribute",
+            on_line_start=True,
+        )
+        self.assertMatches(
+            [
+                (49, 57, "Dim counter As Long\n"),
+                (57, 67, "Public area As New Collection\n"),
+            ],
+            "[private|public|dim] .* as [new] .*",
+            on_line_start=True,
+            on_line_end=True,
+        )
+
+    def test_start(self):
+        tokens = tokenize_stream(self.txt)
+        for pattern, kwargs in [
+            ("[public] [declare] property|sub|function|enum|const .*", {}),
+            ("end property|sub|function|enum", {"on_line_start": True}),
+            ("[private|public|dim] .* as [new] .*", {"on_line_end": True}),
+            (r"\n", {}),
+        ]:
+            everything = list(match_tokens(tokens, pattern, **kwargs))
+            for start in [0, 1, 30, 40, 104, 105, len(tokens)]:
+                from_start = list(match_tokens(tokens, pattern, start=start, **kwargs))
+
+                # Same as matching the tokens from `start`, without copying them
+                self.assertEqual(
+                    from_start,
+                    [
+                        (i + start, j + start)
+                        for i, j in match_tokens(tokens[start:], pattern, **kwargs)
+                    ],
+                )
+                if not kwargs.get("on_line_start"):
+                    # Where a match starts doesn't depend on the tokens before it
+                    self.assertEqual(
+                        from_start, [i for i in everything if i[0] >= start]
+                    )
+
+        self.assertEqual(
+            list(
+                match_tokens(
+                    tokens,
+                    "end property|sub|function|enum",
+                    on_line_start=True,
+                    start=40,
+                )
+            ),
+            [(102, 105), (121, 124), (137, 140), (160, 163)],
+        )
+        self.assertEqual(next(match_tokens(tokens, r"\n", start=5)), (9, 10))
+
+
+class TestNameTransformer(unittest.TestCase):
+    def test_first_matching_rule_wins(self):
+        def is_foo(x):
+            return x.lower() == "foo"
+
+        cases = [
+            # A function rule before a string rule for the same name
+            ([(is_foo, "Func"), ("foo", "Str")], "Func", False),
+            # A function rule after it
+            ([("foo", "Str"), (is_foo, "Func")], "Str", True),
+            # Duplicate string rules with different case
+            ([("FOO", "First"), ("foo", "Second")], "First", True),
+            ([("FOO", "First"), (is_foo, "Func"), ("foo", "Second")], "First", True),
+            ([(lambda x: False, "Never"), ("Foo", str.upper)], "FOO", True),
+            ([(is_foo, str.lower), ("Foo", "Str")], "foo", False),
+        ]
+        for rules, transformed, matched in cases:
+            transformer = NameTransformer(rules)
+            # The remembered rule gives the same result the second time
+            for _ in range(2):
+                for name in ["foo", "Foo", "FOO"]:
+                    self.assertEqual(transformer.transform(name), transformed, rules)
+                    self.assertEqual(transformer.match(name), matched, rules)
+                self.assertEqual(transformer.transform("Bar"), "Bar")
+                self.assertFalse(transformer.match("Bar"))
+
+    def test_remembered_rules_are_bounded(self):
+        transformer = NameTransformer(
+            [("x1", "Y1"), (lambda x: x.startswith("x"), str.upper)]
+        )
+        with mock.patch.object(NameTransformer, "_memo_entries", 3):
+            for _ in range(2):
+                self.assertEqual(
+                    [transformer.transform(f"x{i}") for i in range(10)],
+                    ["X0", "Y1", *(f"X{i}" for i in range(2, 10))],
+                )
+                self.assertLessEqual(len(transformer._memo), 3)
+
+
+class TestTokenCache(unittest.TestCase):
+    def test_reuse_and_invalid_entries(self):
+        txt = TestTokenStream.txt
+        with tempfile.TemporaryDirectory() as tmpdir:
+            token_cache._memory_cache.clear()
+            stream = token_cache.cached_tokenize_stream(txt, tmpdir)
+            (entry,) = Path(tmpdir).glob("*.tokens")
+
+            token_cache._memory_cache.clear()
+            self.assertEqual(token_cache.cached_tokenize_stream(txt, tmpdir), stream)
+
+            # Truncated entries are ignored and rewritten
+            entry.write_bytes(entry.read_bytes()[:-9])
+            token_cache._memory_cache.clear()
+            self.assertEqual(token_cache.cached_tokenize_stream(txt, tmpdir), stream)
+            self.assertEqual(len(entry.read_bytes()), 9 * len(tokenize_stream(txt)))
+
+            # Rewriting a returned stream doesn't leak into the cache
+            stream[-3].text = "Nope"
+            self.assertEqual(
+                tokens_to_str(token_cache.cached_tokenize_stream(txt, tmpdir)),
+                txt,
+            )
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            entries = []
+            for i in range(5):
+                txt = f"Dim x{i} As Long\n"
+                token_cache.cached_tokenize_stream(txt, tmpdir)
+                entries.append(Path(tmpdir, f"{token_cache._cache_key(txt)}.tokens"))
+                os.utime(entries[-1], (1000 + i, 1000 + i))
+
+            token_cache.evict_token_cache(2 * entries[-1].stat().st_size, tmpdir)
+            self.assertEqual(
+                sorted(Path(tmpdir).glob("*.tokens")), sorted(entries[-2:])
+            )
+
+    def test_threads_share_the_memory_cache(self):
+        # A small cache, so that threads keep evicting each other's entries
+        txts = [f"Dim x{i} As Long\n" for i in range(16)]
+        errors = []
+
+        def tokenize_all(tmpdir):
+            try:
+                for _ in range(50):
+                    for txt in txts:
+                        stream = token_cache.cached_tokenize_stream(txt, tmpdir)
+                        if tokens_to_str(stream) != txt:
+                            errors.append(txt)
+            except Exception as e:
+                errors.append(e)
+
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.object(
+            token_cache, "_memory_cache_entries", 4
+        ):
+            token_cache._memory_cache.clear()
+            threads = [
+                threading.Thread(target=tokenize_all, args=(tmpdir,)) for _ in range(8)
+            ]
+            for i in threads:
+                i.start()
+            for i in threads:
+                i.join()
+
+            self.assertEqual(errors, [])
+            self.assertLessEqual(len(token_cache._memory_cache), 4)
+
+
+class TestVirtualTree(unittest.TestCase):
+    def test_same_result_as_on_disk(self):
+        project = locate.this_dir().joinpath("uncompiled-project", "TemplateGen")
+        transformer = NameTransformer({"HashLib": "HashLibX"})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shutil.copytree(project, tmpdir, dirs_exist_ok=True)
+            do_renaming(tmpdir, transformer)
+            bas_create_namespaced_classes(tmpdir)
+
+            tree = VirtualTree.from_dir(project)
+            do_renaming(tree, transformer)
+            bas_create_namespaced_classes(tree)
+
+            on_disk = [i for i in Path(tmpdir).rglob("*") if i.is_file()]
+            self.assertEqual(
+                sorted(i.relative_to(tmpdir) for i in on_disk), sorted(tree.files)
+            )
+            for i in on_disk:
+                if i.suffix in (".bas", ".cls"):
+                    self.assertEqual(
+                        i.read_text(encoding="latin-1"),
+                        tree[i.relative_to(tmpdir)].text,
+                    )
+
+    def test_hooks_see_files_on_disk(self):
+        def mid_process(source):
+            source.temp_transformed.joinpath("HashLib.bas").unlink()
+            source.temp_transformed.joinpath("Extra.bas").write_text(
+                'Attribute VB_Name = "Extra"\nPublic Function ExtraFn()\nEnd Function\n'
+            )
+
+        def post_process(source):
+            names.extend(i.name for i in source.temp_transformed.glob("*.cls"))
+
+        names = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            Config(
+                Source(
+                    path_source=locate.this_dir().joinpath(
+                        "uncompiled-project", "TemplateGen"
+                    ),
+                    glob_include="**/*.bas",
+                    mid_process=mid_process,
+                    post_process=post_process,
+                )
+            ).run(tmpdir)
+
+            output = sorted(i.name for i in Path(tmpdir).glob("*.cls"))
+            self.assertIn("z__Extra.cls", names)
+            self.assertNotIn("z__HashLib.cls", names)
+            self.assertEqual(output, sorted(names))
+
+
+class TestParallelRun(unittest.TestCase):
+    def test_same_output_as_sequential(self):
+        project = locate.this_dir().joinpath("uncompiled-project")
+        config = Config(
+            Source(
+                path_source=project.joinpath("VBALib"),
+                glob_include=["**/*.cls", "**/*.bas"],
+            ),
+            # Same download directory, and renames that can't be sent to another process
+            *[
+                Source(
+                    path_source=project.joinpath("TemplateGen"),
+                    glob_include=glob,
+                    rename_overwrites=[(lambda x: x == "HashLib", "HashLibX")],
+                )
+                for glob in ("**/Hash*.bas", "**/Scenario*.bas")
+            ],
+        )
+
+        outputs = []
+        for workers in (None, 3):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                config.run(tmpdir, workers=workers)
+                outputs.append({i.name: i.read_bytes() for i in Path(tmpdir).glob("*")})
+
+        self.assertIn("z__HashLibX.cls", outputs[0])
+        self.assertEqual(outputs[0], outputs[1])
+
+
+class TestIncrementalRun(unittest.TestCase):
+    def test_unchanged_sources_are_reused(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            project = Path(tmpdir, "TemplateGen")
+            shutil.copytree(
+                locate.this_dir().joinpath("uncompiled-project", "TemplateGen"),
+                project,
+            )
+            source = Source(path_source=project, glob_include="**/*.bas")
+            config = Config(source)
+
+            output = Path(tmpdir, "output")
+            config.run(output, incremental=True)
+            mtimes = {i.name: i.stat().st_mtime_ns for i in output.glob("*")}
+
+            config.run(output, incremental=True)
+            self.assertTrue(source._reused)
+            self.assertEqual(
+                mtimes, {i.name: i.stat().st_mtime_ns for i in output.glob("*")}
+            )
+
+            # A changed file rebuilds the source and only rewrites what changed
+            with project.joinpath("HashLib.bas").open("a") as f:
+                f.write("\nPublic Function Extra()\nEnd Function\n")
+            config.run(output, incremental=True)
+            self.assertFalse(source._reused)
+            changed = [
+                i.name
+                for i in output.glob("*")
+                if i.stat().st_mtime_ns != mtimes.get(i.name)
+            ]
+            self.assertIn("z__HashLib.cls", changed)
+            self.assertNotIn("z__Examples.cls", changed)
+
+            full = Path(tmpdir, "full")
+            config.run(full)
+            self.assertEqual(
+                {i.name: i.read_bytes() for i in output.glob("*")},
+                {i.name: i.read_bytes() for i in full.glob("*")},
+            )
+
+    def test_output_is_synced(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            project = Path(tmpdir, "TemplateGen")
+            shutil.copytree(
+                locate.this_dir().joinpath("uncompiled-project", "TemplateGen"),
+                project,
+            )
+            config = Config(Source(path_source=project, glob_include="**/*.bas"))
+
+            output = Path(tmpdir, "output")
+            changes = config.run(output)
+            self.assertEqual(
+                sorted(i.name for i in output.glob("*")),
+                sorted(i.name for i in changes.added),
+            )
+            self.assertEqual((changes.changed, changes.removed), ([], []))
+            mtimes = {i.name: i.stat().st_mtime_ns for i in output.glob("*")}
+
+            # Only stale files are touched
+            output.joinpath("Stale.bas").write_text("x")
+            output.joinpath("old", "sub").mkdir(parents=True)
+            output.joinpath("old", "sub", "Stale.cls").write_text("x")
+            changes = config.run(output)
+            self.assertEqual(
+                (changes.added, changes.changed, changes.removed),
+                ([], [], [Path("Stale.bas"), Path("old", "sub", "Stale.cls")]),
+            )
+            self.assertFalse(output.joinpath("old").exists())
+            self.assertEqual(
+                mtimes, {i.name: i.stat().st_mtime_ns for i in output.glob("*")}
+            )
+
+            with project.joinpath("HashLib.bas").open("a") as f:
+                f.write("\nPublic Function Extra()\nEnd Function\n")
+            changes = config.run(output)
+            self.assertIn(Path("z__HashLib.cls"), changes.changed)
+            self.assertNotIn(Path("z__Examples.cls"), changes.changed)
+            self.assertEqual(
+                {
+                    i.name
+                    for i in output.glob("*")
+                    if i.stat().st_mtime_ns != mtimes[i.name]
+                },
+                {i.name for i in changes.changed},
+            )
+
+
 class TestBasCombining(unittest.TestCase):
     def test_matching(self):
         x = "\nPrivate Function Bla2(arr As Variant)\n    Bla2 = True\nEnd Function"
@@ -167,6 +829,20 @@ class TestBasCombining(unittest.TestCase):
 
         self.assertTrue("".join([tokens_to_str(i.tokens) for i in y]) == x)
 
+    def test_compile_code_into_sections_large_module(self):
+        x = 'Attribute VB_Name = "Large"\n' + "".join(
+            f"Private Function F{i}(x)\n    F{i} = x\nEnd Function\nDim v{i} As Long\n"
+            for i in range(1000)
+        )
+
+        y = compile_code_into_sections(tokenize(x))
+
+        self.assertEqual(
+            ["attribute"] + ["function", "unknown", "global"] * 1000,
+            [i.type for i in y],
+        )
+        self.assertTrue("".join([tokens_to_str(i.tokens) for i in y]) == x)
+
     def test_underscore_names(self):
         txt = lstripdedent(
             """
@@ -324,6 +1000,762 @@ class TestBasCombining(unittest.TestCase):
 
         self.assertEqual(txt1, txt2)
 
+    def test_combining_leaves_tokens_alone(self):
+        txts = {
+            i: i.read_text()
+            for i in locate.this_dir()
+            .joinpath("misc-vba-example/2022-08-08-input")
+            .glob("*")
+        }
+        combined = compile_bas_sources_into_single_file(txts)
+
+        for tokenizer in (tokenize, tokenize_stream):
+            sources = {key: tokenizer(val) for key, val in txts.items()}
+            self.assertEqual(compile_bas_sources_into_single_file(sources), combined)
+            for key, val in sources.items():
+                self.assertEqual(tokens_to_str(val), to_unix_line_endings(txts[key]))
+
+
+class TestGitDownload(unittest.TestCase):
+    def test_mirror_and_worktree_checkouts(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            remote = Path(tmpdir, "remote")
+            c1, c2 = make_git_repo(
+                remote, [{"A.bas": "1", "b/B.bas": "1"}, {"A.bas": "2"}]
+            )
+            git("tag", "v1", c1, cwd=remote)
+            mirrors, dest = Path(tmpdir, "mirrors"), Path(tmpdir, "dest")
+
+            downloader.git_download(remote.as_uri(), dest, mirror_dir=mirrors)
+            self.assertEqual(Path(dest, "A.bas").read_text(), "2")
+
+            Path(dest, "A.bas").write_text("dirty")
+            Path(dest, "untracked.bas").write_text("")
+            downloader.git_download(remote.as_uri(), dest, "v1", mirror_dir=mirrors)
+            self.assertEqual(Path(dest, "A.bas").read_text(), "1")
+            self.assertFalse(Path(dest, "untracked.bas").exists())
+
+            # Commits are fetched by id, and known commits don't need the remote
+            c3, c4 = make_git_repo(remote, [{"A.bas": "3"}, {"A.bas": "4"}])[-2:]
+            git("reset", "--quiet", "--hard", c2, cwd=remote)
+            downloader.git_download(remote.as_uri(), dest, c3, mirror_dir=mirrors)
+            self.assertEqual(Path(dest, "A.bas").read_text(), "3")
+
+            shutil.move(remote, remote.with_name("gone"))
+            downloader.git_download(remote.as_uri(), dest, c1[:7], mirror_dir=mirrors)
+            self.assertEqual(Path(dest, "A.bas").read_text(), "1")
+
+            with self.assertRaises(RuntimeError):
+                downloader.git_download(remote.as_uri(), dest, c4, mirror_dir=mirrors)
+
+            # A second checkout shares the mirror
+            other = Path(tmpdir, "other")
+            downloader.git_download(remote.as_uri(), other, c3, mirror_dir=mirrors)
+            self.assertEqual(Path(other, "b/B.bas").read_text(), "1")
+            self.assertEqual(len(list(mirrors.iterdir())), 1)
+
+    def test_processes_share_a_new_mirror(self):
+        code = dedent(
+            """
+            import sys, time
+            from pathlib import Path
+            from zebra_vba_packager import downloader
+            remote, tmpdir = sys.argv[1:]
+            while not Path(tmpdir, "go").exists():
+                time.sleep(0.001)
+            tree = downloader.git_tree(
+                remote, mirror_dir=Path(tmpdir, "mirrors"), store_dir=Path(tmpdir, "store")
+            )
+            print(tree.joinpath("A.bas").read_text())
+            """
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            remote = Path(tmpdir, "remote")
+            make_git_repo(remote, [{"A.bas": "1"}])
+
+            # Both processes find no mirror and start making it at the same moment
+            for i in range(3):
+                run_dir = Path(tmpdir, f"run{i}")
+                run_dir.mkdir()
+                processes = [
+                    subprocess.Popen(
+                        [sys.executable, "-c", code, remote.as_uri(), str(run_dir)],
+                        cwd=locate.this_dir().parent,
+                        stdout=subprocess.PIPE,
+                    )
+                    for _ in range(2)
+                ]
+                run_dir.joinpath("go").touch()
+                for process in processes:
+                    self.assertEqual(process.communicate()[0].strip(), b"1")
+                    self.assertEqual(process.returncode, 0)
+                self.assertEqual(
+                    [i.name for i in run_dir.joinpath("mirrors").iterdir()],
+                    [downloader.git_mirror_path(remote.as_uri()).name],
+                )
+
+    def test_export_only_fetches_selected_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            remote = Path(tmpdir, "remote")
+            files = {"A.bas": "a", "b/B.bas": "b", "b/C.cls": "c", "doc/x.md": "x"}
+            (c1,) = make_git_repo(remote, [files])
+            mirrors = Path(tmpdir, "mirrors")
+
+            exported = downloader.git_export(
+                remote.as_uri(), c1, ["**/*.bas", "b"], "b/B.bas", mirror_dir=mirrors
+            )
+            self.assertEqual(exported, {"A.bas": b"a", "b/C.cls": b"c"})
+
+            with GitRepo(downloader.git_mirror_path(remote.as_uri(), mirrors)) as repo:
+                blobs = repo.ls_tree(c1)
+                self.assertEqual(
+                    repo.missing_objects(c1), {blobs["b/B.bas"], blobs["doc/x.md"]}
+                )
+
+    def test_export_same_output_as_checkout(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            remote = Path(tmpdir, "remote")
+            project = locate.this_dir().joinpath("uncompiled-project", "TemplateGen")
+            make_git_repo(
+                remote,
+                [{i.name: i.read_text(encoding="latin-1") for i in project.glob("*")}],
+            )
+
+            outputs = []
+            with mock.patch.object(downloader, "git_mirror_dir", Path(tmpdir, "m")):
+                for export in (False, True):
+                    output = Path(tmpdir, f"output-{export}")
+                    Config(
+                        Source(
+                            git_source=remote.as_uri(),
+                            git_export=export,
+                            glob_include="**/*.bas",
+                            glob_exclude="**/Scenario*",
+                        )
+                    ).run(output)
+                    outputs.append({i.name: i.read_bytes() for i in output.glob("*")})
+
+            self.assertIn("z__HashLib.cls", outputs[0])
+            self.assertEqual(outputs[0], outputs[1])
+
+
+class TestUrlDownload(unittest.TestCase):
+    def test_resume_and_cache(self):
+        content = os.urandom(300_000)
+        md5 = hashlib.md5(content).hexdigest()
+        sha256 = hashlib.sha256(content).hexdigest()
+
+        with tempfile.TemporaryDirectory() as tmpdir, FileServer(content) as server:
+            dest = Path(tmpdir, "file.zip")
+            server.cut_after = 100_000
+            with self.assertRaises(RuntimeError):
+                downloader.url_download(server.url, dest, chunk_size=1000)
+            self.assertFalse(dest.exists())
+
+            # The rest is fetched with a range request, the whole file is hashed
+            digests = downloader.url_download(server.url, dest)
+            self.assertEqual(digests, {"md5": md5, "sha256": sha256})
+            self.assertEqual(server.requests[-1]["Range"], "bytes=100000-")
+            self.assertEqual(dest.read_bytes(), content)
+
+            # A known hash needs no request, otherwise the server is asked if the file changed
+            downloader.url_download(server.url, dest, sha256=sha256.upper())
+            self.assertEqual(len(server.requests), 2)
+            self.assertEqual(downloader.url_download(server.url, dest), digests)
+            self.assertEqual(server.requests[-1]["If-None-Match"], '"v1"')
+
+            # A file with another hash is downloaded again, but not kept
+            server.content, server.etag = b"changed", '"v2"'
+            with self.assertRaises(RuntimeError):
+                downloader.url_download(server.url, dest, md5="0" * 32)
+            self.assertEqual(dest.read_bytes(), content)
+            self.assertEqual(server.requests[-1]["If-None-Match"], '"v1"')
+            downloader.url_download(server.url, dest)
+            self.assertEqual(dest.read_bytes(), b"changed")
+
+    def test_resume_with_wrong_range(self):
+        content = os.urandom(300_000)
+
+        with tempfile.TemporaryDirectory() as tmpdir, FileServer(content) as server:
+            dest = Path(tmpdir, "file.zip")
+            server.cut_after = 100_000
+            with self.assertRaises(RuntimeError):
+                downloader.url_download(server.url, dest)
+
+            # A partial response that doesn't follow on the partial file starts the download over
+            server.content_range_start = 50_000
+            downloader.url_download(server.url, dest)
+            self.assertEqual(dest.read_bytes(), content)
+            self.assertEqual(server.requests[-2]["Range"], "bytes=100000-")
+            self.assertNotIn("Range", server.requests[-1])
+
+    def test_url_source(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as f:
+            f.writestr("lib/Mod.bas", 'Attribute VB_Name = "Mod"\nSub A()\nEnd Sub\n')
+            f.writestr("lib/docs/big.md", "x" * 100_000)
+        md5 = hashlib.md5(buffer.getvalue()).hexdigest()
+
+        with tempfile.TemporaryDirectory() as tmpdir, FileServer(
+            buffer.getvalue()
+        ) as server, mock.patch.object(
+            artifact_store, "artifact_store_dir", Path(tmpdir, "store")
+        ):
+            # Another source with the same file gets it from the store
+            for source in [
+                Source(url_source=server.url, url_md5=md5, glob_include="**/*.bas"),
+                Source(url_source=server.url, url_md5=md5, glob_include="**/*.bas"),
+            ]:
+                Config(source).run(Path(tmpdir, "output"))
+                self.assertTrue(Path(tmpdir, "output", "z__Mod.cls").is_file())
+            self.assertEqual(len(server.requests), 1)
+            self.assertEqual(
+                len(list(Path(tmpdir, "store", "trees").glob("*.complete"))), 1
+            )
+            # Only the selected files were extracted
+            self.assertEqual(
+                [i.name for i in source.temp_downloads.rglob("*") if i.is_file()],
+                ["Mod.bas"],
+            )
+
+
+class TestGlobMatching(unittest.TestCase):
+    def test_single_walk(self):
+        def reference(path, glob_include, glob_exclude):
+            # Each glob on its own, as `Path.glob` sees it
+            def files(globs):
+                found = set()
+                for glob in [globs] if isinstance(globs, str) else globs:
+                    for i in Path(path).glob(glob):
+                        found |= {j for j in i.rglob("*") if j.is_file()}
+                        found |= {i} if i.is_file() else set()
+                return {i.resolve() for i in found}
+
+            return files(glob_include) - files(glob_exclude)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in [
+                "A.bas",
+                "src/B.bas",
+                "src/C.cls",
+                "src/node_modules/D.bas",
+                "src/sub/E.bas",
+                "src/sub/z__NameSpaces.bas",
+                "docs/F.bas",
+            ]:
+                Path(tmpdir, name).parent.mkdir(parents=True, exist_ok=True)
+                Path(tmpdir, name).write_text("x")
+
+            root = Path(tmpdir).resolve().name
+            for glob_include, glob_exclude, scanned in [
+                ("**/*.bas", [], {root, "src", "node_modules", "sub", "docs"}),
+                (
+                    ["src", "*.bas"],
+                    ["**/node_modules", "**/z__*.bas"],
+                    {root, "src", "sub"},
+                ),
+                ("src/**/*.*", "src/sub", {root, "src", "node_modules"}),
+                ("**/sub/*", "**/*.cls", {root, "src", "node_modules", "sub", "docs"}),
+            ]:
+                with mock.patch.object(util.os, "scandir", wraps=os.scandir) as scan:
+                    found = util.get_matching_file_patterns(
+                        tmpdir, glob_include, glob_exclude
+                    )
+                self.assertEqual(
+                    found, reference(tmpdir, glob_include, glob_exclude), glob_include
+                )
+                # Directories that are excluded, or can't hold included files, aren't read
+                self.assertEqual(
+                    {Path(i.args[0]).name for i in scan.call_args_list}, scanned
+                )
+
+
+class TestExtraction(unittest.TestCase):
+    def test_selected_files_of_each_format(self):
+        files = {
+            "pkg/src/A.bas": b"a",
+            "pkg/src/sub/B.cls": b"b",
+            "pkg/docs/x.md": b"x",
+        }
+        select = util.path_matcher("**/src", "**/sub/*.bas")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            src = tmpdir.joinpath("src")
+            for name, data in files.items():
+                src.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+                src.joinpath(name).write_bytes(data)
+
+            for fmt in ("zip", "tar", "gztar"):
+                shutil.make_archive(tmpdir.joinpath("a"), fmt, src)
+            shutil.copy(tmpdir.joinpath("a.tar.gz"), tmpdir.joinpath("b.gz"))
+            with py7zr.SevenZipFile(tmpdir.joinpath("a.7z"), "w") as f:
+                f.writeall(src.joinpath("pkg"), "pkg")
+
+            for name in ("a.zip", "a.tar", "a.tar.gz", "b.gz", "a.7z"):
+                out = tmpdir.joinpath(f"out-{name}")
+                extracted = extract_archive(tmpdir.joinpath(name), out, select)
+                self.assertEqual(
+                    sorted(extracted), ["pkg/src/A.bas", "pkg/src/sub/B.cls"], name
+                )
+                self.assertEqual(
+                    sorted(
+                        i.relative_to(out).as_posix()
+                        for i in out.rglob("*")
+                        if i.is_file()
+                    ),
+                    sorted(extracted),
+                    name,
+                )
+                self.assertEqual(out.joinpath("pkg/src/sub/B.cls").read_bytes(), b"b")
+
+            # A gz that isn't a tar holds a single file
+            tmpdir.joinpath("c.txt.gz").write_bytes(gzip.compress(b"c"))
+            self.assertEqual(
+                extract_archive(tmpdir.joinpath("c.txt.gz"), tmpdir.joinpath("c")),
+                ["c.txt"],
+            )
+
+    def test_nested_unpacking(self):
+        def zip_bytes(files):
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w") as f:
+                for name, data in files.items():
+                    f.writestr(name, data)
+            return buffer.getvalue()
+
+        inner = zip_bytes({"deep/c.zip": zip_bytes({"x.bas": "x"})})
+        outer = zip_bytes({"b.zip": inner, "b.bas": "b"})
+
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.object(
+            artifact_store, "artifact_store_dir", Path(tmpdir, "store")
+        ):
+            for depth in (2, 8):
+                drop = Path(tmpdir, f"drop-{depth}")
+                drop.joinpath("sub").mkdir(parents=True)
+                drop.joinpath("a.zip").write_bytes(outer)
+                drop.joinpath("sub", "same.zip").write_bytes(outer)
+
+                with mock.patch.object(
+                    util, "extract_archive", wraps=extract_archive
+                ) as extract:
+                    util.unpack_globs("**/*.zip", drop, depth, workers=4)
+
+                found = sorted(
+                    i.relative_to(drop).as_posix()
+                    for i in drop.rglob("*.bas")
+                    if i.is_file()
+                )
+                deepest = ["a.zip-unpack/b.zip-unpack/deep/c.zip-unpack/x.bas"]
+                self.assertEqual(
+                    found,
+                    ["a.zip-unpack/b.bas"]
+                    + (deepest if depth > 2 else [])
+                    + ["sub/same.zip-unpack/b.bas"]
+                    + (
+                        ["sub/" + deepest[0].replace("a.zip", "same.zip")]
+                        if depth > 2
+                        else []
+                    ),
+                )
+                # Each distinct archive is only extracted once, also over both runs
+                self.assertEqual(extract.call_count, 2 if depth == 2 else 1)
+
+
+class TestArtifactStore(unittest.TestCase):
+    def test_files_and_trees(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = Path(tmpdir, "store")
+            Path(tmpdir, "a.txt").write_bytes(b"a")
+            digests = {
+                "md5": hashlib.md5(b"a").hexdigest(),
+                "sha256": hashlib.sha256(b"a").hexdigest().upper(),
+            }
+            stored = artifact_store.store_file(Path(tmpdir, "a.txt"), digests, store)
+            self.assertEqual(stored.read_bytes(), b"a")
+            self.assertEqual(
+                artifact_store.stored_file({"md5": digests["md5"].upper()}, store),
+                (stored, {i: j.lower() for i, j in digests.items()}),
+            )
+            self.assertIsNone(artifact_store.stored_file({"md5": "0" * 32}, store))
+
+            calls = []
+
+            def populate(path):
+                calls.append(path)
+                path.joinpath("sub").mkdir()
+                artifact_store.link_file(stored, path.joinpath("sub", "a.txt"))
+
+            tree = artifact_store.stored_tree("key", populate, store)
+            self.assertEqual(artifact_store.stored_tree("key", populate, store), tree)
+            self.assertEqual(len(calls), 1)
+
+            dst = Path(tmpdir, "dst")
+            dst.mkdir()
+            dst.joinpath("old.txt").write_bytes(b"")
+            artifact_store.link_tree(tree, dst)
+            self.assertEqual(
+                [i.relative_to(dst).as_posix() for i in dst.rglob("*")],
+                ["sub", "sub/a.txt"],
+            )
+            self.assertEqual(dst.joinpath("sub", "a.txt").read_bytes(), b"a")
+
+    def test_concurrent_fills(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = Path(tmpdir, "store")
+            calls = []
+
+            def populate(path):
+                calls.append(path)
+                time.sleep(0.2)
+                path.joinpath("a.txt").write_text("a")
+
+            # The first thread fills the key and the others wait for it, without replacing the tree they got
+            with ThreadPoolExecutor(4) as pool:
+                trees = list(
+                    pool.map(
+                        lambda _: artifact_store.stored_tree("key", populate, store),
+                        range(4),
+                    )
+                )
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(len(set(trees)), 1)
+            self.assertEqual(trees[0].joinpath("a.txt").read_text(), "a")
+            self.assertEqual(
+                sorted(i.name for i in store.joinpath("trees").iterdir()),
+                ["key", "key.complete"],
+            )
+
+            # A marker that appeared in the meantime wins over the tree being filled
+            def populate_elsewhere(path):
+                Path(store, "trees", "other").mkdir()
+                Path(store, "trees", "other.complete").touch()
+
+            tree = artifact_store.stored_tree("other", populate_elsewhere, store)
+            self.assertEqual(list(tree.iterdir()), [])
+            self.assertEqual(
+                sorted(i.name for i in store.joinpath("trees").iterdir()),
+                ["key", "key.complete", "other", "other.complete"],
+            )
+
+    def test_lock_across_processes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            code = dedent(
+                f"""
+                import sys
+                from zebra_vba_packager import artifact_store
+                with artifact_store.locked("name", {tmpdir!r}):
+                    print("locked", flush=True)
+                    sys.stdin.read()
+                """
+            )
+            with subprocess.Popen(
+                [sys.executable, "-c", code],
+                cwd=locate.this_dir().parent,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            ) as process:
+                self.assertEqual(process.stdout.readline().strip(), b"locked")
+                with artifact_store.locked("name", tmpdir, blocking=False) as held:
+                    self.assertFalse(held)
+                process.stdin.close()
+                process.wait()
+
+            with artifact_store.locked("name", tmpdir, blocking=False) as held:
+                self.assertTrue(held)
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            temp, store = Path(tmpdir, "temp"), Path(tmpdir, "temp", "artifacts")
+            trees = store.joinpath("trees")
+            for i, name in enumerate(["kept", "locked", "old", "new"]):
+                Path(trees, name).mkdir(parents=True)
+                Path(trees, name, "data").write_bytes(b"x" * 1000)
+                Path(trees, f"{name}.complete").touch()
+                os.utime(Path(trees, name), (1000 + i, 1000 + i))
+                os.utime(Path(trees, f"{name}.complete"), (1000 + i, 1000 + i))
+
+            # The working directory of a source isn't the store's to remove, however old
+            Path(temp, "source").mkdir()
+            Path(temp, "source", "data").write_bytes(b"x" * 1000)
+            os.utime(Path(temp, "source"), (900, 900))
+
+            # Hard linked files are only counted once
+            digests = {"md5": "0" * 32, "sha256": "1" * 64}
+            artifact_store.store_file(Path(trees, "new", "data"), digests, store)
+            for i in store.joinpath("files").iterdir():
+                os.utime(i, (999, 999))
+
+            # Entries that are being filled are left alone
+            with artifact_store.locked("trees-locked", store):
+                artifact_store.evict_artifact_store(
+                    2500,
+                    keep=[Path(trees, "kept", "data")],
+                    temp_dir=temp,
+                    store_dir=store,
+                )
+            self.assertEqual(list(store.joinpath("files").iterdir()), [])
+            self.assertEqual(
+                sorted(i.name for i in trees.iterdir()),
+                [
+                    "kept",
+                    "kept.complete",
+                    "locked",
+                    "locked.complete",
+                    "new",
+                    "new.complete",
+                ],
+            )
+
+            artifact_store.evict_artifact_store(1500, temp_dir=temp, store_dir=store)
+            self.assertEqual(
+                sorted(i.name for i in trees.iterdir()), ["new", "new.complete"]
+            )
+            self.assertEqual(
+                sorted(i.name for i in temp.iterdir()), ["artifacts", "source"]
+            )
+
+    def test_eviction_skips_mirrors_in_use(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            temp, store = Path(tmpdir, "temp"), Path(tmpdir, "temp", "artifacts")
+            mirrors = temp.joinpath("git-mirrors")
+            for name in ["used", "used.0123abcd.tmp", "unused"]:
+                Path(mirrors, name).mkdir(parents=True)
+                Path(mirrors, name, "HEAD").write_bytes(b"x" * 1000)
+
+            # A mirror is used, or created, under the same lock as `_mirror_repo` takes
+            with artifact_store.locked("mirror-used", store):
+                artifact_store.evict_artifact_store(0, temp_dir=temp, store_dir=store)
+            self.assertEqual(
+                sorted(i.name for i in mirrors.iterdir()),
+                ["used", "used.0123abcd.tmp"],
+            )
+
+            artifact_store.evict_artifact_store(0, temp_dir=temp, store_dir=store)
+            self.assertEqual(list(mirrors.iterdir()), [])
+
+    def test_eviction_interval(self):
+        project = locate.this_dir().joinpath("uncompiled-project", "TemplateGen")
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.object(
+            zebra_config, "zebra_temp_dir", Path(tmpdir)
+        ), mock.patch.object(
+            zebra_config, "evict_artifact_store"
+        ) as evict, mock.patch.object(
+            zebra_config, "evict_token_cache"
+        ):
+            config = Config(Source(path_source=project))
+            for _ in range(3):
+                config.run(Path(tmpdir, "output"))
+            self.assertEqual(evict.call_count, 1)
+
+            # Once the interval has passed
+            stamp = Path(tmpdir, "last-eviction")
+            os.utime(stamp, (stamp.stat().st_mtime - 2 * 60 * 60,) * 2)
+            config.run(Path(tmpdir, "output"))
+            self.assertEqual(evict.call_count, 2)
+
+    def test_linked_staging(self):
+        def mid_process(source):
+            # Hooks may edit the files in place, both those staged from the source and the transformed ones
+            for directory in [source.temp_downloads, source.temp_transformed]:
+                with open(directory.joinpath("A.frm"), "r+b") as f:
+                    f.write(b"B")
+            staged.append(source.temp_downloads.joinpath("A.frm"))
+
+        staged = []
+        # Without reflinks, files are copied rather than hard linked
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.object(
+            artifact_store, "_reflink", return_value=False
+        ):
+            src = Path(tmpdir, "src")
+            src.mkdir()
+            src.joinpath("A.frm").write_bytes(b"A form")
+            src.joinpath("Mod.bas").write_bytes(b'Attribute VB_Name = "Mod"\r\n')
+
+            for _ in range(2):
+                Config(
+                    Source(path_source=src, glob_include="*", mid_process=mid_process)
+                ).run(Path(tmpdir, "output"), incremental=True)
+
+            # Nothing shares the data of the user's files
+            self.assertFalse(os.path.samefile(staged[0], src.joinpath("A.frm")))
+            self.assertFalse(artifact_store.is_linked(src.joinpath("A.frm")))
+            self.assertEqual(src.joinpath("A.frm").read_bytes(), b"A form")
+            self.assertEqual(Path(tmpdir, "output", "A.frm").read_bytes(), b"B form")
+
+            # A written file gets data of its own
+            tree = VirtualTree.from_dir(src)
+            tree.write_to(Path(tmpdir, "linked"), hard_link=True)
+            self.assertTrue(
+                os.path.samefile(Path(tmpdir, "linked", "A.frm"), src.joinpath("A.frm"))
+            )
+            tree.write_text("A.frm", "changed")
+            tree.write_to(Path(tmpdir, "linked"), hard_link=True)
+            self.assertEqual(Path(tmpdir, "linked", "A.frm").read_text(), "changed")
+            self.assertEqual(src.joinpath("A.frm").read_bytes(), b"A form")
+
+
+class TestGitBackend(unittest.TestCase):
+    def test_same_as_git_rev_parse(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            work = Path(tmpdir, "work")
+            c1, c2, c3 = make_git_repo(work, [{"A.bas": "1"}, {"A.bas": "2"}, {}])
+            git("tag", "light", c1, cwd=work)
+            git("tag", "--annotate", "-m", "tag", "annotated", c2, cwd=work)
+            git("branch", "side", c2, cwd=work)
+            bare = Path(tmpdir, "bare.git")
+            git("clone", "--quiet", "--bare", str(work), str(bare))
+
+            revisions = ["main", "side", "light", "annotated", "HEAD", "HEAD~1"]
+            revisions += [c1, c2[:7], c3[:12].upper(), "nope", "0000000", c2 + ":A.bas"]
+            with GitRepo(bare) as repo:
+                expected = []
+                for i in revisions:
+                    try:
+                        expected.append(
+                            git("rev-parse", "--verify", f"{i}^{{commit}}", cwd=bare)
+                        )
+                    except subprocess.CalledProcessError:
+                        expected.append(None)
+                self.assertEqual(repo.resolve(*revisions), expected)
+                self.assertEqual(repo.resolve(*revisions), expected)
+
+                show_ref = dict(
+                    reversed(i.split())
+                    for i in git("show-ref", "-d", cwd=bare).split("\n")
+                )
+                self.assertEqual(
+                    repo.refs(),
+                    {
+                        i: show_ref.get(i + "^{}", j)
+                        for i, j in show_ref.items()
+                        if not i.endswith("^{}")
+                    },
+                )
+
+                worktree = Path(tmpdir, "worktree")
+                repo.run("worktree", "add", "--detach", str(worktree), "side")
+                self.assertEqual(read_worktree(worktree), (bare.resolve(), c2))
+                self.assertIsNone(read_worktree(work))
+
+    def test_few_git_processes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            remote = Path(tmpdir, "remote")
+            (c1,) = make_git_repo(remote, [{"A.bas": "1"}])
+            mirrors, dest = Path(tmpdir, "mirrors"), Path(tmpdir, "dest")
+            downloader.git_download(remote.as_uri(), dest, c1, mirror_dir=mirrors)
+
+            with mock.patch.object(
+                subprocess, "Popen", wraps=subprocess.Popen
+            ) as popen:
+                downloader.git_download(remote.as_uri(), dest, c1, mirror_dir=mirrors)
+                # The commit is already in the mirror, so git only touches the worktree (`reset --hard` and
+                # `clean`), and a rev-parse or two more wouldn't matter
+                commands = [" ".join(map(str, i.args[0])) for i in popen.call_args_list]
+                self.assertLessEqual(len(commands), 4)
+                for i in ["fetch", "clone", "ls-remote"]:
+                    self.assertFalse([j for j in commands if f" {i}" in j], i)
+            self.assertEqual(Path(dest, "A.bas").read_text(), "1")
+
+
+class TestSource(unittest.TestCase):
+    def test_cheap_construction(self):
+        def make():
+            return Source(path_source=uid)
+
+        uid = f"missing-{os.getpid()}-{id(self)}"
+        first, second = make(), make()
+        other = Source(path_source=uid)
+
+        # Identified by the line of code that made it, and nothing is written yet
+        self.assertEqual(first.caller_id, second.caller_id)
+        self.assertNotEqual(first.caller_id, other.caller_id)
+        self.assertEqual(first.caller_path, Path(__file__).resolve())
+        self.assertFalse(first.temp_downloads.exists())
+        self.assertFalse(first._temp_transformed.exists())
+
+
+class TestImport(unittest.TestCase):
+    def test_light_import(self):
+        # E.g. pre-commit hooks that only tokenize or fix casing import the package many times
+        code = dedent(
+            """
+            import shutil, sys
+            from zebra_vba_packager import fix_casing, tokenize
+            heavy = ["download", "py7zr", "sortedcontainers", "pathvalidate", "deprecation", "locate"]
+            print("7zip" in dict(shutil.get_archive_formats()), *(i for i in heavy if i in sys.modules))
+            """
+        )
+        output = subprocess.check_output(
+            [sys.executable, "-c", code], cwd=locate.this_dir().parent
+        ).split()
+
+        # How long the import takes is measured by benchmark.py
+        self.assertEqual(output, [b"True"])
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_all_stages_run(self):
+        with locate.prepend_sys_path("."):
+            import benchmark
+
+        results = benchmark.run_benchmarks(repeat=1, scale=0.02)
+        self.assertEqual(list(results["results"]), list(benchmark.corpora))
+        for corpus in results["results"].values():
+            self.assertGreater(corpus["files"], 0)
+            self.assertEqual(
+                set(corpus["stages"]),
+                {
+                    "tokenize",
+                    "tokenize_list",
+                    "match_tokens",
+                    "code_sections",
+                    "renaming",
+                    "combining",
+                    "namespacing",
+                    "config_run",
+                },
+            )
+
+        self.assertGreater(results["import"]["min"], 0)
+
+        # Results of different runs can be compared
+        old = json.loads(json.dumps(results))
+        self.assertIn("config_run", benchmark.compare(results, old))
+        self.assertIn("import", benchmark.compare(results, old))
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_stages_of_run(self):
+        project = locate.this_dir().joinpath("uncompiled-project", "TemplateGen")
+        for workers in [None, 2]:
+            recorder = SpanRecorder()
+            with tempfile.TemporaryDirectory() as tmpdir:
+                Config(
+                    Source(path_source=project, combine_bas_files=True),
+                    Source(path_source=project, glob_include="**/*.bas"),
+                ).run(tmpdir, workers=workers, observers=[recorder])
+
+            stages = {}
+            for i in recorder.spans:
+                stages.setdefault(i.name, []).append(i)
+
+            for i in ["run", "prepare", "glob", "transform", "rename", "combine"]:
+                self.assertIn(i, stages)
+            self.assertEqual(len(stages["prepare"]), 2)
+            self.assertEqual(len(stages["transform"]), 2)
+            self.assertEqual({i.source for i in stages["rename"]}, {str(project)})
+            self.assertGreater(sum(i.tokens for i in stages["rename"]), 0)
+            self.assertGreater(sum(i.bytes_read for i in stages["rename"]), 0)
+            self.assertGreater(stages["write_output"][0].bytes_written, 0)
+
+            self.assertIn("combine", recorder.summary())
+            self.assertIn(str(project), recorder.summary(by_source=True))
+            self.assertEqual(len(json.loads(recorder.to_json())), len(recorder.spans))
+            events = recorder.chrome_trace()["traceEvents"]
+            self.assertEqual({i["name"] for i in events}, set(stages))
+            self.assertTrue(all(i["ph"] == "X" and i["dur"] >= 0 for i in events))
+
 
 class TestFullRun(unittest.TestCase):
     def test_github_download_and_combine(self):
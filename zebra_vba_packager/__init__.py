@@ -1,13 +1,58 @@
-from .py7z import unpack, pack
-from .zebra_config import Config, Source
-from .vba_tokenizer import tokenize
-from .vba_renaming import write_tokens, strip_bas_header
-from .excel_compilation import (
-    decompile_xl,
-    compile_xl,
-    runmacro_xl,
-    saveas_xlsx,
-    is_locked,
-)
-from .util import backup_last_50_paths
-from .fix_casing import fix_casing
+from importlib import import_module
+from typing import TYPE_CHECKING
+
+from .extraction import register_7z_formats
+
+# The public names are imported from their module when first used (PEP 562), so that e.g. `tokenize` doesn't pull
+# in the dependencies of downloading and packaging.
+_lazy_names = {
+    "unpack": ".py7z",
+    "pack": ".py7z",
+    "Config": ".zebra_config",
+    "Source": ".zebra_config",
+    "tokenize": ".vba_tokenizer",
+    "iter_tokenize": ".vba_tokenizer",
+    "write_tokens": ".vba_renaming",
+    "strip_bas_header": ".vba_renaming",
+    "decompile_xl": ".excel_compilation",
+    "compile_xl": ".excel_compilation",
+    "runmacro_xl": ".excel_compilation",
+    "saveas_xlsx": ".excel_compilation",
+    "is_locked": ".excel_compilation",
+    "backup_last_50_paths": ".util",
+    "fix_casing": ".fix_casing",
+}
+
+__all__ = list(_lazy_names)
+
+if TYPE_CHECKING:
+    from .py7z import unpack, pack
+    from .zebra_config import Config, Source
+    from .vba_tokenizer import tokenize, iter_tokenize
+    from .vba_renaming import write_tokens, strip_bas_header
+    from .excel_compilation import (
+        decompile_xl,
+        compile_xl,
+        runmacro_xl,
+        saveas_xlsx,
+        is_locked,
+    )
+    from .util import backup_last_50_paths
+    from .fix_casing import fix_casing
+
+
+def __getattr__(name):
+    if name not in _lazy_names:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(import_module(_lazy_names[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+# Lets shutil make and unpack .7z archives; py7zr is only imported once it does
+register_7z_formats()
@@ -0,0 +1,386 @@
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Tuple, Union
+
+from . import util
+
+zebra_temp_dir = Path(tempfile.gettempdir(), "zebra-vba-packager")
+artifact_store_dir = zebra_temp_dir.joinpath("artifacts")
+artifact_store_max_bytes = 2 * 1024 * 1024 * 1024
+# `Config.run` evicts at most once per this many seconds, since that walks the whole store
+artifact_store_eviction_interval = 60 * 60
+
+# Files that belong with an entry: markers, download state and unfinished temporary copies
+_sidecar_re = re.compile(r"^(.*?)(\.complete|\.json|\.part|\.[0-9a-f]{8}\.tmp)$")
+
+
+def _entry_name(name: str) -> str:
+    return m[1] if (m := _sidecar_re.match(name)) else name
+
+
+def _store(store_dir) -> Path:
+    return Path(artifact_store_dir if store_dir is None else store_dir)
+
+
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_lock = threading.Lock()
+
+
+@contextmanager
+def locked(name: str, store_dir=None, blocking: bool = True):
+    """
+    Hold the lock named `name` of the store, against other threads and other processes, e.g. while filling an
+    entry; yields whether the lock is held, which with `blocking=False` is only the case if it was free. Lock files
+    are kept in the "locks" directory of the store and never removed, so that every process locks the same file.
+    """
+    locks = _store(store_dir).joinpath("locks")
+    os.makedirs(locks, exist_ok=True)
+    path = os.path.abspath(locks.joinpath(f"{name}.lock"))
+
+    # A file lock doesn't keep out other threads of the same process on every platform
+    with _thread_locks_lock:
+        thread_lock = _thread_locks.setdefault(path, threading.Lock())
+    if not thread_lock.acquire(blocking):
+        yield False
+        return
+
+    try:
+        with open(path, "a+b") as f:
+            if _lock_file(f, blocking):
+                try:
+                    yield True
+                finally:
+                    _unlock_file(f)
+            else:
+                yield False
+    finally:
+        thread_lock.release()
+
+
+def _lock_file(f, blocking: bool) -> bool:
+    if sys.platform == "win32":
+        import msvcrt
+
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.05)
+
+    import fcntl
+
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _unlock_file(f):
+    if sys.platform == "win32":
+        import msvcrt
+
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _reflink(src, dst) -> bool:
+    # Copy-on-write clone (btrfs, xfs, ...), which shares the data like a hard link but can't change the original
+    if not sys.platform.startswith("linux"):
+        return False
+
+    import fcntl
+
+    ficlone = 0x40049409
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), ficlone, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return True
+    except OSError:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        return False
+
+
+def link_file(src: Union[str, Path], dst: Union[str, Path], hard_link: bool = False):
+    """
+    Put a copy of `src` at `dst` that costs no extra disk space where possible: a reflink, else a plain copy.
+    Either can be edited without changing `src`. With `hard_link=True` a hard link is tried before copying, which
+    is only safe for files that nobody changes in place, e.g. those the packager keeps in its own directories;
+    never for files that hooks, other tools or the user can see.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if _reflink(src, dst):
+        return
+
+    if hard_link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            # Other drive, or a file system without hard links
+            pass
+
+    shutil.copy2(src, dst)
+
+
+def is_linked(path: Union[str, Path]) -> bool:
+    """
+    Whether the file at `path` shares its data with another path through a hard link, so that writing to it would
+    change both.
+    """
+    try:
+        return os.stat(path).st_nlink > 1
+    except OSError:
+        return False
+
+
+def link_tree(src: Union[str, Path], dst: Union[str, Path], hard_link: bool = False):
+    """
+    Replace the directory `dst` by a linked copy of the directory `src` (see `link_file`).
+    """
+    src, dst = Path(src), Path(dst)
+    util.rmtree(dst, ignore_errors=True)
+    os.makedirs(dst, exist_ok=True)
+
+    # Like `shutil.copytree`, the content of linked directories is copied
+    for root, dirs, files in os.walk(src, followlinks=True):
+        target = dst.joinpath(os.path.relpath(root, src))
+        for i in dirs:
+            os.makedirs(target.joinpath(i), exist_ok=True)
+        for i in files:
+            link_file(os.path.join(root, i), target.joinpath(i), hard_link)
+
+
+def _touch(path: Path):
+    # Mark as recently used for `evict_artifact_store`
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def stored_file(
+    digests: Dict[str, str], store_dir=None
+) -> Optional[Tuple[Path, Dict[str, str]]]:
+    """
+    `(location, digests)` of the stored file with any of the given digests (e.g. `{"md5": ..., "sha256": ...}`),
+    or None if there is no such file.
+    """
+    files = _store(store_dir).joinpath("files")
+    for name, digest in digests.items():
+        if not digest:
+            continue
+        try:
+            if name == "sha256":
+                path = files.joinpath(f"sha256-{digest.lower()}")
+            else:
+                path = files.joinpath(
+                    files.joinpath(f"{name}-{digest.lower()}").read_text().strip()
+                )
+            stored_digests = json.loads(
+                path.with_name(f"{path.name}.json").read_text(encoding="utf-8")
+            )
+        except (OSError, ValueError):
+            continue
+
+        if path.is_file():
+            _touch(path)
+            return path, stored_digests
+
+    return None
+
+
+def store_file(path: Union[str, Path], digests: Dict[str, str], store_dir=None) -> Path:
+    """
+    Add the file at `path` with the given digests (which must include its sha256) to the store if it isn't there
+    yet, and return its location in the store. The file is stored under its sha256, and can be found by any of its
+    digests with `stored_file`.
+    """
+    digests = {i: j.lower() for i, j in digests.items()}
+    files = _store(store_dir).joinpath("files")
+    stored = files.joinpath(f"sha256-{digests['sha256']}")
+    if stored_file({"sha256": digests["sha256"]}, store_dir) is not None:
+        return stored
+
+    with locked(f"files-{stored.name}", store_dir):
+        # Unless another thread or process stored it in the meantime; a stored file is never replaced
+        if stored_file({"sha256": digests["sha256"]}, store_dir) is not None:
+            return stored
+
+        os.makedirs(files, exist_ok=True)
+        tmp = files.joinpath(f"{stored.name}.{uuid.uuid4().hex[:8]}.tmp")
+        link_file(path, tmp, hard_link=True)
+        os.replace(tmp, stored)
+
+        for name, digest in digests.items():
+            if name != "sha256":
+                files.joinpath(f"{name}-{digest}").write_text(stored.name)
+
+        # The file counts as stored once this exists
+        _write_json(stored.with_name(f"{stored.name}.json"), digests)
+
+    return stored
+
+
+def _write_json(path: Path, data):
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    tmp.write_text(json.dumps(data, indent=1), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def stored_tree(key: str, populate: Callable[[Path], None], store_dir=None) -> Path:
+    """
+    The directory stored under `key`, which is made by `populate(directory)` the first time it is needed. `key`
+    must identify the content, e.g. the hash of the archive it was extracted from.
+    """
+    trees = _store(store_dir).joinpath("trees")
+    path, marker = trees.joinpath(key), trees.joinpath(f"{key}.complete")
+    if marker.is_file() and path.is_dir():
+        _touch(marker)
+        return path
+
+    # Sources that need the same tree at the same time wait for the first one to make it
+    with locked(f"trees-{key}", store_dir):
+        if marker.is_file():
+            if path.is_dir():
+                _touch(marker)
+                return path
+            # The tree was removed but its marker wasn't
+            marker.unlink()
+
+        tmp = trees.joinpath(f"{key}.{uuid.uuid4().hex[:8]}.tmp")
+        os.makedirs(tmp)
+        try:
+            populate(tmp)
+            # A tree is published once its marker exists, and is never replaced after that
+            if not marker.is_file():
+                # Left over from a process that stopped before writing the marker
+                util.rmtree(path, ignore_errors=True)
+                os.replace(tmp, path)
+                marker.touch()
+        finally:
+            util.rmtree(tmp, ignore_errors=True)
+
+    return path
+
+
+def _disk_usage(path: Path, seen: set) -> int:
+    # Hard linked files are counted once, for the first entry they are found in
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return 0
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        if (stat.st_dev, stat.st_ino) in seen:
+            return 0
+        seen.add((stat.st_dev, stat.st_ino))
+        return stat.st_size
+
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(_disk_usage(Path(root, i), seen) for i in files)
+    return total
+
+
+def evict_artifact_store(
+    max_bytes: Union[int, None] = None,
+    keep: Iterable[Union[str, Path]] = (),
+    temp_dir: Union[str, Path, None] = None,
+    store_dir=None,
+):
+    """
+    Remove the least recently used entries from the store and the git mirrors under %temp%/zebra-vba-packager,
+    until they take at most `max_bytes`. Only entries the packager owns are removed: not the working directories
+    or outputs of sources, nor entries that are being filled (see `locked`) or that contain or are inside a path in
+    `keep`.
+    """
+    max_bytes = artifact_store_max_bytes if max_bytes is None else max_bytes
+    temp_dir = Path(zebra_temp_dir if temp_dir is None else temp_dir)
+    store_dir = _store(store_dir)
+    keep = {os.path.abspath(i) for i in keep}
+
+    # Container -> prefix of the lock names of its entries, which are taken while they are filled or used
+    containers = {
+        store_dir.joinpath("files"): "files-",
+        store_dir.joinpath("trees"): "trees-",
+        store_dir.joinpath("downloads"): "downloads-",
+        temp_dir.joinpath("git-mirrors"): "mirror-",
+    }
+
+    # Entries with their sidecar files, stored files with the files that point to them
+    groups = {}
+    seen = set()
+    for container in containers:
+        try:
+            with os.scandir(container) as it:
+                scanned = list(it)
+        except OSError:
+            continue
+
+        for entry in scanned:
+            stat = entry.stat(follow_symlinks=False)
+            name = _entry_name(entry.name)
+            if container.name == "files" and not name.startswith("sha256-"):
+                # Other digests point to the file stored under its sha256
+                try:
+                    name = Path(entry.path).read_text().strip()
+                except (OSError, ValueError):
+                    pass
+            key = (container, name)
+
+            group = groups.setdefault(key, [0, 0, []])
+            group[0] = max(group[0], stat.st_mtime)
+            group[1] += _disk_usage(Path(entry.path), seen)
+            group[2].append(entry.path)
+
+    total = sum(size for _, size, _ in groups.values())
+    for (container, name), (_, size, paths) in sorted(
+        groups.items(), key=lambda x: x[1][0]
+    ):
+        if total <= max_bytes:
+            break
+        if any(
+            j == i or j.startswith(i + os.sep) or i.startswith(j + os.sep)
+            for i in map(os.path.abspath, paths)
+            for j in keep
+        ):
+            continue
+
+        with locked(
+            f"{containers[container]}{name}", store_dir, blocking=False
+        ) as free:
+            if not free:
+                continue
+            for i in paths:
+                if os.path.isdir(i) and not os.path.islink(i):
+                    util.rmtree(i, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(i)
+                    except OSError:
+                        pass
+        total -= size
@@ -1,19 +1,26 @@
-from copy import deepcopy
 from dataclasses import dataclass
 from itertools import chain
 from pathlib import Path
 from contextlib import suppress
 from textwrap import indent
 from types import SimpleNamespace as SN
-from typing import Dict, Union, List
-from functools import reduce
-import operator
-from sortedcontainers import SortedDict
+from typing import TYPE_CHECKING, Dict, Union, List
 
 from .match_tokens import match_tokens
+from .token_cache import cached_tokenize_stream
 from .vba_renaming import vba_module_name
 from .util import first, to_unix_line_endings
-from .vba_tokenizer import VBAToken, tokenize, tokens_to_str
+from .vba_tokenizer import (
+    VBAToken,
+    TokenStream,
+    tokenize,
+    tokenize_stream,
+    token_texts,
+    token_type_names,
+)
+
+if TYPE_CHECKING:
+    from sortedcontainers import SortedDict
 
 
 @dataclass
@@ -64,25 +71,25 @@ def get_private_renames(tokens: List[VBAToken]):
     ]
 
 
-def find_section(tokens, start_match_string, end_match_string):
-    i, j = next(match_tokens(tokens, start_match_string, on_line_start=True))
-    k, l = [
-        _ + j
-        for _ in next(match_tokens(tokens[j:], end_match_string, on_line_start=True))
-    ]
+def find_section(tokens, start_match_string, end_match_string, start: int = 0):
+    i, j = next(
+        match_tokens(tokens, start_match_string, on_line_start=True, start=start)
+    )
+    k, l = next(match_tokens(tokens, end_match_string, on_line_start=True, start=j))
     return i, l
 
 
 def find_all_hashif_sections(tokens):
     in_ = 0
     sections = []
+    types, texts = token_type_names(tokens), token_texts(tokens)
     for i in range(len(tokens)):
-        if tokens[i].type == "#if":
-            if tokens[i].text.lower() == "#if":
+        if types[i] == "#if":
+            if texts[i].lower() == "#if":
                 if in_ == 0:
                     sections.append([i, None])
                 in_ += 1
-            elif "#end" in tokens[i].text.lower():
+            elif "#end" in texts[i].lower():
                 if in_ == 1:
                     sections[-1][-1] = i + 1
                 in_ -= 1
@@ -99,13 +106,13 @@ def find_all_function_sections(tokens):
     while True:
         try:
             pre = "[private|public] property|sub|function|enum"
-            i, j = find_section(tokens[start:], pre, r"end property|sub|function|enum")
-            sections[(start + i, start + j)] = (
+            i, j = find_section(tokens, pre, r"end property|sub|function|enum", start)
+            sections[(i, j)] = (
                 "function"
-                if (type_ := tokens[start + j - 1].text.lower()) in ("sub", "property")
+                if (type_ := tokens[j - 1].text.lower()) in ("sub", "property")
                 else type_
             )
-            start += j
+            start = j
         except StopIteration:
             break
 
@@ -120,7 +127,7 @@ def find_all_declaration_sections(tokens):
         on_line_start=True,
     ):
         try:
-            j = i0 + next(match_tokens(tokens[i0:], r"\n"))[1]
+            j = next(match_tokens(tokens, r"\n", start=i0))[1]
         except StopIteration:
             j = len(tokens)
 
@@ -143,46 +150,41 @@ def find_all_global_var_sections(tokens):
     return sections
 
 
-def compile_code_into_sections(
-    input: Union[List[VBAToken], str], origin: Union[str, None] = None
-) -> List[VBASectionClassifier]:
-    r"""
-    Split VBA code into a few high-level catagories, such as `#if`, `function`, `option`, `declare`, and
-    `unknown`. Extend `unknown` into more catagories as they are needed by other parts of the codebase.
+def find_all_code_sections(tokens: Union[List[VBAToken], TokenStream]) -> "SortedDict":
     """
-    tokens = input
-    if not isinstance(tokens, list):
-        tokens = tokenize(input)
+    Token index ranges `(start, end)` of the sections of `compile_code_into_sections`, mapped to their type. The
+    ranges follow each other from the start of the first section up to the end of the tokens.
+    """
+    from sortedcontainers import SortedDict
 
-    mixed = SortedDict()
+    # The finders scan the token texts and types many times, which a stream keeps cached
+    stream = (
+        tokens if isinstance(tokens, TokenStream) else TokenStream.from_tokens(tokens)
+    )
+
+    found = {}
     for f in [
         find_all_hashif_sections,
         find_all_function_sections,
         find_all_declaration_sections,
         find_all_global_var_sections,
     ]:
-        mixed.update(f(tokens))
-
-    keys = list(mixed.keys())
-    keys_sets = [set(range(key[0], key[1])) for key in keys]
-
-    # merge overlapping sections
-    i = 0
-    while i < len(keys) - 1:
-        if keys_sets[i].intersection(keys_sets[i + 1]):
-            key_new = (keys[i][0], max(keys[i][1], keys[i + 1][1]))
-
-            mixed[key_new] = mixed.pop(keys[i])
-            mixed.pop(keys[i + 1])
+        found.update(f(stream))
 
-            keys_sets[i] = set(range(*key_new))
-            keys_sets.pop(i + 1)
+    # Merge overlapping sections, in order of their start; an empty section overlaps nothing
+    mixed = SortedDict()
+    merged = None
+    for (i, j), type_ in sorted(found.items()):
+        if merged is not None and merged[0] < merged[1] and i < j and i < merged[1]:
+            merged[1] = max(merged[1], j)
+            continue
 
-            keys[i] = key_new
-            keys.pop(i + 1)
+        if merged is not None:
+            mixed[tuple(merged[:2])] = merged[2]
+        merged = [i, j, type_]
 
-            continue
-        i += 1
+    if merged is not None:
+        mixed[tuple(merged[:2])] = merged[2]
 
     # Fill empty gaps
     for (_, i), (j, _) in zip(
@@ -191,6 +193,20 @@ def compile_code_into_sections(
         if i != j:
             mixed[i, j] = "unknown"
 
+    return mixed
+
+
+def compile_code_into_sections(
+    input: Union[List[VBAToken], TokenStream, str], origin: Union[str, None] = None
+) -> List[VBASectionClassifier]:
+    r"""
+    Split VBA code into a few high-level catagories, such as `#if`, `function`, `option`, `declare`, and
+    `unknown`. Extend `unknown` into more catagories as they are needed by other parts of the codebase.
+    """
+    tokens = input
+    if not isinstance(tokens, (list, TokenStream)):
+        tokens = tokenize_stream(input)
+
     return [
         VBASectionClassifier(
             tokens=(t := tokens[idxes[0] : idxes[1]]),
@@ -199,16 +215,19 @@ def compile_code_into_sections(
             private=type != "unknown"
             and "private" in (_.text.lower().strip() for _ in t[:2]),
         )
-        for idxes, type_ in mixed.items()
+        for idxes, type_ in find_all_code_sections(tokens).items()
     ]
 
 
 def compile_bas_sources_into_single_file(
-    sources: Dict[Union[str, Path], Union[str, Path, List[VBAToken]]],
+    sources: Dict[Union[str, Path], Union[str, Path, List[VBAToken], TokenStream]],
     module_name: Union[str, None] = None,
 ) -> str:
+    # Private names are renamed in the `overrides` of a stream per source, leaving the input as is
     sources = {
-        key: deepcopy(val) if isinstance(val, list) else tokenize(val)
+        key: TokenStream.from_tokens(val)
+        if isinstance(val, (list, TokenStream))
+        else cached_tokenize_stream(val)
         for key, val in sources.items()
     }
     names = {key: vba_module_name(tokens) for key, tokens in sources.items()}
@@ -217,39 +236,42 @@ def compile_bas_sources_into_single_file(
     for key, tokens in sources.items():
         privates = {i.lower(): f"{names[key]}_{i}" for i in get_private_renames(tokens)}
 
-        for t in tokens:
-            if t.type == "name" and t.text.lower() in privates:
-                t.text = privates[t.text.lower()]
+        for i, (type_, text) in enumerate(
+            zip(token_type_names(tokens), token_texts(tokens))
+        ):
+            if type_ == "name" and text.lower() in privates:
+                tokens.set_text(i, privates[text.lower()])
 
-    classifiers_sources = {}
-    for key, val in sources.items():
-        classifiers_sources[key] = []
-        for c in compile_code_into_sections(val, origin=key):
-            classifiers_sources[key].append(c)
+    # Sections of every source as `[type, start, end]` token index ranges
+    sections = {
+        key: [[type_, i, j] for (i, j), type_ in find_all_code_sections(tokens).items()]
+        for key, tokens in sources.items()
+    }
 
     # Get the first entry in #if statement and rather use that as an proxy classification for the whole block
-    for classifiers in classifiers_sources.values():
-        for c in classifiers:
-            if c.type == "#if":
-                for i in compile_code_into_sections(c.tokens[3:]):
-                    if i.type != "unknown":
-                        c.type = i.type
+    for key, tokens in sources.items():
+        for c in sections[key]:
+            if c[0] == "#if":
+                for type_ in find_all_code_sections(tokens[c[1] + 3 : c[2]]).values():
+                    if type_ != "unknown":
+                        c[0] = type_
                         break
 
     # Sanity check to see if all sources have the same `declare` statements:
     option_statements = {i: [] for i in sources}
 
-    for classifiers in classifiers_sources.values():
-        for c in classifiers:
-            if c.type == "option":
+    for key, tokens in sources.items():
+        types, texts = token_type_names(tokens), token_texts(tokens)
+        for type_, i, j in sections[key]:
+            if type_ == "option":
                 normcode = " ".join(
                     [
-                        i.text.lower().strip()
-                        for i in c.tokens
-                        if not i.type in ("space", "comment")
+                        texts[k].lower().strip()
+                        for k in range(i, j)
+                        if not types[k] in ("space", "comment")
                     ]
                 )
-                option_statements[c.origin].append(normcode)
+                option_statements[key].append(normcode)
 
     for key in option_statements:
         option_statements[key] = sorted(option_statements[key])
@@ -271,21 +293,6 @@ def compile_bas_sources_into_single_file(
                     f"Options must be equal across aggregated bas files, got conflict:\n{lhs}\n{rhs}"
                 )
 
-    # Merge classifiers with `unknown` at their top
-    for classifiers in classifiers_sources.values():
-        idx = -1
-        while (idx := idx + 1) < len(classifiers):
-            if classifiers[idx].type == "unknown":
-                for j in range(idx + 1, len(classifiers)):
-                    classifiers[idx + 1].tokens = (
-                        classifiers[idx].tokens + classifiers[idx + 1].tokens
-                    )
-                    classifiers.pop(idx)
-                    if classifiers[idx].type != "unknown":
-                        break
-
-    classifiers = reduce(operator.concat, classifiers_sources.values())  # noqa
-
     buckets = {
         "attribute": [],
         "option": [],
@@ -295,30 +302,43 @@ def compile_bas_sources_into_single_file(
         "function": [],
     }
 
-    for c in classifiers:
-        # Only use one of the file's declare statements
-        if c.type == "option":
-            if c.origin == first(classifiers_sources):
-                buckets[c.type].append(c)
-        elif c.type in buckets:
-            buckets[c.type].append(c)
-        else:
-            buckets["other"].append(c)
+    for key, source_sections in sections.items():
+        # Merge `unknown` sections into the start of the section that follows them
+        start = None
+        for type_, i, j in source_sections:
+            if start is None:
+                start = i
+            if type_ == "unknown":
+                continue
+
+            # Only use one of the file's declare statements
+            if type_ == "option":
+                if key == first(sources):
+                    buckets[type_].append((key, type_, start, j))
+            elif type_ in buckets:
+                buckets[type_].append((key, type_, start, j))
+            else:
+                buckets["other"].append((key, type_, start, j))
+            start = None
+
+        if start is not None:
+            buckets["other"].append((key, "unknown", start, len(sources[key])))
 
     code = []
     origin = None
-    for key, vals in buckets.items():
-        if key == "attribute":
+    for bucket, vals in buckets.items():
+        if bucket == "attribute":
             continue
 
-        for i in vals:
-            block_str = to_unix_line_endings(tokens_to_str(i.tokens)).strip()
+        for key, type_, i, j in vals:
+            texts = token_texts(sources[key])
+            block_str = to_unix_line_endings("".join(texts[i:j])).strip()
             if block_str != "":
                 block_str = block_str + "\n\n"
-                if i.type != "option":
-                    if i.origin != origin:
-                        code.append(f"'*************** {names[i.origin]}\n")
-                        origin = i.origin
+                if type_ != "option":
+                    if key != origin:
+                        code.append(f"'*************** {names[key]}\n")
+                        origin = key
 
                 code.append(block_str)
 
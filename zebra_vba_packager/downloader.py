@@ -1,11 +1,29 @@
+import hashlib
+import http.client
+import json
+import re
 import subprocess
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+import uuid
 from contextlib import suppress
 from pathlib import Path
 import shutil
 import os
 from contextlib import contextmanager
-import download
-from . import util
+from typing import Dict, Tuple, Union
+from pathvalidate import sanitize_filename
+from . import artifact_store, util
+from .git_backend import GitRepo, read_worktree
+
+git_mirror_dir = Path(tempfile.gettempdir(), "zebra-vba-packager", "git-mirrors")
+
+re_commit = re.compile(r"^[0-9a-f]{7,40}$", re.IGNORECASE)
+
+_mirror_repos = {}
+_mirror_repos_lock = threading.Lock()
 
 
 @contextmanager
@@ -47,79 +65,377 @@ def sh_quiet(command):
     )
 
 
-def git_download(git_source, dest, revision=None):
-    os.makedirs(dest, exist_ok=True)
+def git_mirror_path(git_source, mirror_dir: Union[str, Path, None] = None) -> Path:
+    """
+    Location of the bare mirror of `git_source`, which is shared by all checkouts of that repository.
+    """
+    name = sanitize_filename(
+        str(git_source).replace("\\", "/").rstrip("/").split("/")[-1]
+    )
+    return Path(git_mirror_dir if mirror_dir is None else mirror_dir).joinpath(
+        f"{hashlib.md5(str(git_source).encode()).hexdigest()[:8]}-{name}"
+    )
+
+
+@contextmanager
+def _mirror_repo(mirror: Path, store_dir=None):
+    """
+    The `GitRepo` of a mirror, locked for the current thread and against other processes (with the lock
+    "mirror-<name>" of the artifact store, which `evict_artifact_store` also takes). Repos are kept for the whole
+    process, so that their `cat-file` process and resolved commits are reused by later downloads.
+    """
+    with _mirror_repos_lock:
+        if (entry := _mirror_repos.get(str(mirror))) is None:
+            entry = _mirror_repos[str(mirror)] = (GitRepo(mirror), threading.Lock())
+
+    repo, lock = entry
+    with lock, artifact_store.locked(f"mirror-{mirror.name}", store_dir):
+        yield repo
+
+
+def _git_mirror(repo: GitRepo, git_source):
+    """
+    Create an empty blobless (partial) mirror of `git_source`; objects are fetched into it as needed.
+    """
+    mirror = repo.path
+    if mirror.joinpath("HEAD").is_file():
+        util.dir_touch(mirror)
+        return
+
+    repo.close()
+    util.rmtree(mirror, ignore_errors=True)
+    tmp = mirror.with_name(f"{mirror.name}.{uuid.uuid4().hex[:8]}.tmp")
+    if sh_quiet([repo.git, "init", "--quiet", "--bare", str(tmp)]) != 0:
+        util.rmtree(tmp, ignore_errors=True)
+        raise RuntimeError(f"Could not create a git mirror of {git_source} in {tmp}")
+
+    # Written directly instead of spawning `git config` for every setting
+    url = str(git_source).replace("\\", "\\\\").replace('"', '\\"')
+    with tmp.joinpath("config").open("a", encoding="utf-8") as f:
+        f.write(
+            '[remote "origin"]\n'
+            f'\turl = "{url}"\n'
+            "\tfetch = +refs/heads/*:refs/heads/*\n"
+            "\tfetch = +refs/tags/*:refs/tags/*\n"
+            "\tpromisor = true\n"
+            "\tpartialclonefilter = blob:none\n"
+        )
+
+    os.makedirs(mirror.parent, exist_ok=True)
+    try:
+        os.replace(tmp, mirror)
+    except OSError:
+        # Made by a process that doesn't take the lock in the meantime
+        util.rmtree(tmp, ignore_errors=True)
+        if not mirror.joinpath("HEAD").is_file():
+            raise
+
+
+def _fetch_commit(repo: GitRepo, revision=None) -> Union[str, None]:
+    """
+    The commit of `revision` (default branch if None), fetching only what is missing from the mirror.
+    """
+    if revision is not None and re_commit.match(revision):
+        # A commit that is already in the mirror can't change, so don't touch the network
+        if (commit := repo.resolve(revision)[0]) is not None:
+            return commit
+
+        # A full commit id can be fetched on its own; it is kept under refs/pinned so that it isn't garbage collected
+        if len(revision) == 40:
+            repo.run(
+                "fetch",
+                "--quiet",
+                "--filter=blob:none",
+                "origin",
+                f"{revision}:refs/pinned/{revision}",
+            )
+            if (commit := repo.resolve(revision)[0]) is not None:
+                return commit
+
+    # Branches and tags are fetched every time, since they may have moved
+    repo.run("fetch", "--quiet", "--filter=blob:none", "--prune", "--force", "origin")
+    repo.refs_changed()
+
+    if revision is None:
+        with suppress(subprocess.CalledProcessError, IndexError):
+            head = repo.output("ls-remote", "--symref", "origin", "HEAD")[0]
+            if head.startswith("ref: "):
+                ref = head[len("ref: ") :].split()[0]
+                if repo.path.joinpath("HEAD").read_text().strip() != f"ref: {ref}":
+                    repo.run("symbolic-ref", "HEAD", ref)
+                    repo.refs_changed()
+
+    return repo.resolve("HEAD" if revision is None else revision)[0]
+
+
+def git_download(git_source, dest, revision=None, mirror_dir=None):
+    """
+    Check out `revision` (default branch if None) of `git_source` into `dest`. The repository is kept in a shared
+    bare mirror under `mirror_dir` (`git_mirror_dir` by default), and `dest` is a worktree of that mirror, so
+    repeated downloads only fetch what changed, or nothing at all for a commit that was fetched before.
+    """
+    dest = Path(dest).resolve()
+    mirror = git_mirror_path(git_source, mirror_dir).resolve()
+
+    with _mirror_repo(mirror) as repo:
+        _git_mirror(repo, git_source)
+
+        if (commit := _fetch_commit(repo, revision)) is None:
+            raise RuntimeError(f"Could not check out {revision}")
+
+        if (worktree := read_worktree(dest)) is not None and worktree[0] == mirror:
+            # Moves the detached HEAD as well
+            sh_quiet([repo.git, "-C", str(dest), "reset", "--quiet", "--hard", commit])
+            sh_quiet([repo.git, "-C", str(dest), "clean", "-qdfx"])
+        else:
+            # --force also reuses a worktree registration whose directory was deleted
+            util.rmtree(dest, ignore_errors=True)
+            repo.run("worktree", "add", "--force", "--detach", str(dest), commit)
+
+        if (worktree := read_worktree(dest)) is None or worktree[1] != commit:
+            raise RuntimeError(f"Could not check out {revision}")
+
+
+def git_export(
+    git_source,
+    revision=None,
+    glob_include="**/*",
+    glob_exclude=None,
+    mirror_dir=None,
+) -> Dict[str, bytes]:
+    """
+    Contents of the files of `revision` (default branch if None) of `git_source` that match the include/exclude
+    globs, keyed on their relative path, without checking anything out. Only the blobs of the matching files are
+    fetched into the (blobless) mirror. Contents are as committed: no line ending conversion or other
+    `.gitattributes` filters are applied.
+    """
+    mirror = git_mirror_path(git_source, mirror_dir).resolve()
+
+    with _mirror_repo(mirror) as repo:
+        _git_mirror(repo, git_source)
+
+        if (commit := _fetch_commit(repo, revision)) is None:
+            raise RuntimeError(f"Could not check out {revision}")
+
+        files = repo.ls_tree(commit)
+        paths = sorted(util.get_matching_paths(files, glob_include, glob_exclude))
+        object_ids = [files[i] for i in paths]
 
-    with working_directory(dest):
-        if Path(os.getcwd()).resolve() != Path(dest).resolve():
-            raise (RuntimeError(f"Could not create and enter {dest}"))
+        if missing := repo.missing_objects(commit).intersection(object_ids):
+            if repo.fetch_objects(sorted(missing)) != 0:
+                raise RuntimeError(f"Could not fetch the files of {revision}")
 
+        return dict(zip(paths, list(repo.read_blobs(object_ids))))
+
+
+def git_tree(git_source, revision=None, mirror_dir=None, store_dir=None) -> Path:
+    """
+    Directory with the files of `revision` (default branch if None) of `git_source`, kept in the artifact store
+    under the id of its git tree, so that every source that needs the same files shares one checkout.
+    """
+    mirror = git_mirror_path(git_source, mirror_dir).resolve()
+
+    with _mirror_repo(mirror, store_dir) as repo:
+        _git_mirror(repo, git_source)
+
+        if (commit := _fetch_commit(repo, revision)) is None:
+            raise RuntimeError(f"Could not check out {revision}")
+
+        def checkout(dest):
+            if missing := repo.missing_objects(commit):
+                if repo.fetch_objects(sorted(missing)) != 0:
+                    raise RuntimeError(f"Could not fetch the files of {revision}")
+            repo.checkout(commit, dest)
+
+        (tree,) = repo.output("rev-parse", f"{commit}^{{tree}}")
+        return artifact_store.stored_tree(f"git-{tree}", checkout, store_dir)
+
+
+def _download_info_path(dest: Path) -> Path:
+    return dest.with_name(dest.name + ".json")
+
+
+def _read_download_info(dest: Path, url) -> dict:
+    try:
+        info = json.loads(_download_info_path(dest).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return info if info.get("url") == url else {}
+
+
+def _write_download_info(dest: Path, info: dict):
+    path = _download_info_path(dest)
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    tmp.write_text(json.dumps(info, indent=1), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def url_download(
+    url, dest, md5: str = None, sha256: str = None, chunk_size: int = 1 << 16
+) -> Dict[str, str]:
+    """
+    Download `url` to `dest`, returning the md5 and sha256 of the file, which are computed while it is streamed to
+    disk. Raises a RuntimeError if the file doesn't have the given `md5`/`sha256`.
+
+    A file downloaded before is kept without contacting the server if it has the given hash, and otherwise only
+    downloaded again if the server reports a change (ETag/Last-Modified). An interrupted download is resumed with a
+    range request the next time. What is known about `dest` is kept next to it in "<dest>.json".
+    """
+    dest = Path(dest)
+    part = dest.with_name(dest.name + ".part")
+    expected = {
+        name: value.lower()
+        for name, value in (("md5", md5), ("sha256", sha256))
+        if value is not None
+    }
+
+    info = _read_download_info(dest, url)
+    complete = info.get("complete")
+    if complete is not None and not (
+        dest.is_file()
+        and dest.stat().st_size == complete["size"]
+        and dest.stat().st_mtime_ns == complete["mtime_ns"]
+    ):
+        complete = None
+
+    def checked(digests):
+        if any(digests[i] != j for i, j in expected.items()):
+            raise RuntimeError(
+                f"Downloaded file {dest} has md5 {digests['md5']} and sha256 {digests['sha256']}, expected "
+                + " and ".join(f"{i} {j}" for i, j in expected.items())
+            )
+        return digests
+
+    if (
+        complete is not None
+        and expected
+        and all(complete[i] == j for i, j in expected.items())
+    ):
+        return {i: complete[i] for i in ("md5", "sha256")}
+
+    headers = {}
+    if complete is not None:
+        if complete.get("etag"):
+            headers["If-None-Match"] = complete["etag"]
+        if complete.get("last_modified"):
+            headers["If-Modified-Since"] = complete["last_modified"]
+
+    # A partial download can only be resumed if the server can tell whether it is still the same file
+    partial = info.get("partial") or {}
+    validator = partial.get("etag") or partial.get("last_modified")
+    offset = part.stat().st_size if validator and part.is_file() else 0
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+
+    try:
         try:
-            git = str(Path(sh_lines("where git")[0]).resolve())
-        except (subprocess.CalledProcessError, IndexError) as e:
-            raise (RuntimeError("Could not find git through `where git`"))
-
-        # Test if we are currently tracking the ref
-        def is_on_ref(revision):
-            if revision is None:
-                return False
-            try:
-                commit = sh_lines([git, "rev-parse", "HEAD"])[0]
-                return (
-                    commit
-                    == sh_lines(
-                        [git, "rev-list", "-n", "1", revision],
-                        stderr=subprocess.DEVNULL,
-                    )[0]
+            response = urllib.request.urlopen(
+                urllib.request.Request(url, headers=headers), timeout=60
+            )
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and complete is not None:
+                return checked({i: complete[i] for i in ("md5", "sha256")})
+            if e.code == 416 and offset:
+                # The partial file is no good, start over
+                os.remove(part)
+                return url_download(url, dest, md5, sha256, chunk_size)
+            raise
+
+        with response:
+            hashes = {"md5": hashlib.md5(), "sha256": hashlib.sha256()}
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+
+            content_range = response.headers.get("Content-Range", "")
+            if response.status == 200:
+                offset = 0
+                mode = "wb"
+            elif (
+                response.status == 206
+                and offset
+                and content_range.startswith(f"bytes {offset}-")
+            ):
+                with open(part, "rb") as f:
+                    while chunk := f.read(chunk_size):
+                        for i in hashes.values():
+                            i.update(chunk)
+                mode = "ab"
+            elif response.status == 206 and offset:
+                # Not the rest of the partial file, start over without it
+                os.remove(part)
+                return url_download(url, dest, md5, sha256, chunk_size)
+            else:
+                raise RuntimeError(
+                    f"Unexpected response {response.status} {content_range!r} for {url}"
                 )
-            except subprocess.CalledProcessError:
-                return False
-
-        if Path(".git").is_dir():
-            if is_on_ref(revision):
-                sh_quiet([git, "reset", "--hard"])
-                sh_quiet([git, "clean", "-qdfx"])
-                return None
-
-        gitremote = None  # noqa
-        with suppress(subprocess.CalledProcessError):
-            gitremote = sh_lines([git, "config", "--get", "remote.origin.url"])[0]
-
-        # If not correct git source, then re-download
-        if gitremote != git_source:
-            for i in Path(".").glob("*"):
-                if i.is_file():
-                    os.remove(i)
-                else:
-                    util.rmtree(i)
-
-            subprocess.call([git, "clone", git_source, str(Path(".").resolve())])
-            if not Path(".git").is_dir():
-                raise (RuntimeError(f"Could not `git clone {git_source} .`"))
-
-        sh_quiet([git, "reset", "--hard"])
-        sh_quiet([git, "clean", "-qdfx"])
-
-        for get_all_upstream in [False, True]:
-            if get_all_upstream:
-                for branch in sh_lines([git, "branch", "-a"]):
-                    if "->" in branch:
-                        continue
-                    sh_quiet([git, "branch", "--track", branch.split("/")[-1], branch])
-
-            sh_quiet([git, "fetch", "--all"])
-            sh_quiet([git, "fetch", "--tags", "--force"])
-
-            # set revision to default branch
-            if revision is None:
-                revision = sh_lines([git, "symbolic-ref", "refs/remotes/origin/HEAD"])[
-                    0
-                ].split("/")[-1]
-
-            sh_quiet([git, "pull", "origin", revision])
-            sh_quiet([git, "checkout", "--force", revision])
-
-            if revision is None or is_on_ref(revision):
-                return None
-
-        raise RuntimeError(f"Could not check out {revision}")
+
+            os.makedirs(dest.parent, exist_ok=True)
+            _write_download_info(
+                dest, {"url": url, "complete": complete, "partial": validators}
+            )
+
+            size = offset
+            with open(part, mode) as f:
+                while chunk := response.read(chunk_size):
+                    f.write(chunk)
+                    for i in hashes.values():
+                        i.update(chunk)
+                    size += len(chunk)
+
+            # A dropped connection just ends the body early
+            if (length := response.headers.get("Content-Length")) is not None:
+                if size != offset + int(length):
+                    raise RuntimeError(f"Download of {url} was cut off")
+
+    except (OSError, http.client.HTTPException) as e:
+        raise RuntimeError(f"Could not download {url}") from e
+
+    digests = {i: j.hexdigest() for i, j in hashes.items()}
+    try:
+        checked(digests)
+    except RuntimeError:
+        os.remove(part)
+        raise
+
+    os.replace(part, dest)
+    stat = dest.stat()
+    _write_download_info(
+        dest,
+        {
+            "url": url,
+            "complete": {
+                **validators,
+                **digests,
+                "size": size,
+                "mtime_ns": stat.st_mtime_ns,
+            },
+        },
+    )
+    return digests
+
+
+def url_artifact(
+    url, name, md5: str = None, sha256: str = None, store_dir=None
+) -> Tuple[Path, Dict[str, str]]:
+    """
+    `(location in the artifact store, digests)` of the file at `url`. With a known `md5` or `sha256` a stored file
+    is used without contacting the server, whichever script downloaded it; otherwise the file is downloaded with
+    `url_download` to a location in the store that is named after the url and `name`.
+    """
+    expected = {"md5": md5, "sha256": sha256}
+    if (stored := artifact_store.stored_file(expected, store_dir)) is not None:
+        if all(stored[1][i] == j.lower() for i, j in expected.items() if j):
+            return stored
+
+    dest = Path(
+        artifact_store.artifact_store_dir if store_dir is None else store_dir,
+        "downloads",
+        f"{hashlib.md5(str(url).encode()).hexdigest()[:8]}-{sanitize_filename(name)}",
+    )
+    # Sources with the same url download it once, the others wait and find it complete
+    with artifact_store.locked(f"downloads-{dest.name}", store_dir):
+        digests = url_download(url, dest, md5, sha256)
+        return artifact_store.store_file(dest, digests, store_dir), digests
@@ -1,5 +1,4 @@
 from typing import Union
-import locate
 from pathlib import Path
 import os
 import tempfile
@@ -8,10 +7,11 @@ from . import util
 import subprocess
 import uuid
 
-_compile_vbs = locate.this_dir().joinpath("bin", "compile.vbs")
-_decompile_vbs = locate.this_dir().joinpath("bin", "decompile.vbs")
-_runmacro_vbs = locate.this_dir().joinpath("bin", "runmacro.vbs")
-_saveasxlsx_vbs = locate.this_dir().joinpath("bin", "saveasxlsx.vbs")
+_this_dir = Path(__file__).resolve().parent
+_compile_vbs = _this_dir.joinpath("bin", "compile.vbs")
+_decompile_vbs = _this_dir.joinpath("bin", "decompile.vbs")
+_runmacro_vbs = _this_dir.joinpath("bin", "runmacro.vbs")
+_saveasxlsx_vbs = _this_dir.joinpath("bin", "saveasxlsx.vbs")
 
 
 def _file_is_locked(path) -> Union[bool, Exception]:
@@ -57,7 +57,7 @@ def is_locked(path) -> Union[bool, Exception]:
 
 def compile_xl(src_dir, dst_file=None):
     """
-    >>> indir = locate.this_dir().joinpath("../test/example-xl-with-vba")
+    >>> indir = _this_dir.joinpath("../test/example-xl-with-vba")
     >>> xl = indir.parent.joinpath("temporary_output/example-xl-with-vba-and-rename.xlsb")
     >>> compile_xl(indir, xl)  #doctest: +ELLIPSIS
     WindowsPath('...example-xl-with-vba-and-rename.xlsb')
@@ -106,7 +106,7 @@ def compile_xl(src_dir, dst_file=None):
 
 def decompile_xl(src_file, dst_dir=None):
     """
-    >>> xl = locate.this_dir().joinpath("../test/example-xl-with-vba.xlsb")
+    >>> xl = _this_dir.joinpath("../test/example-xl-with-vba.xlsb")
     >>> outdir = xl.parent.joinpath("temporary_output/example-xl-output")
     >>> decompile_xl(xl, outdir) #doctest: +ELLIPSIS
     WindowsPath('...example-xl-output')
@@ -154,7 +154,7 @@ def runmacro_xl(src_file, macroname=None):
 
 def saveas_xlsx(src_file, dst_file):
     """
-    >>> xl = locate.this_dir().joinpath("../test/example-xl-with-vba.xlsb")
+    >>> xl = _this_dir.joinpath("../test/example-xl-with-vba.xlsb")
     >>> outfile = xl.parent.joinpath("temporary_output/example-xl-as-xlsx.xlsx")
     >>> saveas_xlsx(xl, outfile) #doctest: +ELLIPSIS
     WindowsPath('...example-xl-as-xlsx.xlsx')
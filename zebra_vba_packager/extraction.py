@@ -0,0 +1,154 @@
+import gzip
+import os
+import shutil
+import tarfile
+import zipfile
+from pathlib import Path, PurePosixPath
+from typing import Callable, List, Optional, Union
+
+archive_suffixes = (".zip", ".tar", ".7z", ".gz")
+
+
+def archive_format(name: str) -> str:
+    """
+    How `extract_archive` reads an archive with the given file name; archives with the same content and format
+    extract to the same files.
+
+    >>> [archive_format(i) for i in ["a.ZIP", "a.tar.gz", "a.tgz", "a.7z", "a.txt.gz"]]
+    ['zip', 'tar', 'tar', '7z', 'gz:a.txt']
+    """
+    suffix = name.lower()
+    if suffix.endswith(".zip"):
+        return "zip"
+    if suffix.endswith(".7z"):
+        return "7z"
+    if suffix.endswith(".gz") and not suffix.endswith((".tar.gz", ".tgz")):
+        # A single compressed file is named after the archive
+        return f"gz:{name[: -len('.gz')]}"
+    return "tar"
+
+
+def _pack_7zarchive(base_name, base_dir, *args, **kwargs):
+    from py7zr import pack_7zarchive
+
+    pack_7zarchive(base_name, base_dir, *args, **kwargs)
+    return str(base_name) + ".7z"
+
+
+def _unpack_7zarchive(*args, **kwargs):
+    from py7zr import unpack_7zarchive
+
+    return unpack_7zarchive(*args, **kwargs)
+
+
+def register_7z_formats():
+    """
+    Let `shutil.make_archive` and `shutil.unpack_archive` handle 7z archives (format "7zip"). py7zr is only imported
+    once such an archive is made or unpacked.
+    """
+    if "7zip" not in [i for i, *_ in shutil.get_unpack_formats()]:
+        shutil.register_archive_format(
+            "7zip", _pack_7zarchive, description="7zip archive"
+        )
+        shutil.register_unpack_format("7zip", [".7z"], _unpack_7zarchive)
+
+
+def _member_path(name: str) -> Optional[str]:
+    # Relative path of an archive member, or None for members that would end up outside the destination
+    parts = [i for i in PurePosixPath(name.replace("\\", "/")).parts if i != "."]
+    if not parts or parts[0] == "/" or ".." in parts or ":" in parts[0]:
+        return None
+    return "/".join(parts)
+
+
+def _write(fileobj, dest: Path, path: str) -> Path:
+    target = dest.joinpath(path)
+    os.makedirs(target.parent, exist_ok=True)
+    with open(target, "wb") as f:
+        shutil.copyfileobj(fileobj, f, 1 << 20)
+    return target
+
+
+def _extract_tar(tar: tarfile.TarFile, dest: Path, select) -> List[str]:
+    # Members are visited in the order they are stored, so a compressed stream is only decompressed once
+    extracted = []
+    for member in tar:
+        if member.isfile() and (path := _member_path(member.name)) and select(path):
+            target = _write(tar.extractfile(member), dest, path)
+            os.utime(target, (member.mtime, member.mtime))
+            extracted.append(path)
+    return extracted
+
+
+def extract_archive(
+    path: Union[str, Path],
+    dest: Union[str, Path],
+    select: Callable[[str], bool] = None,
+    name: str = None,
+) -> List[str]:
+    """
+    Extract the files of a zip, tar (optionally compressed), gz or 7z archive into `dest`, only those for whose
+    relative path `select` returns True (all files by default), and return their relative paths. Nothing else of the
+    archive is written to disk; a tar inside a gz is decompressed on the fly. The format is told by `name`, which
+    defaults to the file name of `path`. Members that would end up outside `dest` are skipped.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as tdir:
+    ...     with zipfile.ZipFile(Path(tdir, "a.zip"), "w") as f:
+    ...         f.writestr("src/A.bas", "a")
+    ...         f.writestr("docs/x.md", "x")
+    ...         f.writestr("../evil.bas", "x")
+    ...     extract_archive(Path(tdir, "a.zip"), Path(tdir, "out"), lambda x: x.endswith(".bas"))
+    ['src/A.bas']
+    """
+    path, dest = Path(path), Path(dest)
+    select = (lambda x: True) if select is None else select
+    fmt = archive_format(path.name if name is None else name)
+
+    if fmt == "zip":
+        extracted = []
+        with zipfile.ZipFile(path) as f:
+            for info in f.infolist():
+                if (
+                    not info.is_dir()
+                    and (member := _member_path(info.filename))
+                    and select(member)
+                ):
+                    with f.open(info) as src:
+                        _write(src, dest, member)
+                    extracted.append(member)
+        return extracted
+
+    if fmt == "7z":
+        import py7zr
+
+        with py7zr.SevenZipFile(path) as f:
+            targets = [
+                i.filename
+                for i in f.list()
+                if not i.is_directory
+                and (member := _member_path(i.filename))
+                and select(member)
+            ]
+            if targets:
+                f.extract(dest, targets=targets)
+        return [_member_path(i) for i in targets]
+
+    if fmt.startswith("gz:"):
+        # A tar inside the gz, else a single compressed file
+        with gzip.open(path) as f:
+            try:
+                with tarfile.open(fileobj=f, mode="r|") as tar:
+                    return _extract_tar(tar, dest, select)
+            except tarfile.ReadError:
+                pass
+
+        member = fmt[len("gz:") :]
+        if not select(member):
+            return []
+        with gzip.open(path) as f:
+            _write(f, dest, member)
+        return [member]
+
+    with tarfile.open(path, mode="r|*") as tar:
+        return _extract_tar(tar, dest, select)
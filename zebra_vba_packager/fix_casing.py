@@ -1,11 +1,11 @@
-from .vba_tokenizer import vba_names, tokenize, tokens_to_str
-import os
+from .virtual_tree import VirtualTree, tree_of
+from .vba_tokenizer import vba_names, tokens_to_str
 from typing import Union
 from pathlib import Path
 
 
 def fix_casing(
-    code_dir: Union[str, Path],
+    code_dir: Union[str, Path, VirtualTree],
     case_style: Union[str, None] = None,
     vars_overwrite_file: Union[str, Path, list] = None,
 ):
@@ -19,7 +19,7 @@ def fix_casing(
         - Excluding desired variables.
 
     Args:
-        code_dir: List of directories containing the '.bas', '.cls', '.txt' files to enforce casing on.
+        code_dir: Directory (or `VirtualTree`) containing the '.bas', '.cls', '.txt' files to enforce casing on.
         case_style: Casing style. Options -> None, 'camel', 'pascal'. Not case-sensitive
         vars_overwrite_file: File containing variable names that overwrites the selected casing option.
     """
@@ -35,42 +35,32 @@ def fix_casing(
     if vars_overwrite_file is not None:
         tokens_dict = _fetch_vars_overwrite_file_data(vars_overwrite_file)
 
-    vbafiles = _get_vba_filenames(code_dir, exts)
+    with tree_of(code_dir) as tree:
+        for file_name_input in tree.paths(*exts):
+            file_name_output = _rename_filename(file_name_input, case_style)
 
-    for file_name_input in vbafiles:
-        file_name_output = _rename_filename(file_name_input, case_style)
+            file_content_input = tree.read_text(file_name_input)
+            tokens = tree.tokens(file_name_input).copy()
 
-        with open(file_name_input) as file:
-            file_content_input = file.read()
-        tokens = tokenize(file_content_input)
+            tokens, tokens_dict = _convert_token_txt(
+                tokens, case_style, tokens_dict, vba_names_dict
+            )
 
-        tokens, tokens_dict = _convert_token_txt(
-            tokens, case_style, tokens_dict, vba_names_dict
-        )
+            file_content_output = tokens_to_str(tokens)
 
-        file_content_output = tokens_to_str(tokens)
+            # For any change
+            if file_content_output != file_content_input:
+                tree.write_text(file_name_input, file_content_output)
 
-        # For filename changes
-        if file_name_input != file_name_output:
-            os.remove(file_name_input)
+            # For filename changes
+            if str(file_name_input) != str(file_name_output):
+                tree.rename(file_name_input, file_name_output)
 
-        # For any change
-        if (
-            file_content_output != file_content_input
-            or file_name_input != file_name_output
-        ):
-            with open(file_name_output, "w") as ofile:
-                ofile.write(file_content_output)
 
-
-def _rename_filename(f, case_style):
-    file_name_old = os.path.basename(f)[:-4]
+def _rename_filename(f: Path, case_style):
+    file_name_old = f.name[:-4]
     file_name_new = _change_variable_casing(file_name_old, case_style)
-    return (
-        os.path.dirname(f)
-        + "\\"
-        + os.path.basename(f).replace(file_name_old, file_name_new)
-    )
+    return f.with_name(f.name.replace(file_name_old, file_name_new))
 
 
 def _fetch_vars_overwrite_file_data(vars_overwrite_file: Union[str, Path, list]):
@@ -141,15 +131,3 @@ def _token_is_dll_name(tokens, index) -> bool:
         ):
             return True
     return False
-
-
-def _get_vba_filenames(codedir, exts):
-    vbafiles = []
-    for d, dirs, files in os.walk(codedir):
-        for f in files:
-            if not f.lower()[-4:] in exts:
-                continue
-
-            path = os.path.join(d, f)
-            vbafiles.append(path)
-    return vbafiles
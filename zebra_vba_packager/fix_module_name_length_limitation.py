@@ -1,10 +1,9 @@
 from __future__ import annotations
 import dataclasses
 import re
-from pathlib import Path
 from typing import Optional
 
-from .util import read_txt, write_txt
+from .virtual_tree import tree_of
 
 re_modname = re.compile(
     r'^\s*Attribute\s*VB_Name\s*=\s*"(.*)"', re.IGNORECASE | re.MULTILINE
@@ -16,20 +15,21 @@ re_zebra_namespace = re.compile(
 
 def fix_module_name_length_limitation(dirpath):
     modname_reuse = set()
-    for p in sorted(Path(dirpath).rglob("*.cls")):
-        txt = read_txt(p)
+    with tree_of(dirpath) as tree:
+        for p in tree.paths(".cls", sort=True):
+            txt = tree.read_text(p)
 
-        i, j = re_modname.search(txt).span(1)
-        modname = txt[i:j]
+            i, j = re_modname.search(txt).span(1)
+            modname = txt[i:j]
 
-        if modname.startswith("z__"):
-            mpair = _ModnamePair.from_str(txt, suffix=1)
+            if modname.startswith("z__"):
+                mpair = _ModnamePair.from_str(txt, suffix=1)
 
-            if mpair.needs_renaming():
-                while mpair.modname in modname_reuse:
-                    mpair.suffix += 1
-                modname_reuse.add(mpair.modname)
-                write_txt(p, mpair.inject_into(txt))
+                if mpair.needs_renaming():
+                    while mpair.modname in modname_reuse:
+                        mpair.suffix += 1
+                    modname_reuse.add(mpair.modname)
+                    tree.write_text(p, mpair.inject_into(txt))
 
 
 @dataclasses.dataclass
@@ -2,7 +2,7 @@ from __future__ import annotations
 import re
 from pathlib import Path
 
-from .util import read_txt, write_txt
+from .virtual_tree import tree_of
 
 re_modname = re.compile(r"^'zebra source (.*)$", re.IGNORECASE | re.MULTILINE)
 re_full_commit = re.compile(r"^[0-9a-f]{40}$")
@@ -53,18 +53,19 @@ def expand_zebra_refs(txt, new_repo, new_ref):
 
 
 def add_repo_history_comment(dirpath, new_repo, new_ref):
-    for p in sorted(Path(dirpath).rglob("*.cls")) + sorted(
-        Path(dirpath).rglob("*.bas")
-    ):
-        txt = read_txt(p)
-        sourcelist = expand_zebra_refs(txt, new_repo, new_ref)
-        write_txt(p, replace_zebra_refs(txt, sourcelist))
+    with tree_of(dirpath) as tree:
+        for p in tree.paths(".cls", sort=True) + tree.paths(".bas", sort=True):
+            txt = tree.read_text(p)
+            sourcelist = expand_zebra_refs(txt, new_repo, new_ref)
+            if (new_txt := replace_zebra_refs(txt, sourcelist)) != txt:
+                tree.write_text(p, new_txt)
 
 
 def fix_repo_history_comment(dirpath):
-    for p in sorted(Path(dirpath).rglob("*.cls")) + sorted(
-        Path(dirpath).rglob("*.bas")
-    ):
-        txt = read_txt(p)
-        sourcelist = get_zebra_refs(txt)
-        write_txt(p, replace_zebra_refs(txt, sourcelist))
+    with tree_of(dirpath) as tree:
+        for p in tree.paths(".cls", sort=True) + tree.paths(".bas", sort=True):
+            txt = tree.read_text(p)
+            sourcelist = get_zebra_refs(txt)
+            # Unchanged files are left alone
+            if (new_txt := replace_zebra_refs(txt, sourcelist)) != txt:
+                tree.write_text(p, new_txt)
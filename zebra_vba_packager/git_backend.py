@@ -0,0 +1,298 @@
+import atexit
+import os
+import re
+import shutil
+import subprocess
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Union
+
+re_full_commit = re.compile(r"^[0-9a-f]{40}$")
+
+
+@lru_cache(maxsize=None)
+def git_executable() -> str:
+    if (git := shutil.which("git")) is None:
+        raise RuntimeError("Could not find git on the PATH")
+    return str(Path(git).resolve())
+
+
+class GitRepo:
+    """
+    The git command line for one repository, spawning as few git processes as possible: object and ref lookups all
+    go through a single long-lived `git cat-file --batch-check` process, and commit ids are remembered once resolved.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.git = git_executable()
+        self._batch = None
+        self._lock = threading.Lock()
+        # Commit id (or abbreviation) -> full commit id; commits never change, unlike ref names
+        self._commits = {}
+
+    def run(self, *args) -> int:
+        """
+        Run a git command quietly, returning its exit code.
+        """
+        return subprocess.call(
+            [self.git, "-C", str(self.path), *args],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def output(self, *args) -> List[str]:
+        """
+        Lines of the output of a git command; raises `subprocess.CalledProcessError` if it fails.
+        """
+        lines = (
+            subprocess.check_output(
+                [self.git, "-C", str(self.path), *args], stderr=subprocess.DEVNULL
+            )
+            .decode("utf-8")
+            .strip()
+            .split("\n")
+        )
+        return [] if lines == [""] else [i.strip() for i in lines]
+
+    def resolve(self, *revisions: str) -> List[Optional[str]]:
+        """
+        Full commit ids of `revisions` (None where a revision isn't a known commit), looked up in one round trip.
+        """
+        with self._lock:
+            missing = [i for i in revisions if i not in self._commits]
+            if missing:
+                if self._batch is None:
+                    self._batch = subprocess.Popen(
+                        [self.git, "-C", str(self.path), "cat-file", "--batch-check"],
+                        stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL,
+                        env=_no_lazy_fetch_env(),
+                    )
+                    _open_repos.add(self)
+
+                self._batch.stdin.write(
+                    "".join(f"{i}^{{commit}}\n" for i in missing).encode("utf-8")
+                )
+                self._batch.stdin.flush()
+
+                resolved = {}
+                for i in missing:
+                    # "<id> commit <size>", or "<name> missing|ambiguous"
+                    line = self._batch.stdout.readline().decode("utf-8").split()
+                    if not line:
+                        self._close()
+                        raise RuntimeError(f"git cat-file stopped in {self.path}")
+                    resolved[i] = line[0] if line[1:2] == ["commit"] else None
+
+                for i, commit in resolved.items():
+                    if commit is not None and commit.startswith(i.lower()):
+                        self._commits[i] = commit
+            else:
+                resolved = {}
+
+            return [self._commits.get(i, resolved.get(i)) for i in revisions]
+
+    def refs(self) -> Dict[str, str]:
+        """
+        All refs with the commit they point to (tags peeled), from a single `for-each-ref`.
+        """
+        refs = {}
+        for line in self.output(
+            "for-each-ref", "--format=%(refname) %(objectname) %(*objectname)"
+        ):
+            name, *ids = line.split()
+            refs[name] = ids[-1]
+        return refs
+
+    def ls_tree(self, commit: str) -> Dict[str, str]:
+        """
+        Blob ids of the regular files in the tree of `commit`, keyed on their path (with "/" separators).
+        Symbolic links and submodules are left out.
+        """
+        files = {}
+        for entry in subprocess.check_output(
+            [
+                self.git,
+                "-C",
+                str(self.path),
+                "ls-tree",
+                "-r",
+                "-z",
+                "--full-tree",
+                commit,
+            ],
+            stderr=subprocess.DEVNULL,
+            env=_no_lazy_fetch_env(),
+        ).split(b"\0"):
+            if entry:
+                info, path = entry.split(b"\t", 1)
+                mode, type_, object_id = info.split()
+                if type_ == b"blob" and mode in (b"100644", b"100755"):
+                    files[path.decode("utf-8")] = object_id.decode("utf-8")
+        return files
+
+    def missing_objects(self, commit: str) -> Set[str]:
+        """
+        Ids of the objects in the tree of `commit` that aren't in the repository, e.g. blobs left out of a partial
+        clone.
+        """
+        lines = subprocess.check_output(
+            [
+                self.git,
+                "-C",
+                str(self.path),
+                "rev-list",
+                "--objects",
+                "--missing=print",
+                "--no-walk",
+                commit,
+            ],
+            stderr=subprocess.DEVNULL,
+            env=_no_lazy_fetch_env(),
+        ).decode("utf-8")
+        return {i[1:].strip() for i in lines.split("\n") if i.startswith("?")}
+
+    def fetch_objects(self, object_ids: Iterable[str], remote: str = "origin") -> int:
+        """
+        Fetch objects by id in a single request, the way git fills in missing objects of a partial clone.
+        """
+        return subprocess.run(
+            [
+                self.git,
+                "-C",
+                str(self.path),
+                "-c",
+                "fetch.negotiationAlgorithm=noop",
+                "fetch",
+                "--quiet",
+                "--no-tags",
+                "--no-write-fetch-head",
+                "--recurse-submodules=no",
+                "--filter=blob:none",
+                "--stdin",
+                remote,
+            ],
+            input="".join(f"{i}\n" for i in object_ids).encode("utf-8"),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+
+    def read_blobs(self, object_ids: Iterable[str]) -> Iterator[bytes]:
+        """
+        Contents of the given blobs, streamed from a single `git cat-file --batch`.
+        """
+        batch = subprocess.Popen(
+            [self.git, "-C", str(self.path), "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=_no_lazy_fetch_env(),
+        )
+        try:
+            for i in object_ids:
+                batch.stdin.write(f"{i}\n".encode("utf-8"))
+                batch.stdin.flush()
+
+                # "<id> blob <size>", then the content and a newline
+                header = batch.stdout.readline().split()
+                if header[1:2] != [b"blob"]:
+                    raise RuntimeError(f"Could not read blob {i} in {self.path}")
+                data = batch.stdout.read(int(header[2]))
+                batch.stdout.read(1)
+                yield data
+        finally:
+            batch.stdin.close()
+            batch.stdout.close()
+            batch.wait()
+
+    def checkout(self, commit: str, dest: Union[str, Path]):
+        """
+        Write the files of `commit` to the (empty) directory `dest`, the way `git checkout` would but without making
+        it a repository. Missing blobs must have been fetched beforehand.
+        """
+        dest = Path(dest)
+        index = dest.with_name(dest.name + ".index")
+        env = {**_no_lazy_fetch_env(), "GIT_INDEX_FILE": str(index)}
+        try:
+            for args in (["read-tree", commit], ["checkout-index", "--all", "--force"]):
+                subprocess.run(
+                    [
+                        self.git,
+                        f"--git-dir={self.path}",
+                        f"--work-tree={dest}",
+                        *args,
+                    ],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    env=env,
+                    check=True,
+                )
+        finally:
+            if index.is_file():
+                os.remove(index)
+
+    def refs_changed(self):
+        """
+        Call after refs were changed by another git process (e.g. a fetch), so that names are looked up again.
+        """
+        with self._lock:
+            self._close()
+
+    def close(self):
+        """
+        Stop the `cat-file` process and forget resolved commits, e.g. before the repository is deleted.
+        """
+        with self._lock:
+            self._close()
+            self._commits.clear()
+
+    def _close(self):
+        if self._batch is not None:
+            self._batch.stdin.close()
+            self._batch.wait()
+            self._batch.stdout.close()
+            self._batch = None
+        _open_repos.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _no_lazy_fetch_env():
+    # Lookups never fetch missing objects of a partial clone one by one from the promisor remote
+    return {**os.environ, "GIT_NO_LAZY_FETCH": "1"}
+
+
+_open_repos = set()
+
+
+@atexit.register
+def _close_open_repos():
+    for repo in list(_open_repos):
+        repo.close()
+
+
+def read_worktree(path: Union[str, Path]):
+    """
+    `(common git dir, HEAD commit)` of a worktree made by `git worktree add`, read from its files without running
+    git; None if `path` isn't such a worktree. The commit is None unless HEAD is detached.
+    """
+    try:
+        git_file = Path(path, ".git").read_text(encoding="utf-8").strip()
+        if not git_file.startswith("gitdir: "):
+            return None
+        git_dir = Path(path, git_file[len("gitdir: ") :])
+        common_dir = git_dir.joinpath(
+            git_dir.joinpath("commondir").read_text(encoding="utf-8").strip()
+        ).resolve()
+        head = git_dir.joinpath("HEAD").read_text(encoding="utf-8").strip()
+    except (OSError, ValueError):
+        return None
+
+    return common_dir, head if re_full_commit.match(head) else None
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import uuid
+from contextlib import suppress
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from .vba_tokenizer import tokenizer_version
+from .virtual_tree import VirtualTree
+
+
+def packager_version() -> str:
+    try:
+        from .version import version
+    except ImportError:
+        version = "unknown"
+    return version
+
+
+@lru_cache(maxsize=None)
+def packager_fingerprint() -> str:
+    """
+    Version of the packager together with a hash of its own source code, so that changing the packager (also during
+    development, without a new version) invalidates incremental builds.
+    """
+    file_hash = hashlib.md5(f"{packager_version()}\n{tokenizer_version}".encode())
+    for i in sorted(Path(__file__).parent.glob("*.py")):
+        file_hash.update(i.read_bytes())
+    return file_hash.hexdigest()
+
+
+def settings_fingerprint(x) -> Optional[str]:
+    """
+    Stable text representation of `Source` settings, or None if they contain functions, whose behaviour can't be
+    fingerprinted.
+
+    >>> fingerprint = settings_fingerprint({"b": 1, "A": [None, ("x", "y")]})
+    >>> fingerprint == settings_fingerprint({"A": [None, ("x", "y")], "b": 1})
+    True
+    >>> settings_fingerprint([(lambda x: True, "y")]) is None
+    True
+    """
+    if isinstance(x, dict):
+        items = sorted(
+            (settings_fingerprint(i), settings_fingerprint(j)) for i, j in x.items()
+        )
+        if any(i is None or j is None for i, j in items):
+            return None
+        return "{" + ",".join(f"{i}:{j}" for i, j in items) + "}"
+
+    if isinstance(x, (list, tuple)):
+        items = [settings_fingerprint(i) for i in x]
+        if None in items:
+            return None
+        return "[" + ",".join(items) + "]"
+
+    if callable(x):
+        return None
+
+    return repr(x)
+
+
+def source_fingerprint(options: dict, tree: VirtualTree) -> Optional[str]:
+    """
+    Fingerprint of everything the transformation of a source depends on: the packager, the transformation options and
+    the name and content of every selected file. Since the file contents are covered, so are the git commit, url md5
+    or local files they came from.
+    """
+    if (settings := settings_fingerprint(options)) is None:
+        return None
+
+    fingerprint = hashlib.md5(f"{packager_fingerprint()}\n{settings}\n".encode())
+    for i in sorted(tree.files, key=lambda x: x.as_posix()):
+        fingerprint.update(f"{i.as_posix()}\0{tree[i].digest()}\n".encode())
+
+    return fingerprint.hexdigest()
+
+
+def _manifest_path(directory: Path) -> Path:
+    return directory.with_name(directory.name + ".json")
+
+
+def load_transformed(directory: Path, fingerprint: str) -> Optional[VirtualTree]:
+    """
+    The transformed files stored by `store_transformed` under `directory`, if they were stored for `fingerprint`.
+    """
+    try:
+        manifest = json.loads(_manifest_path(directory).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get("fingerprint") != fingerprint:
+        return None
+
+    files = {directory.joinpath(i): size for i, size in manifest["files"].items()}
+    for i, size in files.items():
+        if not i.is_file() or i.stat().st_size != size:
+            return None
+
+    return VirtualTree.from_files(directory, files)
+
+
+def store_transformed(directory: Path, fingerprint: str, tree: VirtualTree):
+    manifest_path = _manifest_path(directory)
+    with suppress(FileNotFoundError):
+        os.remove(manifest_path)
+
+    os.makedirs(directory, exist_ok=True)
+    # Nothing edits these files in place, they are only replaced
+    tree.write_to(directory, clean=True, hard_link=True)
+
+    manifest = {
+        "fingerprint": fingerprint,
+        "files": {
+            i.as_posix(): directory.joinpath(i).stat().st_size for i in tree.paths()
+        },
+    }
+    tmp = manifest_path.with_name(f"{manifest_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    tmp.write_text(json.dumps(manifest, indent=1), encoding="utf-8")
+    os.replace(tmp, manifest_path)
@@ -0,0 +1,208 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, List, Optional, Union
+
+
+@dataclass
+class Span:
+    """
+    A stage of `Config.run` that finished: when it started (in `time.perf_counter()` seconds) and how long it took,
+    with the files it handled, the bytes it read and wrote and the tokens it produced. `source` names the source the
+    stage ran for, if any; `depth` is the number of spans it ran in.
+    """
+
+    name: str
+    source: Optional[str] = None
+    start: float = 0.0
+    duration: float = 0.0
+    files: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    tokens: int = 0
+    depth: int = 0
+    process: int = 0
+    thread: int = 0
+
+
+_observers: List[Callable[[Span], None]] = []
+_lock = threading.RLock()
+_local = threading.local()
+
+
+@contextmanager
+def observe(*observers: Callable[[Span], None]):
+    """
+    Call each of `observers` with every `Span` that finishes within this context, in any thread. Observers are called
+    one at a time.
+    """
+    with _lock:
+        _observers.extend(observers)
+    try:
+        yield
+    finally:
+        with _lock:
+            for i in observers:
+                _observers.remove(i)
+
+
+def observed() -> bool:
+    return bool(_observers)
+
+
+@contextmanager
+def span(name: str, source: str = None):
+    """
+    Time the code within this context as the stage `name`. A span inside another one belongs to the same source,
+    unless `source` is given. Nothing is measured unless there are observers.
+
+    >>> recorder = SpanRecorder()
+    >>> with observe(recorder):
+    ...     with span("outer", "a source"):
+    ...         with span("inner"):
+    ...             count(files=2, tokens=10)
+    >>> [(i.name, i.source, i.depth, i.files, i.tokens) for i in recorder.spans]
+    [('inner', 'a source', 1, 2, 10), ('outer', 'a source', 0, 0, 0)]
+    """
+    if not _observers:
+        yield
+        return
+
+    stack = _stack()
+    current = Span(
+        name,
+        stack[-1].source if source is None and stack else source,
+        depth=len(stack),
+        process=os.getpid(),
+        thread=threading.get_ident(),
+    )
+    stack.append(current)
+    current.start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.duration = time.perf_counter() - current.start
+        stack.pop()
+        emit(current)
+
+
+def count(files: int = 0, bytes_read: int = 0, bytes_written: int = 0, tokens: int = 0):
+    """
+    Add to the counts of the innermost span of this thread, if any.
+    """
+    if _observers and (stack := getattr(_local, "stack", None)):
+        current = stack[-1]
+        current.files += files
+        current.bytes_read += bytes_read
+        current.bytes_written += bytes_written
+        current.tokens += tokens
+
+
+def emit(finished: Span):
+    """
+    Pass a finished span on to the observers, e.g. one that was recorded in another process by `run_recorded`.
+    """
+    with _lock:
+        for i in _observers:
+            i(finished)
+
+
+def run_recorded(function: Callable, *args, **kwargs):
+    """
+    `(function(*args, **kwargs), spans)`, with the spans that finished in the meantime. Meant for running on a process
+    pool, where the observers of the calling process aren't available; the caller `emit`s the spans.
+    """
+    recorder = SpanRecorder()
+    with _lock:
+        observers = _observers[:]
+        _observers[:] = [recorder]
+    try:
+        return function(*args, **kwargs), recorder.spans
+    finally:
+        with _lock:
+            _observers[:] = observers
+
+
+def _stack() -> List[Span]:
+    if (stack := getattr(_local, "stack", None)) is None:
+        stack = _local.stack = []
+    return stack
+
+
+class SpanRecorder:
+    """
+    Observer that keeps all spans, to summarize them or export them as JSON or as a Chrome trace (which can be
+    opened in chrome://tracing or https://ui.perfetto.dev).
+    """
+
+    def __init__(self):
+        self.spans: List[Span] = []
+
+    def __call__(self, finished: Span):
+        self.spans.append(finished)
+
+    def summary(self, by_source: bool = False) -> str:
+        """
+        A table with the number of spans, total duration and counts of each stage (and source, with
+        `by_source=True`), in the order the stages first started. Durations of nested spans overlap.
+        """
+        rows = {}
+        for i in sorted(self.spans, key=lambda x: x.start):
+            key = (i.name, i.source if by_source else None)
+            row = rows.setdefault(key, [i.depth, 0, 0.0, 0, 0, 0, 0])
+            row[1] += 1
+            row[2] += i.duration
+            row[3] += i.files
+            row[4] += i.bytes_read
+            row[5] += i.bytes_written
+            row[6] += i.tokens
+
+        header = ["stage", "count", "seconds", "files", "read", "written", "tokens"]
+        lines = [
+            f"{header[0]:30} {header[1]:>6} {header[2]:>9} {header[3]:>7} {header[4]:>11} "
+            f"{header[5]:>11} {header[6]:>10}"
+        ]
+        for (name, source), (depth, *row) in rows.items():
+            label = "  " * depth + name + ("" if source is None else f" [{source}]")
+            lines.append(
+                f"{label:30} {row[0]:6} {row[1]:9.3f} {row[2]:7} {row[3]:11} {row[4]:11} {row[5]:10}"
+            )
+        return "\n".join(lines)
+
+    def to_json(self) -> str:
+        return json.dumps([asdict(i) for i in self.spans], indent=1)
+
+    def chrome_trace(self) -> dict:
+        """
+        The spans in the Chrome trace event format, with times in microseconds since the first span started.
+        """
+        start = min((i.start for i in self.spans), default=0.0)
+        return {
+            "traceEvents": [
+                {
+                    "name": i.name,
+                    "cat": "zebra-vba-packager",
+                    "ph": "X",
+                    "ts": (i.start - start) * 1e6,
+                    "dur": i.duration * 1e6,
+                    "pid": i.process,
+                    "tid": i.thread,
+                    "args": {
+                        "source": i.source,
+                        "files": i.files,
+                        "bytes_read": i.bytes_read,
+                        "bytes_written": i.bytes_written,
+                        "tokens": i.tokens,
+                    },
+                }
+                for i in self.spans
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def write_chrome_trace(self, path: Union[str, Path]):
+        Path(path).write_text(json.dumps(self.chrome_trace()), encoding="utf-8")
@@ -1,9 +1,18 @@
+from collections import deque
+from functools import lru_cache
+from itertools import chain
 from textwrap import dedent
 from types import SimpleNamespace as SN
-from typing import List
+from typing import List, Union
 import re
 
-from .vba_tokenizer import VBAToken, tokenize
+from .vba_tokenizer import (
+    TokenStream,
+    VBAToken,
+    token_texts,
+    token_type_names,
+    tokenize,
+)
 
 
 def _str_to_matchables(s):
@@ -21,63 +30,152 @@ def _str_to_matchables(s):
     return matchobj
 
 
-def match_tokens(
-    tokens: List[VBAToken],
-    custom_token_match_string,
-    on_line_start=False,
-    on_line_end=False,
-):
-    matchables = _str_to_matchables(custom_token_match_string)
-
-    # Pretend that tokens[-1] is a newline
-    def token_at(i):
-        return (
-            tokens[i]
-            if (i >= 0 and i < len(tokens))
-            else VBAToken(type="newline", text="\n")
-        )
+class TokenPattern:
+    """
+    A compiled `match_tokens` pattern: space separated regular expressions, each matched case-insensitively against
+    the start of the next non-space token, with optional elements in brackets. Optional elements that match always
+    consume their token, and a match ends when the last element consumes a token.
 
-    # For on_line_start start at tokens[-1] and inject first match as =="\r\n"
-    i = -1
-    if on_line_start:
-        matchables.insert(0, SN(optional=False, re=SN(match=lambda x: x == "\n")))
-        i = -2
-    if on_line_end:
-        matchables.append(SN(optional=False, re=SN(match=lambda x: x == "\n")))
-
-    t_len = len(tokens) + on_line_end
-    while (i := i + 1) < t_len:
-        if token_at(i).type == "space":
-            continue
-
-        matched = 1  # 1 = ongoing
-        k = -1
-        j = i - 1
-        while (j := j + 1) < t_len and k < len(matchables):
-            if token_at(j).type == "space":
-                continue
-
-            while (k := k + 1) < len(matchables):
-                if matchables[k].re.match(token_at(j).text):
-                    if k == len(matchables) - 1:
-                        matched = 2  # final match
-                    break
-
-                elif matchables[k].optional:  # Optional don't have to match
-                    continue
-                else:
-                    matched = 0  # early no match termination
-                    break
+    All matches are found in a single pass over the tokens: every start position is a walk through the pattern, and
+    walks that reached the same pattern element continue together. Transitions are cached per pattern element and
+    token text.
+
+    >>> pattern = TokenPattern("[private|public] function .*", on_line_start=True)
+    >>> list(pattern.finditer(tokenize("Function A()\\nPrivate Function B()\\nx = Function")))
+    [(0, 3), (5, 10)]
+    """
+
+    _max_transitions = 65536
+
+    def __init__(self, pattern: str, on_line_start=False, on_line_end=False):
+        self.pattern = pattern
+        self.on_line_start = on_line_start
+        self.on_line_end = on_line_end
 
-            if matched != 1:
+        self.matchables = _str_to_matchables(pattern)
+        # For on_line_start start at tokens[-1] and inject first match as =="\n"
+        if on_line_start:
+            self.matchables.insert(
+                0, SN(optional=False, re=SN(match=lambda x: x == "\n"))
+            )
+        if on_line_end:
+            self.matchables.append(SN(optional=False, re=SN(match=lambda x: x == "\n")))
+
+        # Per state, the state after consuming a token text
+        self._transitions = [{} for _ in self.matchables]
+
+    def _step(self, k: int, text: str):
+        """
+        Consume a token in state `k` (the next pattern element to try) and return the next state, or None.
+        """
+        transitions = self._transitions[k]
+
+        next_k = None
+        matchables = self.matchables
+        while k < len(matchables):
+            if matchables[k].re.match(text):
+                next_k = k + 1
+                break
+            elif not matchables[k].optional:  # early no match termination
                 break
+            k += 1  # Optional don't have to match
+
+        if len(transitions) >= self._max_transitions:
+            transitions.clear()
+        transitions[text] = next_k
+
+        return next_k
 
-        if matched == 2:
-            ii = i
-            while on_line_start and tokens[(ii := ii + 1)].type == "space":
+    def finditer(self, tokens: Union[List[VBAToken], TokenStream], start: int = 0):
+        """
+        Yield the `(start, end)` index ranges of all matches, ordered by start. Matching from `start` gives the
+        same result as matching `tokens[start:]` (offset by `start`), without copying the tokens.
+        """
+        n_tokens = len(tokens)
+        types, texts = token_type_names(tokens), token_texts(tokens)
+        final = len(self.matchables)
+        transitions, step = self._transitions, self._step
+        start_transitions = transitions[0]
+
+        # Non-space tokens, pretending that tokens[-1] and tokens[n] are newlines
+        positions = (
+            (i, texts[i]) for i in range(start, n_tokens) if types[i] != "space"
+        )
+        if self.on_line_start:
+            positions = chain([(start - 1, "\n")], positions)
+        if self.on_line_end:
+            positions = chain(positions, [(n_tokens, "\n")])
+
+        walks = {}  # state -> starts of the ongoing walks in that state
+        ends = {}  # start -> end of the match, or None if there is none
+        starts = deque()  # starts of walks not yielded yet, in order
+        for j, text in positions:
+            if walks:
+                next_walks = {}
+                for k, walk in walks.items():
+                    if (next_k := transitions[k].get(text, -1)) == -1:
+                        next_k = step(k, text)
+
+                    if next_k is None or next_k == final:
+                        end = None if next_k is None else j + 1
+                        for i in walk:
+                            ends[i] = end
+                    elif next_k in next_walks:
+                        next_walks[next_k].extend(walk)
+                    else:
+                        next_walks[next_k] = walk
+                walks = next_walks
+
+            # Start a new walk at every token
+            if (next_k := start_transitions.get(text, -1)) == -1:
+                next_k = step(0, text)
+            if next_k is not None:
+                starts.append(j)
+                if next_k == final:
+                    ends[j] = j + 1
+                elif next_k in walks:
+                    walks[next_k].append(j)
+                else:
+                    walks[next_k] = [j]
+
+            while starts and starts[0] in ends:
+                if (end := ends.pop(i := starts.popleft())) is not None:
+                    yield self._match(types, i, end)
+
+        # Walks still ongoing when the tokens run out don't match
+        for i in starts:
+            if ends.get(i) is not None:
+                yield self._match(types, i, ends[i])
+
+    def _match(self, types, i, j):
+        if self.on_line_start:
+            while types[(i := i + 1)] == "space":
                 pass
+        return i, j
+
+
+@lru_cache(maxsize=256)
+def compile_token_pattern(
+    custom_token_match_string: str, on_line_start=False, on_line_end=False
+) -> TokenPattern:
+    return TokenPattern(custom_token_match_string, on_line_start, on_line_end)
+
+
+def match_tokens(
+    tokens: Union[List[VBAToken], TokenStream],
+    custom_token_match_string: Union[str, TokenPattern],
+    on_line_start=False,
+    on_line_end=False,
+    start: int = 0,
+):
+    if isinstance(custom_token_match_string, TokenPattern):
+        pattern = custom_token_match_string
+    else:
+        pattern = compile_token_pattern(
+            custom_token_match_string, on_line_start, on_line_end
+        )
 
-            yield ii, j + 1
+    return pattern.finditer(tokens, start)
 
 
 if __name__ == "__main__":
@@ -3,7 +3,6 @@ import deprecation
 from pathlib import Path
 import os
 import shutil
-from py7zr import pack_7zarchive, unpack_7zarchive
 import tempfile
 
 
@@ -16,15 +15,6 @@ def in_temp_directory():
         os.chdir(old_cwd)
 
 
-def _pack_7zarchive(path, *args, **kwargs):
-    pack_7zarchive(path, *args, **kwargs)
-    return str(path) + ".7z"
-
-
-shutil.register_archive_format("7zip", _pack_7zarchive, description="7zip archive")
-shutil.register_unpack_format("7zip", [".7z"], unpack_7zarchive)
-
-
 @deprecation.deprecated(
     deprecated_in="0.0.10",
     removed_in="1.0",
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import tempfile
+import threading
+import uuid
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Union
+
+from .instrumentation import count
+from .vba_tokenizer import TokenStream, tokenize_stream, tokenizer_version
+
+token_cache_dir = Path(tempfile.gettempdir(), "zebra-vba-packager", "token-cache")
+token_cache_max_bytes = 256 * 1024 * 1024
+
+# Token arrays of recently tokenized sources, most recently used last
+_memory_cache = OrderedDict()
+_memory_cache_entries = 512
+# Sources are tokenized on several threads when `Config.run` has workers
+_memory_cache_lock = threading.Lock()
+
+
+def _cache_key(txt: str) -> str:
+    return hashlib.md5(
+        f"{tokenizer_version}\n{txt}".encode("utf-8", "surrogatepass")
+    ).hexdigest()
+
+
+def cached_tokenize_stream(
+    txt: str, cache_dir: Union[str, Path, None] = None
+) -> TokenStream:
+    """
+    Like `tokenize_stream`, but reuse the token arrays of previously seen sources, both within this process and
+    across runs via an on-disk cache keyed on the content of `txt` and `tokenizer_version`.
+
+    Only the token types and offsets are stored; the text always comes from `txt`. Each call returns a new
+    stream, so rewriting tokens in it never affects the cache.
+
+    >>> with tempfile.TemporaryDirectory() as tdir:
+    ...     txt = 'Attribute VB_Name = "Foo"\\nDim x As Long'
+    ...     a = cached_tokenize_stream(txt, tdir)
+    ...     _memory_cache.clear()
+    ...     b = cached_tokenize_stream(txt, tdir)
+    ...     [len(list(Path(tdir).glob("*.tokens"))), a == b == tokenize_stream(txt)]
+    [1, True]
+    """
+    txt = txt.replace("\r\n", "\n")
+    key = _cache_key(txt)
+
+    with _memory_cache_lock:
+        if (arrays := _memory_cache.get(key)) is not None:
+            _memory_cache.move_to_end(key)
+
+    if arrays is not None:
+        count(tokens=len(arrays[0]))
+        return TokenStream(txt, *arrays)
+
+    path = Path(token_cache_dir if cache_dir is None else cache_dir, f"{key}.tokens")
+    if (arrays := _load(path, len(txt))) is None:
+        stream = tokenize_stream(txt)
+        arrays = stream.types, stream.starts, stream.ends
+        _store(path, stream.types, stream.ends)
+
+    with _memory_cache_lock:
+        _memory_cache[key] = arrays
+        while len(_memory_cache) > _memory_cache_entries:
+            _memory_cache.popitem(last=False)
+
+    count(tokens=len(arrays[0]))
+    return TokenStream(txt, *arrays)
+
+
+def _load(path: Path, txt_len: int):
+    """
+    Read token arrays stored by `_store`; return None if missing or not valid for a source of `txt_len` characters.
+    """
+    try:
+        data = path.read_bytes()
+    except OSError:
+        return None
+
+    n = len(data) // 9
+    if len(data) != 9 * n:
+        return None
+
+    types = array("B", data[:n])
+    ends = array("q")
+    ends.frombytes(data[n:])
+    if (ends[-1] if n else 0) != txt_len:
+        return None
+
+    # Mark as recently used for `evict_token_cache`
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    return types, array("q", [0]) + ends[:-1], ends
+
+
+def _store(path: Path, types: array, ends: array):
+    """
+    Persist token arrays; start offsets are not stored since tokens are contiguous.
+    """
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        os.makedirs(path.parent, exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(types.tobytes())
+            f.write(ends.tobytes())
+        os.replace(tmp, path)
+    except OSError:
+        # The cache is an optimisation only
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def evict_token_cache(
+    max_bytes: Union[int, None] = None, cache_dir: Union[str, Path, None] = None
+):
+    """
+    Remove the least recently used entries from the on-disk token cache until it is at most `max_bytes` large.
+    """
+    max_bytes = token_cache_max_bytes if max_bytes is None else max_bytes
+    cache_dir = Path(token_cache_dir if cache_dir is None else cache_dir)
+
+    entries = []
+    try:
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".tokens") and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry))
+    except OSError:
+        return
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries, key=lambda x: x[0]):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(entry.path)
+            total -= size
+        except OSError:
+            pass
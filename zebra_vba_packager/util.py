@@ -1,16 +1,39 @@
-import datetime
+import fnmatch
 import hashlib
 import os
+import re
 import shutil
 import stat
 import sys
 import tempfile
 import time
-import uuid
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePath
 from typing import Iterable, Union, Callable, Any
+from . import artifact_store
 from .excel_compilation import is_locked
-from .py7z import pack, unpack
+from .extraction import archive_format, extract_archive
+
+
+def interval_elapsed(stamp: Union[str, Path], seconds: float) -> bool:
+    """
+    Whether `seconds` have passed since the file `stamp` was last touched (or it doesn't exist), in which case it is
+    touched now. Lets e.g. the eviction of a cache run at most once per interval, across processes.
+    """
+    stamp = Path(stamp)
+    try:
+        if time.time() - stamp.stat().st_mtime < seconds:
+            return False
+    except OSError:
+        pass
+
+    try:
+        os.makedirs(stamp.parent, exist_ok=True)
+        stamp.touch()
+        os.utime(stamp)
+    except OSError:
+        pass
+    return True
 
 
 def file_md5(fname: Path):
@@ -21,6 +44,14 @@ def file_md5(fname: Path):
     return file_hash.hexdigest()
 
 
+def file_sha256(fname: Path):
+    with open(fname, "rb") as f:
+        file_hash = hashlib.sha256()
+        while chunk := f.read(1 << 16):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
 def first(iterable: Iterable):
     for i in iterable:
         return i
@@ -97,27 +128,6 @@ def rmtree(
     return shutil.rmtree(path, False, _onerror)
 
 
-def delete_old_files_in_tempdir():
-    """
-    Keep removing directories older than 8 weeks from %temp%/zebra-vba-packager
-    until all of them are removed or the directory has 10 directories left.
-    """
-    temp_files_location = Path(tempfile.gettempdir(), "zebra-vba-packager")
-    temp_files = list(temp_files_location.glob("*"))
-    temp_files.sort(key=lambda x: os.path.getmtime(x))
-    number_of_files = len(temp_files)
-
-    for file in temp_files:
-        if number_of_files <= 10:
-            return
-        modified_date = os.path.getmtime(file)
-        today = datetime.datetime.today()
-        old_date = datetime.timedelta(weeks=8)
-        if modified_date < (today - old_date).timestamp():
-            rmtree(file)
-            number_of_files -= 1
-
-
 def dir_touch(directory_path):
     """
     Creates a directory if it doesn't exist yet.
@@ -128,12 +138,10 @@ def dir_touch(directory_path):
             Path to the directory.
     """
 
-    if os.path.exists(directory_path):
-        new_temp_file_path = Path(directory_path, str(uuid.uuid4()))
-        open(new_temp_file_path, "w").close()
-        os.remove(new_temp_file_path)
-    else:
-        os.makedirs(directory_path)
+    try:
+        os.utime(directory_path)
+    except FileNotFoundError:
+        os.makedirs(directory_path, exist_ok=True)
 
 
 def _str_parameter_to_list(x):
@@ -144,37 +152,222 @@ def _str_parameter_to_list(x):
     return x
 
 
-def unpack_globs(glob_extract, path):
-    for glob in _str_parameter_to_list(glob_extract):
-        for i in Path(path).glob(glob):
-            unpack(i, i.parent.joinpath(i.name + "-unpack"))
+def unpack_globs(glob_extract, path, max_depth: int = 8, workers: int = None):
+    """
+    Unpack the archives under `path` that match `glob_extract` into a "<name>-unpack" directory next to each, then
+    the matching archives that came out of those, and so on up to `max_depth` levels. The archives of a level are
+    unpacked concurrently on `workers` threads. Archives are extracted once per content: the result is kept in the
+    artifact store and linked from there when the same archive turns up again.
+    """
+    globs = _str_parameter_to_list(glob_extract)
+    if not globs:
+        return
+
+    path = Path(path)
+    match = path_matcher(globs)
+    archives = sorted({i for glob in globs for i in path.glob(glob) if i.is_file()})
+
+    with ThreadPoolExecutor(workers) as pool:
+        for _ in range(max_depth):
+            if not archives:
+                break
+
+            # Archives with the same content are extracted once
+            keys = list(pool.map(_unpack_key, archives))
+            first_of = dict(zip(reversed(keys), reversed(archives)))
+            trees = dict(zip(first_of, pool.map(_stored_unpack, first_of.items())))
+
+            unpacked = [i.parent.joinpath(i.name + "-unpack") for i in archives]
+            list(pool.map(artifact_store.link_tree, map(trees.get, keys), unpacked))
+
+            archives = sorted(
+                i
+                for directory in unpacked
+                for i in directory.rglob("*")
+                if i.is_file() and match(i.relative_to(path).as_posix())
+            )
+
+
+def _unpack_key(archive: Path) -> str:
+    key = f"unpack-{file_sha256(archive)}-{archive_format(archive.name)}"
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def _stored_unpack(item) -> Path:
+    key, archive = item
+    return artifact_store.stored_tree(key, lambda tmp: extract_archive(archive, tmp))
 
 
 def get_matching_file_patterns(path, glob_include, glob_exclude=None):
+    """
+    Resolved paths of the files under `path` that match one of the `glob_include` globs (see `Path.glob`) and none
+    of the `glob_exclude` globs, where a glob that matches a directory matches all files in it. The tree is walked
+    once for all globs, skipping directories that are excluded or can't contain included files.
+    """
+    matcher = _GlobMatcher(glob_include, glob_exclude)
     file_matches = set()
-    for glob in _str_parameter_to_list(glob_include):
-        for i in Path(path).glob(glob):
-            i = i.resolve()
-            if i.is_dir():
-                for j in i.rglob("*"):
-                    if j.is_file():
-                        file_matches.add(j.resolve())
-            else:
-                file_matches.add(i)
-
-    for glob in _str_parameter_to_list(glob_exclude):
-        for i in Path(path).glob(glob):
-            i = i.resolve()
-            if i.is_dir():
-                for j in i.rglob("*"):
-                    if j.is_file():
-                        file_matches.discard(j.resolve())
-            else:
-                file_matches.discard(i)
+
+    def walk(directory, parts, included):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+
+        for entry in entries:
+            entry_parts = parts + (entry.name,)
+            # Like "**", symbolic links to directories aren't followed
+            if entry.is_dir() and not entry.is_symlink():
+                dir_included, dir_excluded, below = matcher.dir_match(entry_parts)
+                if not dir_excluded and (included or dir_included or below):
+                    walk(entry.path, entry_parts, included or dir_included)
+
+            elif entry.is_file():
+                file_included, file_excluded = matcher.file_match(entry_parts)
+                if (included or file_included) and not file_excluded:
+                    file_matches.add(Path(entry.path))
+
+    root = Path(path).resolve()
+    root_included, root_excluded, _ = matcher.dir_match(())
+    if not root_excluded:
+        walk(root, (), root_included)
 
     return file_matches
 
 
+def _compile_glob_part(part):
+    # Matches one path component like `fnmatch.fnmatch` (case-insensitive on Windows); None stands for "**"
+    if part == "**":
+        return None
+    flags = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+    return re.compile(fnmatch.translate(part), flags).match
+
+
+def _glob_closure(states, patterns):
+    # A "**" may also match no directory at all
+    states = set(states)
+    todo = list(states)
+    while todo:
+        p, i = todo.pop()
+        if i < len(patterns[p]) and patterns[p][i] is None and (p, i + 1) not in states:
+            states.add((p, i + 1))
+            todo.append((p, i + 1))
+    return frozenset(states)
+
+
+def _glob_step(states, patterns, name, is_dir):
+    # Positions in the patterns after matching one more path component; like `Path.glob`, "**" only matches
+    # directories
+    stepped = set()
+    for p, i in states:
+        if i < len(patterns[p]):
+            if patterns[p][i] is None:
+                if is_dir:
+                    stepped.add((p, i))
+            elif patterns[p][i](name):
+                stepped.add((p, i + 1))
+    return _glob_closure(stepped, patterns) if is_dir else stepped
+
+
+class _GlobMatcher:
+    """
+    Include and exclude globs (see `Path.glob`) compiled for testing paths one component at a time: every directory
+    gets the set of positions reached in each glob, which its files and subdirectories continue from.
+    """
+
+    def __init__(self, glob_include, glob_exclude=None):
+        self.include = self._parse(glob_include)
+        self.exclude = self._parse(glob_exclude)
+        self._dirs = {
+            (): (
+                _glob_closure({(i, 0) for i in range(len(self.include))}, self.include),
+                _glob_closure({(i, 0) for i in range(len(self.exclude))}, self.exclude),
+            )
+        }
+
+    @staticmethod
+    def _parse(globs):
+        parsed = []
+        for glob in _str_parameter_to_list(globs):
+            # Same errors as `Path.glob`
+            if not glob:
+                raise ValueError(f"Unacceptable pattern: {glob!r}")
+            if PurePath(glob).anchor:
+                raise NotImplementedError("Non-relative patterns are unsupported")
+            parsed.append(
+                [_compile_glob_part(i) for i in PurePath(glob).parts if i != "."]
+            )
+        return parsed
+
+    def _states(self, parts):
+        if (states := self._dirs.get(parts)) is None:
+            include, exclude = self._states(parts[:-1])
+            states = self._dirs[parts] = (
+                _glob_step(include, self.include, parts[-1], True),
+                _glob_step(exclude, self.exclude, parts[-1], True),
+            )
+        return states
+
+    def dir_match(self, parts):
+        """
+        `(included, excluded, may have included files below)` for the directory `parts` by itself.
+        """
+        include, exclude = self._states(parts)
+        return (
+            any(i == len(self.include[p]) for p, i in include),
+            any(i == len(self.exclude[p]) for p, i in exclude),
+            any(i < len(self.include[p]) for p, i in include),
+        )
+
+    def file_match(self, parts):
+        """
+        `(included, excluded)` for the file `parts` by itself.
+        """
+        include, exclude = self._states(parts[:-1])
+        return (
+            any(
+                i == len(self.include[p])
+                for p, i in _glob_step(include, self.include, parts[-1], False)
+            ),
+            any(
+                i == len(self.exclude[p])
+                for p, i in _glob_step(exclude, self.exclude, parts[-1], False)
+            ),
+        )
+
+    def __call__(self, path) -> bool:
+        parts = PurePath(path).parts
+        dirs = [self.dir_match(parts[:i]) for i in range(len(parts))]
+        included, excluded = self.file_match(parts)
+        return (included or any(i[0] for i in dirs)) and not (
+            excluded or any(i[1] for i in dirs)
+        )
+
+
+def path_matcher(glob_include, glob_exclude=None) -> Callable[[str], bool]:
+    """
+    A test of whether a relative file path (which doesn't need to exist on disk) is selected by the include and
+    exclude globs the way `get_matching_file_patterns` selects files: a file is matched by a glob if the glob
+    matches the file itself or any directory it is in.
+
+    >>> match = path_matcher(["**/*.bas", "a/b"], "a/*.bas")
+    >>> [match(i) for i in ["a/x.bas", "a/b/y.cls", "z.bas", "z.cls"]]
+    [False, True, True, False]
+    """
+    return _GlobMatcher(glob_include, glob_exclude)
+
+
+def get_matching_paths(paths, glob_include, glob_exclude=None):
+    """
+    Like `get_matching_file_patterns`, but for relative file paths that don't need to exist on disk (e.g. the files
+    in a git tree). Returns the matching paths as given.
+
+    >>> sorted(get_matching_paths(["a/x.bas", "a/b/y.cls", "z.bas"], ["**/*.bas", "a/b"], "a/*.bas"))
+    ['a/b/y.cls', 'z.bas']
+    """
+    match = path_matcher(glob_include, glob_exclude)
+    return {i for i in paths if match(i)}
+
+
 def flatten_2d_list(l):
     return [item for sublist in l for item in sublist]
 
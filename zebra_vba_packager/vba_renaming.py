@@ -1,17 +1,41 @@
-import os
 from copy import deepcopy
 from textwrap import dedent
 from types import SimpleNamespace
-from typing import List
+from typing import Iterable, List, Union
 
 from .util import read_txt, write_txt
 from .exceptions import ModuleNameError
 from .match_tokens import match_tokens
-from .vba_tokenizer import tokenize, VBAToken, tokens_to_str
+from .token_cache import cached_tokenize_stream
+from .virtual_tree import VirtualTree, tree_of
+from .vba_tokenizer import (
+    tokenize,
+    token_type_codes,
+    TokenStream,
+    VBAToken,
+    tokens_to_str,
+)
 from pathlib import Path
 
 
 class NameTransformer:
+    """
+    Renames VBA names, given either a dict of case-insensitive name changes or a list of `(match, change)` rules
+    where each side is a string or a function. For a list, the first matching rule wins.
+
+    Rules in a list are compiled once: string matches go into a case-insensitive dict holding the first rule for
+    each name, and function matches are only tried if they come before that rule. The winning rule is remembered
+    for up to `_memo_entries` names.
+
+    >>> transformer = NameTransformer([("Foo", "Bar"), (lambda x: x.startswith("F"), str.upper), ("fab", "Nope")])
+    >>> [transformer.transform(i) for i in ("foo", "Fab", "fab", "Baz")]
+    ['Bar', 'FAB', 'Nope', 'Baz']
+    >>> [transformer.match(i) for i in ("foo", "Fab", "fab", "Baz")]
+    [True, False, True, False]
+    """
+
+    _memo_entries = 65536
+
     def __init__(self, name_changes):
         # force lowercase matching
         if isinstance(name_changes, dict):
@@ -22,47 +46,88 @@ class NameTransformer:
         else:
             self.name_changes = name_changes
 
+            # lowercase name -> (rule index, change) of the first string rule for that name
+            self._str_rules = {}
+            # (rule index, match, change) of the function rules, in order
+            self._func_rules = []
+            for idx, (i, j) in enumerate(name_changes):
+                if isinstance(i, str):
+                    self._str_rules.setdefault(i.lower(), (idx, j))
+                else:
+                    self._func_rules.append((idx, i, j))
+
+            # name -> (matched a string rule, change) of the winning rule, or None
+            self._memo = {}
+
+    def _rule(self, x):
+        if (rule := self._memo.get(x, False)) is not False:
+            return rule
+
+        rule, str_idx = None, float("inf")
+        if (str_rule := self._str_rules.get(x.lower())) is not None:
+            rule, str_idx = (True, str_rule[1]), str_rule[0]
+
+        for idx, i, j in self._func_rules:
+            if idx >= str_idx:
+                break
+            if i(x):
+                rule = (False, j)
+                break
+
+        if len(self._memo) >= self._memo_entries:
+            self._memo.clear()
+        self._memo[x] = rule
+        return rule
+
     def match(self, x):
         if isinstance(self.name_changes, dict):
             return x.lower() in self.name_changes
         else:
-            for i, j in self.name_changes:
-                if isinstance(i, str):
-                    if i.lower() == x.lower():
-                        return True
-                else:
-                    if i(x):
-                        return False
-        return False
+            # A name that matches a function before any string rule doesn't count as matched
+            rule = self._rule(x)
+            return rule is not None and rule[0]
 
     def transform(self, x):
         if isinstance(self.name_changes, dict):
             return self.name_changes.get(x.lower(), x)
         else:
-            for i, j in self.name_changes:
-                if isinstance(i, str):
-                    if i.lower() == x.lower():
-                        if isinstance(j, str):
-                            return j
-                        else:
-                            return j(x)
-                else:
-                    if i(x):
-                        if isinstance(j, str):
-                            return j
-                        else:
-                            return j(x)
-        return x
+            if (rule := self._rule(x)) is None:
+                return x
 
+            change = rule[1]
+            if isinstance(change, str):
+                return change
+            else:
+                return change(x)
 
-def write_tokens(fname, tokens):
-    write_txt(fname, "".join([i.text for i in tokens]).lstrip())
+
+def write_tokens(fname, tokens: Union[List[VBAToken], TokenStream, Iterable[VBAToken]]):
+    """
+    Write `tokens` to `fname` without leading whitespace. Any other iterable of tokens, e.g. from `iter_tokenize`,
+    is written as it is consumed, without joining the tokens in memory first.
+    """
+    if isinstance(tokens, (list, TokenStream)):
+        write_txt(fname, tokens_to_str(tokens).lstrip())
+        return
+
+    with open(fname, "w", encoding="latin-1") as f:
+        leading = True
+        for i in tokens:
+            text = i.text.lstrip() if leading else i.text
+            leading = leading and not text
+            f.write(text)
 
 
 def vba_directory_mapping(dirname):
+    if isinstance(dirname, VirtualTree):
+        return {
+            i: dirname.tokens(i).copy()
+            for i in dirname.paths(".bas") + dirname.paths(".cls")
+        }
+
     files_to_tokens = {}
     for i in list(Path(dirname).rglob("*.bas")) + list(Path(dirname).rglob("*.cls")):
-        files_to_tokens[i] = tokenize(read_txt(i))
+        files_to_tokens[i] = cached_tokenize_stream(read_txt(i))
 
     return files_to_tokens
 
@@ -89,6 +154,18 @@ def get_all_names(tokens: List[VBAToken]):
 
 
 def replace_all_names(tokens: List[VBAToken], name_transformer: NameTransformer):
+    if isinstance(tokens, TokenStream):
+        # Only the sparse override table gets copied
+        tokens = tokens.copy()
+        name_code = token_type_codes["name"]
+        for i, code in enumerate(tokens.types):
+            if code == name_code:
+                text = tokens.text_at(i)
+                if (new_text := name_transformer.transform(text)) != text:
+                    tokens.set_text(i, new_text)
+
+        return tokens
+
     tokens = deepcopy(tokens)
     for i, t in enumerate(tokens):
         if t.type == "name":
@@ -116,10 +193,11 @@ def cls_renaming_dict(dirname, user_name_transformer):
 
 
 def do_renaming(dirname, user_name_transformer):
-    vba_dir_map = vba_directory_mapping(dirname)
+    with tree_of(dirname) as tree:
+        vba_dir_map = vba_directory_mapping(tree)
 
-    for key, value in vba_dir_map.items():
-        write_tokens(key, replace_all_names(value, user_name_transformer))
+        for key, value in vba_dir_map.items():
+            tree.write_tokens(key, replace_all_names(value, user_name_transformer))
 
 
 def strip_bas_header(tokens):
@@ -162,43 +240,44 @@ def bas_create_namespaced_classes(dirname):
     """
     ).lstrip()
 
-    vba_dir_map = vba_directory_mapping(dirname)
+    with tree_of(dirname) as tree:
+        vba_dir_map = vba_directory_mapping(tree)
 
-    # Get the namespacing right
-    modnames = {}
-    names = {}
-    for filename, tokens in vba_dir_map.items():
-        if not str(filename).lower().endswith(".bas"):
-            continue
-
-        modnames[filename] = vba_module_name(tokens)
-        matches = match_tokens(
-            tokens, "[public] [declare] property|sub|function|enum|const .*"
-        )
-        for i, j in matches:
-            names[tokens[j - 1].text.lower()] = SimpleNamespace(
-                name=tokens[j - 1].text,
-                filename=filename,
-                modname=modnames[filename],
-            )
+        # Get the namespacing right
+        modnames = {}
+        names = {}
+        for filename, tokens in vba_dir_map.items():
+            if not str(filename).lower().endswith(".bas"):
+                continue
 
-    for filename, tokens in vba_dir_map.items():
-        for token in tokens:
-            if (
-                token.type == "name"
-                and (tname := names.get(token.text.lower(), False))
-                and tname.filename != filename
-            ):
-                token.text = f"{tname.modname}.{tname.name}"
-
-    for filename, tokens in vba_dir_map.items():
-        if str(filename).lower().endswith(".bas"):
-            modname = modnames[filename]
-
-            modname_new = f"z__{modname}"
-            modhead = tokenize(module_header.replace("__modulename__", modname_new))
-            tokens = modhead + strip_bas_header(tokens)
-
-            os.remove(filename)
-            newpath = filename.parent.joinpath(modname_new + ".cls")
-            write_tokens(newpath, tokens)
+            modnames[filename] = vba_module_name(tokens)
+            matches = match_tokens(
+                tokens, "[public] [declare] property|sub|function|enum|const .*"
+            )
+            for i, j in matches:
+                names[tokens[j - 1].text.lower()] = SimpleNamespace(
+                    name=tokens[j - 1].text,
+                    filename=filename,
+                    modname=modnames[filename],
+                )
+
+        for filename, tokens in vba_dir_map.items():
+            for token in tokens:
+                if (
+                    token.type == "name"
+                    and (tname := names.get(token.text.lower(), False))
+                    and tname.filename != filename
+                ):
+                    token.text = f"{tname.modname}.{tname.name}"
+
+        for filename, tokens in vba_dir_map.items():
+            if str(filename).lower().endswith(".bas"):
+                modname = modnames[filename]
+
+                modname_new = f"z__{modname}"
+                modhead = tokenize(module_header.replace("__modulename__", modname_new))
+                tokens = modhead + strip_bas_header(tokens)
+
+                tree.remove(filename)
+                newpath = filename.parent.joinpath(modname_new + ".cls")
+                tree.write_tokens(newpath, tokens)
@@ -1,9 +1,11 @@
+import hashlib
 import re
+from array import array
 from dataclasses import dataclass
 from functools import reduce
 import operator
-from typing import List, Tuple
-from itertools import chain
+from typing import Iterator, List, Tuple, Union
+from itertools import accumulate, chain
 
 # https://github.com/rubberduck-vba/Rubberduck/issues/3175 amended with some experimental findings of our own
 vba_names = """
@@ -68,6 +70,55 @@ whitespace_re = re.compile(r"[ \t]+")
 
 newline_re = re.compile(r"\n")
 
+# Single-pass lexer: one master regex, evaluated left to right over the source, that reproduces the token
+# boundaries of the multi-pass legacy implementation. The building blocks mirror the legacy regexes above:
+#   * a line continuation "_\n" only counts if preceded by a space or tab (see `linecont_re`)
+#   * comment/rem bodies run to the end of the logical line, i.e. across line continuations
+#   * `#end ... if` extends to the last "if" on the logical line that is not inside a string or comment
+_lc = r"(?<=[ \t])_\n"
+_ws = rf"(?:[ \t]|{_lc})"
+_body = rf"(?:[^\n_]+|{_lc}|_)*"
+_string = string_re.pattern
+_string_tail = _string[1:]
+_prefix = r"(?:(?<=[\n\t ^()&\-+*/=,.\[\]])|\A)"  # same characters as `filler_re_str`
+_hashif_end_body = (
+    rf"(?:{_string}|\"(?!{_string_tail})|{_lc}|:(?!{_ws}*rem[ \t])|[^\n\"':])*"
+)
+
+_lexer_alternatives = {
+    "remline": rf"(?:\A|(?<=\n)(?<![ \t]_\n))(?P<remws>{_ws}*)rem[ \t]{_body}",
+    "string": _string,
+    "comment": rf"(?:'|:{_ws}*rem[ \t]){_body}",
+    "hashif": rf"{_prefix}#(?:if|elseif|else|end[\t ]{_hashif_end_body}if)",
+    "space": rf"{_ws}+",
+    "name": rf"{_prefix}[a-zA-Z][a-zA-Z0-9_]*",
+    "newline": r"\n",
+}
+
+lexer_re = re.compile(
+    "|".join(f"(?P<{key}>{val})" for key, val in _lexer_alternatives.items()),
+    re.IGNORECASE,
+)
+
+_lexer_types = {
+    "string": "string",
+    "comment": "comment",
+    "hashif": "#if",
+    "space": "space",
+    "newline": "newline",
+}
+
+# A `rem` line directly following another `rem` line is not a comment (the legacy `commentrem_re` consumes the
+# newline that separates them), so such lines are lexed without the `remline` alternative.
+lexer_norem_re = re.compile(
+    "|".join(
+        f"(?P<{key}>{val})"
+        for key, val in _lexer_alternatives.items()
+        if key != "remline"
+    ),
+    re.IGNORECASE,
+)
+
 
 @dataclass
 class VBAToken:
@@ -113,12 +164,13 @@ def idx_sequencing(idxes: List[Tuple[int, int]], last):
     yield (jprev, last), False
 
 
-def tokenize(txt) -> List[VBAToken]:
+def tokenize(txt, engine: str = "lexer") -> List[VBAToken]:
     r"""
     This tokenizes VBA into tokens - it only impliments the type of tokens that we need for now, the rest are given a
     type of "unknown"
 
     :param txt: string consisting of VBA code
+    :param engine: "lexer" for the single-pass lexer, or "legacy" for the original multi-pass implementation
     :return: VBA tokens
 
     >>> vba_txt = '''Attribute VB_Name = "FileCompress" 'comment
@@ -142,8 +194,152 @@ def tokenize(txt) -> List[VBAToken]:
     >>> "".join([i.text for i in tokens]) == vba_txt
     True
 
+    >>> tokens == tokenize(vba_txt, engine="legacy")
+    True
+
+    """
+    try:
+        tokenizer = tokenizer_engines[engine]
+    except KeyError:
+        raise ValueError(
+            f"Unknown tokenizer engine {engine!r}, expected one of {list(tokenizer_engines)}"
+        )
+
+    return tokenizer(txt)
+
+
+def lexer_spans(s, rem_blocked: bool = False):
+    """
+    Yield `(i, j, type)` for every known token in `s`, in order. Unknown text is not yielded and falls in the gaps.
+
+    :param s: VBA code with "\r\n" line endings normalised and the `Attribute VB_Name` value masked out
+    :param rem_blocked: whether `s` directly follows a `rem` line, so that a `rem` line at its start isn't a comment
+    """
+    rem_blocked = 0 if rem_blocked else None
+    for m in lexer_re.finditer(s):
+        kind = m.lastgroup
+        if kind == "remline":
+            i, j = m.span()
+            if i == rem_blocked:
+                for mm in lexer_norem_re.finditer(s, i, j):
+                    yield mm.start(), mm.end(), mm.lastgroup
+                continue
+
+            k = m.end("remws")
+            if i != k:
+                yield i, k, "space"
+            yield k, j, "comment"
+            rem_blocked = j + 1
+        else:
+            yield m.start(), m.end(), kind
+
+
+def lexer_tokens(txt, attribute: bool = True, rem_blocked: bool = False):
+    """
+    Yield `(i, j, type)` for every token of `txt`, including "unknown" ones, so that the spans cover all of `txt`.
+
+    :param txt: VBA code with "\r\n" line endings already normalised to "\n"
+    :param attribute: whether the first `Attribute VB_Name` of the module may be in `txt`
+    :param rem_blocked: see `lexer_spans`
     """
+    s = txt
+
+    # Legacy hack to make xxx in 'attribute vb_name = "xxx"' a name and not a string for easier replacement
+    attr = None
+    if attribute and (m := attribname_re.search(s)):
+        attr = i, j = m.span(1)
+        s = s[: i - 1] + "·" * (j - i + 2) + s[j + 1 :]
+
+    def unknown(i, j):
+        if attr is not None and i <= attr[0] and attr[1] <= j:
+            if i != attr[0] - 1:
+                yield i, attr[0] - 1, "unknown"
+            yield attr[0] - 1, attr[0], "unknown"
+            yield attr[0], attr[1], "name"
+            i = attr[1]
+        if i != j:
+            yield i, j, "unknown"
+
+    prev = 0
+    for i, j, kind in lexer_spans(s, rem_blocked):
+        if prev != i:
+            yield from unknown(prev, i)
+
+        if kind == "name":
+            yield i, j, "reserved" if txt[i:j].lower() in vba_names_set else "name"
+        else:
+            yield i, j, _lexer_types[kind]
+        prev = j
+
+    yield from unknown(prev, len(txt))
+
+
+def tokenize_lexer(txt) -> List[VBAToken]:
+    """
+    Single-pass implementation of `tokenize`, producing the same tokens as `tokenize_legacy`.
+    """
+    txt = txt.replace("\r\n", "\n")
+    return [VBAToken(txt[i:j], type_) for i, j, type_ in lexer_tokens(txt)]
+
+
+# The end of a logical line: a newline that isn't a line continuation
+_logical_line_end_re = re.compile(r"(?<![ \t]_)\n")
+
 
+def _logical_lines(fileobj, chunk_size: int) -> Iterator[str]:
+    # Logical lines of `fileobj` with "\r\n" normalised to "\n", each including its newline
+    pending = ""
+    carry = ""  # a "\r" that may be the start of a "\r\n" split between chunks
+    while chunk := fileobj.read(chunk_size):
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode("latin-1")
+        chunk = carry + chunk
+        carry = "\r" if chunk.endswith("\r") else ""
+
+        scanned = len(pending)
+        pending += chunk[: len(chunk) - len(carry)].replace("\r\n", "\n")
+        start = 0
+        for m in _logical_line_end_re.finditer(pending, scanned):
+            yield pending[start : m.end()]
+            start = m.end()
+        pending = pending[start:]
+
+    if pending := pending + carry:
+        yield pending
+
+
+def iter_tokenize(fileobj, chunk_size: int = 1 << 16) -> Iterator[VBAToken]:
+    r"""
+    Like `tokenize`, but read the VBA code from `fileobj` (text, or bytes that are decoded as latin-1) and yield the
+    tokens one logical line at a time, so that memory use is bounded by the longest line rather than the module.
+
+    >>> import io
+    >>> vba_txt = 'Attribute VB_Name = "Lookup"\r\nPublic Const A = 1 _\r\n    + 2 \' comment\r\n'
+    >>> tokens = iter_tokenize(io.StringIO(vba_txt), chunk_size=8)
+    >>> next(tokens)
+    VBAToken(text='Attribute', type='reserved')
+    >>> [next(tokens)] + list(tokens) == tokenize(vba_txt)[1:]
+    True
+    """
+    attribute = True
+    rem_blocked = False
+    for line in _logical_lines(fileobj, chunk_size):
+        # Consecutive `rem` lines alternate between being comments and not (see `lexer_norem_re`)
+        starts_with_rem = (
+            not rem_blocked and (m := lexer_re.match(line)) and m.lastgroup == "remline"
+        )
+
+        for i, j, type_ in lexer_tokens(line, attribute, rem_blocked):
+            yield VBAToken(line[i:j], type_)
+
+        attribute = attribute and not attribname_re.search(line)
+        rem_blocked = bool(starts_with_rem)
+
+
+def tokenize_legacy(txt) -> List[VBAToken]:
+    """
+    Original multi-pass implementation of `tokenize`, kept as a reference to verify the lexer against.
+    """
     idxmap = {}
     txt = txt.replace("\r\n", "\n")
     lower = txt.lower()
@@ -195,5 +391,323 @@ def tokenize(txt) -> List[VBAToken]:
     return tokens
 
 
-def tokens_to_str(tokens: List[VBAToken]) -> str:
+tokenizer_engines = {
+    "lexer": tokenize_lexer,
+    "legacy": tokenize_legacy,
+}
+
+
+# Type codes used by `TokenStream.types`
+token_types = (
+    "unknown",
+    "name",
+    "reserved",
+    "string",
+    "comment",
+    "#if",
+    "space",
+    "newline",
+)
+token_type_codes = {type_: code for code, type_ in enumerate(token_types)}
+
+# Identifies the lexer's output format, e.g. for keying persisted token streams. Bump `_lexer_revision` when
+# changing the lexer's logic; changes to its regexes, token types or reserved names are picked up automatically.
+_lexer_revision = 1
+tokenizer_version = hashlib.md5(
+    "\n".join(
+        [
+            str(_lexer_revision),
+            lexer_re.pattern,
+            lexer_norem_re.pattern,
+            attribname_re.pattern,
+            *token_types,
+            *vba_names,
+        ]
+    ).encode("utf-8")
+).hexdigest()[:12]
+
+
+class TokenStream:
+    r"""
+    Compact, list-like sequence of VBA tokens.
+
+    Tokens are stored as parallel arrays (type code, start and end offset into `source`) instead of one `VBAToken`
+    per token. Rewritten token text lives in the sparse `overrides` table, so copying a stream only copies that
+    table; the arrays and `source` are shared and never modified in place. Tokens are always contiguous, i.e.
+    `ends[i] == starts[i + 1]`.
+
+    Indexing and iteration yield `TokenView` objects, which behave like `VBAToken` and write `.text` changes back
+    into the stream. `texts()` and `type_names()` are cached on first use for callers that scan the stream many
+    times, and the caches are shared with slices of the stream.
+
+    >>> tokens = tokenize_stream('Attribute VB_Name = "Foo"\nDim x As Long')
+    >>> len(tokens) == len(tokenize('Attribute VB_Name = "Foo"\nDim x As Long'))
+    True
+    >>> [i.text for i in tokens if i.type == "name"]
+    ['Foo', 'x']
+    >>> copied = tokens.copy()
+    >>> copied[-5].text = "y"
+    >>> tokens_to_str(copied)
+    'Attribute VB_Name = "Foo"\nDim y As Long'
+    >>> tokens_to_str(tokens[-5:])
+    'x As Long'
+    """
+
+    __slots__ = ("source", "types", "starts", "ends", "overrides", "_texts", "_names")
+
+    def __init__(
+        self,
+        source: str = "",
+        types: array = None,
+        starts: array = None,
+        ends: array = None,
+        overrides: dict = None,
+    ):
+        self.source = source
+        self.types = array("B") if types is None else types
+        self.starts = array("q") if starts is None else starts
+        self.ends = array("q") if ends is None else ends
+        self.overrides = {} if overrides is None else overrides
+        self._texts = None
+        self._names = None
+
+    @classmethod
+    def from_tokens(cls, tokens: List[VBAToken]) -> "TokenStream":
+        if isinstance(tokens, TokenStream):
+            return tokens.copy()
+
+        texts = [i.text for i in tokens]
+        ends = array("q", accumulate(len(i) for i in texts))
+        return cls(
+            "".join(texts),
+            array("B", (token_type_codes[i.type] for i in tokens)),
+            array("q", chain([0], ends[:-1])) if texts else array("q"),
+            ends,
+        )
+
+    def __len__(self):
+        return len(self.types)
+
+    def _index(self, i: int) -> int:
+        n = len(self.types)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("TokenStream index out of range")
+        return i
+
+    def text_at(self, i: int) -> str:
+        if self.overrides:
+            text = self.overrides.get(i if i >= 0 else i + len(self.types))
+            if text is not None:
+                return text
+        return self.source[self.starts[i] : self.ends[i]]
+
+    def texts(self) -> List[str]:
+        """
+        Text of every token. The returned list is cached and must not be modified.
+        """
+        if self._texts is None:
+            source = self.source
+            self._texts = [source[i:j] for i, j in zip(self.starts, self.ends)]
+            for i, text in self.overrides.items():
+                self._texts[i] = text
+        return self._texts
+
+    def type_names(self) -> List[str]:
+        """
+        Type of every token. The returned list is cached and must not be modified.
+        """
+        if self._names is None:
+            self._names = [token_types[i] for i in self.types]
+        return self._names
+
+    def type_at(self, i: int) -> str:
+        return token_types[self.types[i]]
+
+    def set_text(self, i: int, text: str):
+        i = self._index(i)
+        self.overrides[i] = text
+        if self._texts is not None:
+            self._texts[i] = text
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self.types))
+            if step != 1:
+                return TokenStream.from_tokens(
+                    [self[i] for i in range(start, stop, step)]
+                )
+
+            sliced = TokenStream(
+                self.source,
+                self.types[start:stop],
+                self.starts[start:stop],
+                self.ends[start:stop],
+                {
+                    key - start: val
+                    for key, val in self.overrides.items()
+                    if start <= key < stop
+                },
+            )
+            if self._texts is not None:
+                sliced._texts = self._texts[start:stop]
+            if self._names is not None:
+                sliced._names = self._names[start:stop]
+            return sliced
+
+        return TokenView(self, self._index(idx))
+
+    def __iter__(self):
+        for i in range(len(self.types)):
+            yield TokenView(self, i)
+
+    def __add__(self, other):
+        if isinstance(other, list):
+            other = TokenStream.from_tokens(other)
+        if not isinstance(other, TokenStream):
+            return NotImplemented
+
+        a, b = self._compact(), other._compact()
+        offset = len(a.source)
+        return TokenStream(
+            a.source + b.source,
+            a.types + b.types,
+            a.starts + array("q", (i + offset for i in b.starts)),
+            a.ends + array("q", (i + offset for i in b.ends)),
+            {**a.overrides, **{key + len(a): val for key, val in b.overrides.items()}},
+        )
+
+    def __radd__(self, other):
+        if isinstance(other, list):
+            return TokenStream.from_tokens(other) + self
+        return NotImplemented
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, TokenStream)) or len(other) != len(self):
+            return False
+        return all(i == j for i, j in zip(self, other))
+
+    def __repr__(self):
+        return f"TokenStream({self.to_list()!r})"
+
+    def _compact(self) -> "TokenStream":
+        """
+        Return a stream whose `source` only spans its own tokens, with offsets starting at 0.
+        """
+        if not self.types or (
+            self.starts[0] == 0 and self.ends[-1] == len(self.source)
+        ):
+            return self
+
+        lo, hi = self.starts[0], self.ends[-1]
+        return TokenStream(
+            self.source[lo:hi],
+            self.types,
+            array("q", (i - lo for i in self.starts)),
+            array("q", (i - lo for i in self.ends)),
+            self.overrides,
+        )
+
+    def copy(self) -> "TokenStream":
+        copied = TokenStream(
+            self.source, self.types, self.starts, self.ends, dict(self.overrides)
+        )
+        copied._names = self._names
+        return copied
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def __reduce__(self):
+        # The text/type caches are rebuilt on demand rather than pickled
+        return TokenStream, (
+            self.source,
+            self.types,
+            self.starts,
+            self.ends,
+            self.overrides,
+        )
+
+    def to_list(self) -> List[VBAToken]:
+        return [VBAToken(self.text_at(i), self.type_at(i)) for i in range(len(self))]
+
+    def to_str(self) -> str:
+        if not self.types:
+            return ""
+
+        parts = []
+        pos = self.starts[0]
+        for i in sorted(self.overrides):
+            parts.append(self.source[pos : self.starts[i]])
+            parts.append(self.overrides[i])
+            pos = self.ends[i]
+        parts.append(self.source[pos : self.ends[-1]])
+
+        return "".join(parts)
+
+
+class TokenView:
+    """
+    A single token inside a `TokenStream`, with the same `text`/`type` interface as `VBAToken`.
+    """
+
+    __slots__ = ("stream", "index")
+
+    def __init__(self, stream: TokenStream, index: int):
+        self.stream = stream
+        self.index = index
+
+    @property
+    def text(self) -> str:
+        return self.stream.text_at(self.index)
+
+    @text.setter
+    def text(self, text: str):
+        self.stream.set_text(self.index, text)
+
+    @property
+    def type(self) -> str:
+        return self.stream.type_at(self.index)
+
+    def __eq__(self, other):
+        if isinstance(other, (VBAToken, TokenView)):
+            return self.text == other.text and self.type == other.type
+        return NotImplemented
+
+    def __repr__(self):
+        return f"VBAToken(text={self.text!r}, type={self.type!r})"
+
+
+def tokenize_stream(txt) -> TokenStream:
+    """
+    Like `tokenize`, but return a compact `TokenStream` instead of a list of `VBAToken` objects.
+    """
+    txt = txt.replace("\r\n", "\n")
+    types, starts, ends = array("B"), array("q"), array("q")
+    for i, j, type_ in lexer_tokens(txt):
+        types.append(token_type_codes[type_])
+        starts.append(i)
+        ends.append(j)
+
+    return TokenStream(txt, types, starts, ends)
+
+
+def token_texts(tokens: Union[List[VBAToken], TokenStream]) -> List[str]:
+    if isinstance(tokens, TokenStream):
+        return tokens.texts()
+    return [i.text for i in tokens]
+
+
+def token_type_names(tokens: Union[List[VBAToken], TokenStream]) -> List[str]:
+    if isinstance(tokens, TokenStream):
+        return tokens.type_names()
+    return [i.type for i in tokens]
+
+
+def tokens_to_str(tokens: Union[List[VBAToken], TokenStream]) -> str:
+    if isinstance(tokens, TokenStream):
+        return tokens.to_str()
     return "".join([i.text for i in tokens])
@@ -0,0 +1,432 @@
+import hashlib
+import io
+import os
+import re
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Union
+
+from .artifact_store import is_linked, link_file
+from .instrumentation import count
+from .token_cache import cached_tokenize_stream
+from .util import read_txt, write_txt
+from .vba_tokenizer import (
+    TokenStream,
+    VBAToken,
+    token_type_codes,
+    tokens_to_str,
+    vba_names_set,
+)
+
+_identifier_re = re.compile(r"[a-zA-Z][a-zA-Z0-9_]*")
+
+
+class VirtualFile:
+    """
+    A file inside a `VirtualTree`. The content is read lazily from `origin` and afterwards kept as text or as
+    tokens, whichever was written last; the other form is derived on demand.
+    """
+
+    __slots__ = ("origin", "dirty", "_text", "_tokens", "_data")
+
+    def __init__(self, origin: Union[str, Path, None] = None, text: str = None):
+        self.origin = None if origin is None else Path(origin)
+        self.dirty = origin is None
+        self._text = text
+        self._tokens = None
+        self._data = None
+
+    @classmethod
+    def from_data(cls, data: bytes) -> "VirtualFile":
+        """
+        An unchanged file with the given content, which doesn't exist on disk.
+        """
+        file = cls()
+        file.dirty = False
+        file._data = data
+        return file
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            if self._tokens is not None:
+                self._text = tokens_to_str(self._tokens)
+            elif self._data is not None:
+                # Decoded the same way as `read_txt`, including newline translation
+                self._text = io.TextIOWrapper(
+                    io.BytesIO(self._data), encoding="latin-1"
+                ).read()
+            else:
+                self._text = read_txt(self.origin)
+                count(bytes_read=len(self._text))
+        return self._text
+
+    @text.setter
+    def text(self, text: str):
+        self._text = text
+        self._tokens = None
+        self.dirty = True
+
+    @property
+    def tokens(self) -> TokenStream:
+        """
+        The tokens of the file. The stream is shared, so `.copy()` it before rewriting any token text.
+        """
+        if self._tokens is None:
+            self._tokens = cached_tokenize_stream(self.text)
+        return self._tokens
+
+    @tokens.setter
+    def tokens(self, tokens: Union[List[VBAToken], TokenStream]):
+        if self._same_token_boundaries(tokens):
+            self._text = None
+            self._tokens = tokens
+            self.dirty = True
+        else:
+            self.text = tokens_to_str(tokens)
+
+    def _same_token_boundaries(self, tokens) -> bool:
+        # A copy of this file's own stream where names were only renamed to other plain names tokenizes back to the
+        # same stream, so it can be kept as is. Anything else (e.g. names rewritten to "Module.Name") is stored as
+        # text and tokenized again when needed.
+        if not (
+            isinstance(tokens, TokenStream)
+            and self._tokens is not None
+            and tokens.starts is self._tokens.starts
+        ):
+            return False
+
+        name_code = token_type_codes["name"]
+        return all(
+            tokens.types[i] == name_code
+            and _identifier_re.fullmatch(text)
+            and text.lower() not in vba_names_set
+            for i, text in tokens.overrides.items()
+        )
+
+    def copy(self) -> "VirtualFile":
+        copied = VirtualFile(self.origin, self._text)
+        copied._tokens = self._tokens
+        copied._data = self._data
+        copied.dirty = self.dirty
+        return copied
+
+    def detach(self):
+        """
+        Keep the unchanged content of `origin` in memory, so that the file no longer depends on it.
+        """
+        if not self.dirty and self._data is None:
+            self._data = self.origin.read_bytes()
+            count(bytes_read=len(self._data))
+
+    @property
+    def data(self) -> bytes:
+        """
+        The content as it is written to disk.
+        """
+        if self.dirty:
+            return self.text.replace("\n", os.linesep).encode("latin-1")
+        if self._data is not None:
+            return self._data
+        data = self.origin.read_bytes()
+        count(bytes_read=len(data))
+        return data
+
+    def digest(self) -> str:
+        return hashlib.md5(self.data).hexdigest()
+
+    def write(
+        self,
+        path: Union[str, Path],
+        only_changed: bool = False,
+        hard_link: bool = False,
+    ):
+        """
+        Write the file to `path`; content that was never changed is linked from `origin` (see
+        `artifact_store.link_file`), or copied byte for byte. With `only_changed=True`, a file at `path` that already
+        has the same content is left alone. A file at `path` that shares its data with other paths is replaced
+        rather than written to, so the other paths keep their content.
+        """
+        path = Path(path)
+        if (
+            not self.dirty
+            and self._data is None
+            and os.path.abspath(self.origin) == os.path.abspath(path)
+        ):
+            return
+
+        if only_changed and path.is_file() and path.read_bytes() == self.data:
+            return
+
+        os.makedirs(path.parent, exist_ok=True)
+        if not self.dirty and self._data is None:
+            link_file(self.origin, path, hard_link)
+            return
+
+        if is_linked(path):
+            os.remove(path)
+        if self.dirty:
+            write_txt(path, self.text)
+            count(bytes_written=len(self.text))
+        else:
+            path.write_bytes(self._data)
+            count(bytes_written=len(self._data))
+
+
+@dataclass
+class TreeChanges:
+    """
+    What `VirtualTree.sync_to` did to a directory, as paths relative to it.
+    """
+
+    added: List[Path] = field(default_factory=list)
+    changed: List[Path] = field(default_factory=list)
+    removed: List[Path] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+
+def _listing_key(path: Path):
+    # Windows lists directory entries in case-insensitive (upper case) order, files of a directory before those of
+    # its subdirectories when walking
+    return [i.upper() for i in path.parent.parts], path.name.upper()
+
+
+def _sorted_key(path: Path):
+    # `sorted()` of Windows paths compares the lower case parts
+    return [i.lower() for i in path.parts]
+
+
+class VirtualTree:
+    """
+    In-memory stand-in for a directory of source files, mapping relative paths to `VirtualFile` objects.
+
+    Processing stages read and write `text`/`tokens` of the files without touching the disk; `write_to` puts the
+    result on disk. Wherever a directory listing would decide the order, files are visited in the order Windows
+    lists them, so results don't depend on the platform.
+
+    >>> tree = VirtualTree()
+    >>> tree.write_text("b/Mod.bas", 'Attribute VB_Name = "Mod"\\n')
+    >>> tree.write_text("A.cls", 'Attribute VB_Name = "A"\\n')
+    >>> tree.rename("b/Mod.bas", "b/Mod2.bas")
+    >>> [str(i.as_posix()) for i in tree.paths(".bas", ".cls")]
+    ['A.cls', 'b/Mod2.bas']
+    >>> [i.text for i in tree.tokens("A.cls") if i.type == "name"]
+    ['A']
+    """
+
+    def __init__(self):
+        self.files: Dict[Path, VirtualFile] = {}
+        # Keyed on the exact string, since a case-only rename still has to delete the old name on Windows
+        self.removed: Dict[str, Path] = {}
+
+    @classmethod
+    def from_files(cls, root: Union[str, Path], files) -> "VirtualTree":
+        """
+        A tree with the given files under `root`, keyed on their path relative to `root`. Nothing is read yet.
+        """
+        tree = cls()
+        root = Path(root).resolve()
+        for i in files:
+            tree.files[Path(i).resolve().relative_to(root)] = VirtualFile(i)
+
+        return tree
+
+    @classmethod
+    def from_data(cls, files: Dict[str, bytes]) -> "VirtualTree":
+        """
+        A tree with the given file contents, keyed on their relative path.
+        """
+        tree = cls()
+        for i, data in files.items():
+            tree.files[Path(i)] = VirtualFile.from_data(data)
+
+        return tree
+
+    @classmethod
+    def from_dir(cls, root: Union[str, Path]) -> "VirtualTree":
+        return cls.from_files(root, [i for i in Path(root).rglob("*") if i.is_file()])
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, path):
+        return Path(path) in self.files
+
+    def __getitem__(self, path) -> VirtualFile:
+        return self.files[Path(path)]
+
+    def __iter__(self) -> Iterator[Path]:
+        return iter(self.paths())
+
+    def paths(self, *suffixes: str, sort: bool = False) -> List[Path]:
+        """
+        Relative paths of the files, optionally only those ending with one of `suffixes` (case-insensitive). The
+        order is that of a Windows directory walk, or that of `sorted()` on Windows paths with `sort=True`.
+        """
+        suffixes = tuple(i.lower() for i in suffixes)
+        return sorted(
+            (
+                i
+                for i in self.files
+                if not suffixes or str(i).lower().endswith(suffixes)
+            ),
+            key=_sorted_key if sort else _listing_key,
+        )
+
+    def add(self, path, file: VirtualFile):
+        path = Path(path)
+        self.files[path] = file
+        self.removed.pop(str(path), None)
+
+    def remove(self, path):
+        path = Path(path)
+        del self.files[path]
+        self.removed[str(path)] = path
+
+    def rename(self, src, dst):
+        """
+        Move a file; it is rewritten from its text, since `src` may be the same file as `dst` on a case-insensitive
+        file system.
+        """
+        file = self.files[Path(src)]
+        file.text = file.text
+        self.remove(src)
+        self.add(dst, file)
+
+    def detach(self):
+        """
+        Read all files that still refer to their origin into memory, so that the directories they came from can be
+        changed or removed.
+        """
+        for file in self.files.values():
+            file.detach()
+
+    def read_text(self, path) -> str:
+        return self[path].text
+
+    def write_text(self, path, txt: str):
+        if (path := Path(path)) in self.files:
+            self.files[path].text = txt
+        else:
+            self.add(path, VirtualFile(text=txt))
+
+    def tokens(self, path) -> TokenStream:
+        return self[path].tokens
+
+    def write_tokens(self, path, tokens: Union[List[VBAToken], TokenStream]):
+        """
+        Like `vba_renaming.write_tokens`, leading whitespace of the file is dropped.
+        """
+        if len(tokens) and tokens[0].text[:1].isspace():
+            self.write_text(path, tokens_to_str(tokens).lstrip())
+        elif (path := Path(path)) in self.files:
+            self.files[path].tokens = tokens
+        else:
+            self.add(path, VirtualFile(text=tokens_to_str(tokens)))
+
+    def write_to(
+        self,
+        root: Union[str, Path],
+        clean: bool = False,
+        only_changed: bool = False,
+        hard_link: bool = False,
+    ):
+        """
+        Write the tree under `root`: files removed from the tree are deleted, changed and added files are written,
+        and files that still live unchanged at their original location under `root` are left alone. With
+        `clean=True`, any other file under `root` is deleted as well, and with `only_changed=True` files under
+        `root` that already have the right content aren't rewritten. Unchanged files are reflinked from their
+        origin where the file system supports it, and with `hard_link=True` (only for directories that nobody
+        edits in place) hard linked otherwise.
+        """
+        root = Path(root)
+        for path in self.removed.values():
+            if (dst := root.joinpath(path)).is_file():
+                os.remove(dst)
+
+        for path, file in self.files.items():
+            file.write(root.joinpath(path), only_changed, hard_link)
+
+        if clean:
+            for i in [i for i in root.rglob("*") if i.is_file()]:
+                if i.relative_to(root) not in self.files:
+                    os.remove(i)
+
+    def sync_to(self, root: Union[str, Path]) -> TreeChanges:
+        """
+        Make the directory `root` hold exactly the files of the tree, touching only what differs: files that
+        already have the right content are left alone (keeping their modification time), other files are written,
+        and files and emptied directories that aren't part of the tree are deleted.
+
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tdir:
+        ...     tree = VirtualTree()
+        ...     tree.write_text("A.bas", "a")
+        ...     tree.write_text("B.bas", "b")
+        ...     _ = tree.sync_to(tdir)
+        ...     tree.write_text("B.bas", "changed")
+        ...     tree.remove("A.bas")
+        ...     tree.write_text("C.bas", "c")
+        ...     changes = tree.sync_to(tdir)
+        >>> [[str(i) for i in j] for j in (changes.added, changes.changed, changes.removed)]
+        [['C.bas'], ['B.bas'], ['A.bas']]
+        """
+        root = Path(root)
+        changes = TreeChanges()
+        os.makedirs(root, exist_ok=True)
+
+        # Compared on the exact name, so that a file whose name only changes in case is renamed on Windows too
+        names = {str(i) for i in self.files}
+        for directory, dirs, files in os.walk(root, topdown=False):
+            for i in files:
+                path = Path(directory, i)
+                if str(path.relative_to(root)) not in names:
+                    os.remove(path)
+                    changes.removed.append(path.relative_to(root))
+            for i in dirs:
+                try:
+                    os.rmdir(Path(directory, i))
+                except OSError:
+                    # Not empty
+                    pass
+
+        for path in self.paths():
+            file, dst = self.files[path], root.joinpath(path)
+            if not dst.is_file():
+                changes.added.append(path)
+            elif _same_content(file, dst):
+                continue
+            else:
+                changes.changed.append(path)
+            file.write(dst)
+
+        changes.removed.sort(key=_listing_key)
+        return changes
+
+
+def _same_content(file: VirtualFile, path: Path) -> bool:
+    if not file.dirty and file.origin is not None and file._data is None:
+        try:
+            if os.path.samefile(file.origin, path):
+                return True
+        except OSError:
+            pass
+
+    data = file.data
+    return path.stat().st_size == len(data) and path.read_bytes() == data
+
+
+@contextmanager
+def tree_of(path_or_tree: Union[str, Path, VirtualTree]):
+    """
+    Work on a `VirtualTree` as is, or on a directory loaded into one and written back afterwards.
+    """
+    if isinstance(path_or_tree, VirtualTree):
+        yield path_or_tree
+    else:
+        tree = VirtualTree.from_dir(path_or_tree)
+        yield tree
+        tree.write_to(path_or_tree)
@@ -1,9 +1,8 @@
 import os
-import shutil
+import pickle
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from copy import deepcopy
 
-from download import download
-
 from .fix_repo_history_comment import fix_repo_history_comment, add_repo_history_comment
 from . import util
 from .fix_module_name_length_limitation import (
@@ -11,18 +10,27 @@ from .fix_module_name_length_limitation import (
     fix_module_name_length_limitation,
 )
 from .bas_combining import compile_bas_sources_into_single_file
-from .downloader import git_download
-from .util import file_md5, first
+from .artifact_store import (
+    artifact_store_eviction_interval,
+    evict_artifact_store,
+    link_file,
+    link_tree,
+    stored_tree,
+    zebra_temp_dir,
+)
+from .downloader import git_export, git_tree, url_artifact
+from .util import first
 from .vba_renaming import (
     NameTransformer,
     cls_renaming_dict,
     do_renaming,
     bas_create_namespaced_classes,
     vba_module_name,
-    write_tokens,
 )
-import inspect
-from typing import Union, List, Dict, Callable, Tuple
+import sys
+from functools import lru_cache
+from types import FrameType
+from typing import Union, List, Dict, Callable, Iterable, Optional, Tuple
 
 from dataclasses import dataclass
 
@@ -34,25 +42,44 @@ import tempfile
 
 from pathvalidate import sanitize_filename
 
-from .py7z import unpack
-from .vba_tokenizer import tokenize
+from .token_cache import cached_tokenize_stream, evict_token_cache
 from .fix_casing import fix_casing
+from .virtual_tree import TreeChanges, VirtualTree
+from .incremental import (
+    settings_fingerprint,
+    source_fingerprint,
+    load_transformed,
+    store_transformed,
+)
+from .extraction import archive_suffixes, extract_archive
+from .instrumentation import Span, count, emit, observe, run_recorded, span
 
 
 def strhash(x):
     return hashlib.md5(x.encode("utf-8")).hexdigest()
 
 
-def caller_path(frame_info: inspect.FrameInfo):
-    if (path := frame_info.frame.f_globals.get("__file__", None)) is not None:
-        return Path(os.path.abspath(path)).resolve()
+@lru_cache(maxsize=None)
+def _resolved_path(path: str) -> Path:
+    return Path(path).resolve()
+
 
+def caller_path(frame: FrameType) -> Optional[Path]:
+    """
+    Path of the script that the code of `frame` (e.g. `sys._getframe(1)`) belongs to, if it has one.
+    """
+    if (path := frame.f_globals.get("__file__", None)) is not None:
+        return _resolved_path(os.path.abspath(path))
 
-def caller_id(frame_info: inspect.FrameInfo):
-    if callpath := caller_path(frame_info) is None:
+
+def caller_id(frame: FrameType) -> str:
+    """
+    Identifies the line of code of `frame`; random for code that isn't in a file.
+    """
+    if (callpath := caller_path(frame)) is None:
         callpath = uuid.uuid4()
 
-    return strhash(f"{callpath}@{frame_info.frame.f_lineno}")
+    return strhash(f"{callpath}@{frame.f_lineno}")
 
 
 @dataclass(init=True)
@@ -62,13 +89,16 @@ class Source:
     git_source: str = None
     git_rev: str = None
     git_add_version_comment: bool = None
+    git_export: bool = False
 
     url_source: str = None
     url_md5: str = None
+    url_sha256: str = None
 
     path_source: Union[str, Path] = None
 
     glob_extract: Union[str, List[str]] = None
+    glob_extract_depth: int = 8
     glob_include: Union[str, List[str]] = "**/*"
     glob_exclude: Union[str, List[str]] = None
 
@@ -101,9 +131,11 @@ class Source:
                 "Not more than one of git_source/url_source/path_source may be filled in"
             )
 
+        # The code that constructs the source, outside of the dataclass `__init__`
         # noinspection PyProtectedMember
-        self.caller_path = caller_path(inspect.stack()[2])
-        self.caller_id = caller_id(inspect.stack()[2])
+        frame = sys._getframe(2)
+        self.caller_path = caller_path(frame)
+        self.caller_id = caller_id(frame)
         self.uid = str(uuid.uuid4())[:8]
 
         link = [
@@ -111,6 +143,7 @@ class Source:
             for i in (self.git_source, self.url_source, self.path_source, self.uid)
             if i is not None
         ][0]
+        self._label = str(link)
         fname = sanitize_filename(
             str(link).replace("\\", "/").rstrip("/").split("/")[-1]
         )
@@ -126,164 +159,414 @@ class Source:
             + fname,
         )
 
-        self.temp_transformed = self.temp_downloads.parent.joinpath(
+        self._temp_transformed = self.temp_downloads.parent.joinpath(
             self.temp_downloads.name + "-transformed"
         )
-        if self.url_source:
-            self.temp_downloads_file = Path(str(self.temp_downloads) + "-file-download")
-            util.dir_touch(self.temp_downloads_file)
+        self._tree = None
+        self._tree_written = False
+        self._incremental_dir = None
+        self._fingerprint = None
+        self._reused = False
+
+    @property
+    def temp_transformed(self) -> Path:
+        """
+        Directory with the transformed files of this source. `Config.run` keeps these files in memory and only
+        writes them here once this is accessed, e.g. from a `mid_process` or `post_process` hook.
+        """
+        os.makedirs(self._temp_transformed, exist_ok=True)
+        if self._tree is not None and not self._tree_written:
+            self._tree.write_to(self._temp_transformed, clean=True)
+            self._tree_written = True
+
+        return self._temp_transformed
+
+    def _transform_options(self) -> dict:
+        return dict(
+            rename_overwrites=self.rename_overwrites,
+            auto_cls_rename=self.auto_cls_rename,
+            combine_bas_files=self.combine_bas_files,
+            auto_bas_namespace=self.auto_bas_namespace,
+            git_add_version_comment=self.git_add_version_comment,
+            git_source=self.git_source,
+            git_rev=self.git_rev,
+        )
+
+    def _set_transformed(self, tree: VirtualTree):
+        self._tree = tree
+        if self._fingerprint is not None and not self._reused:
+            with span("store_incremental", self._label):
+                store_transformed(self._incremental_dir, self._fingerprint, tree)
+
+    def _run_hook(self, hook: Callable):
+        self._tree_written = False
+        hook(self)
+
+        # The hook saw (and may have changed) the files on disk
+        if self._tree_written:
+            self._tree = VirtualTree.from_dir(self._temp_transformed)
+            self._tree.detach()
+            self._tree_written = False
+
+
+def _transform_tree(
+    tree: VirtualTree,
+    rename_overwrites=None,
+    auto_cls_rename=True,
+    combine_bas_files=False,
+    auto_bas_namespace=True,
+    git_add_version_comment=None,
+    git_source=None,
+    git_rev=None,
+) -> VirtualTree:
+    """
+    Renaming, bas combining, namespacing and history comments of a single source. All arguments are picklable
+    (unless `rename_overwrites` holds lambdas), so that `Config.run` can run this on a process pool.
+    """
+    renames = deepcopy(rename_overwrites)
+    if renames is None:
+        renames = {}
+
+    # Do variable renaming
+    with span("rename"):
+        count(files=len(tree))
+        rename_transform = NameTransformer(renames)
+
+        if auto_cls_rename:
+            d = cls_renaming_dict(tree, rename_transform)
+
+            if isinstance(renames, dict):
+                renames.update(d)
+            else:
+                renames = list(renames) + [(i, j) for (i, j) in d.items()]
+
+            rename_transform = NameTransformer(renames)
+
+        do_renaming(tree, rename_transform)
+
+    if combine_bas_files:
+        with span("combine"):
+            name = combine_bas_files if isinstance(combine_bas_files, str) else None
+            sources = {}
+            for f in tree.paths(".bas"):
+                sources[f] = tree.read_text(f)
+            count(files=len(sources))
+
+            if len(sources):
+                txt = compile_bas_sources_into_single_file(sources, module_name=name)
+                for i in sources:
+                    tree.remove(i)
+
+                tree.write_text(first(sources), txt)
+
+    if auto_bas_namespace:
+        with span("namespace"):
+            count(files=len(tree.paths(".bas")))
+            bas_create_namespaced_classes(tree)
+
+    if git_add_version_comment or git_add_version_comment is None:
+        with span("history_comment"):
+            fix_repo_history_comment(tree)
+            if git_source is not None:
+                add_repo_history_comment(tree, git_source, str(git_rev))
+
+    return tree
 
-        util.dir_touch(self.temp_downloads)
-        util.dir_touch(self.temp_transformed)
+
+def _transform_source(label: str, tree: VirtualTree, options: dict) -> VirtualTree:
+    with span("transform", label):
+        return _transform_tree(tree, **options)
 
 
 class Config:
     def __init__(self, *sources, casing=None, casing_overwrites=None):
         # noinspection PyProtectedMember
-        self.caller_path = caller_path(inspect.stack()[1])
-        self.caller_id = caller_id(inspect.stack()[1])
+        frame = sys._getframe(1)
+        self.caller_path = caller_path(frame)
+        self.caller_id = caller_id(frame)
         self.sources = sources
         self.output_dir = None
         self.casing = casing
         self.casing_overwrites = casing_overwrites
 
-    def run(self, output_dir=None):
-        util.delete_old_files_in_tempdir()
+    def run(
+        self,
+        output_dir=None,
+        workers: int = None,
+        incremental: bool = False,
+        observers: Iterable[Callable[[Span], None]] = (),
+    ) -> TreeChanges:
+        """
+        Package the sources into `output_dir`. Only the files of `output_dir` that differ from the packaged result
+        are written or deleted; files that stay the same keep their modification time.
+
+        Args:
+            output_dir: Output directory, defaults to a directory under %temp%/zebra-vba-packager.
+            workers: Process up to this many sources concurrently. Downloads, git operations and the `pre_process`
+                and `mid_process` hooks run on a thread pool, and the renaming/combining on a process pool. The
+                output doesn't depend on the order in which sources finish. As with any multiprocessing code, the
+                calling script must then guard this call with `if __name__ == "__main__":` on Windows.
+            incremental: Reuse the transformed files of sources whose inputs (selected files, settings and packager
+                version) didn't change since the previous incremental run. Sources with functions in
+                `rename_overwrites` are always rebuilt.
+            observers: Called with each `instrumentation.Span` when a stage of the run finishes, e.g. a
+                `SpanRecorder` for a summary table or a Chrome trace. Stages of different sources may overlap when
+                `workers` is more than one.
+
+        Returns:
+            The files that were added to, changed in and removed from `output_dir`.
+        """
+        with observe(*observers), span("run"):
+            return self._run(output_dir, workers, incremental)
+
+    def _run(self, output_dir, workers: int, incremental: bool) -> TreeChanges:
+        # Sources sharing a download directory each keep their own incremental results
+        counts = {}
         for source in self.sources:
-            if source.pre_process is not None:
-                source.pre_process(source)
-
-            ltype, link = [
-                (i, j)
-                for (i, j) in {
-                    "git": source.git_source,
-                    "url": source.url_source,
-                    "path": source.path_source,
-                }.items()
-                if j is not None
-            ][0]
-
-            # Get the files from the sources
-            if ltype == "git":
-                git_download(link, source.temp_downloads, source.git_rev)
-
-            elif ltype == "url":
-                # Archive sensitive unpacking
-                is_archive = [
-                    True
-                    for i in [".zip", ".tar", ".7z", ".gz"]
-                    if str(source.temp_downloads.name).lower().endswith(i)
-                ]
-
-                dlfile = source.temp_downloads_file.joinpath(source.temp_downloads.name)
-
-                if not (dlfile.is_file() and file_md5(dlfile) == source.url_md5):
-                    download(link, dlfile, replace=True)
-                    if dlfile.is_file():
-                        print(f"MD5 {file_md5(dlfile)} for link {link}")
+            n = counts[source.temp_downloads] = (
+                counts.get(source.temp_downloads, -1) + 1
+            )
+            source._incremental_dir = source.temp_downloads.parent.joinpath(
+                f"{source.temp_downloads.name}-incremental-{n}"
+            )
 
-                if not is_archive:
-                    shutil.copy2(
-                        dlfile,
-                        source.temp_downloads.joinpath(source.temp_downloads.name),
+        # Walking the caches takes time in proportion to their size, so that isn't done on every run
+        if util.interval_elapsed(
+            zebra_temp_dir.joinpath("last-eviction"), artifact_store_eviction_interval
+        ):
+            with span("evict"):
+                evict_artifact_store()
+                evict_token_cache()
+
+        if workers is None or workers <= 1:
+            previous = {}
+            for source in self.sources:
+                # An earlier source's files must not change along with its refetched download directory
+                if (other := previous.get(source.temp_downloads)) is not None:
+                    other._tree.detach()
+                previous[source.temp_downloads] = source
+
+                source._tree = None
+                self._prepare_source(source, incremental)
+                if not source._reused:
+                    source._set_transformed(
+                        _transform_source(
+                            source._label, source._tree, source._transform_options()
+                        )
                     )
 
-                elif str(dlfile).lower().endswith(".tar.gz"):
-                    unpack(dlfile, (dlgz := str(dlfile) + "-tmpunpack"))
-                    for i in Path(dlgz).rglob("*"):
-                        if str(i).endswith(".tar"):
-                            unpack(i, source.temp_downloads)
-                    util.rmtree(dlgz)
-
-                else:
-                    unpack(dlfile, source.temp_downloads)
+                # post process
+                if source.post_process is not None:
+                    with span("post_process", source._label):
+                        source._run_hook(source.post_process)
+
+        else:
+            # Sources sharing a download directory are fetched one after the other
+            chains = {}
+            for source in self.sources:
+                chains.setdefault(source.temp_downloads, []).append(source)
+
+            with ThreadPoolExecutor(workers) as threads, ProcessPoolExecutor(
+                workers
+            ) as processes:
+                prepared = {
+                    threads.submit(self._prepare_chain, chain, incremental): chain
+                    for chain in chains.values()
+                }
+
+                transformed = {}
+                for future in as_completed(prepared):
+                    future.result()
+                    for source in prepared[future]:
+                        if source._reused:
+                            continue
+
+                        args = (
+                            source._label,
+                            source._tree,
+                            source._transform_options(),
+                        )
+                        try:
+                            pickle.dumps(args[2])
+                        except (pickle.PicklingError, AttributeError, TypeError):
+                            transformed[id(source)] = (
+                                threads.submit(_transform_source, *args),
+                                False,
+                            )
+                        else:
+                            transformed[id(source)] = (
+                                processes.submit(
+                                    run_recorded, _transform_source, *args
+                                ),
+                                True,
+                            )
+
+                for source in self.sources:
+                    if not source._reused:
+                        future, recorded = transformed[id(source)]
+                        result = future.result()
+                        if recorded:
+                            # Spans of another process are passed on once it is done
+                            result, spans = result
+                            for i in spans:
+                                emit(i)
+                        source._set_transformed(result)
+
+                    # post process
+                    if source.post_process is not None:
+                        with span("post_process", source._label):
+                            source._run_hook(source.post_process)
+
+        return self._output(output_dir)
+
+    def _prepare_chain(self, chain: List[Source], incremental: bool):
+        for i, source in enumerate(chain):
+            source._tree = None
+            if i > 0:
+                chain[i - 1]._tree.detach()
+            self._prepare_source(source, incremental)
+
+    @staticmethod
+    def _prepare_source(source: Source, incremental: bool = False):
+        """
+        Run `pre_process`, fetch the files of the source, select them and run `mid_process`. For incremental runs,
+        pick up the previously transformed files if the inputs didn't change.
+        """
+        with span("prepare", source._label):
+            Config._prepare_stages(source, incremental)
+
+    @staticmethod
+    def _prepare_stages(source: Source, incremental: bool):
+        # The working directories are made when first needed
+        util.dir_touch(source.temp_downloads)
+        util.dir_touch(source._temp_transformed)
+
+        if source.pre_process is not None:
+            with span("pre_process"):
+                source.pre_process(source)
 
-            elif ltype == "path":
-                util.rmtree(source.temp_downloads, ignore_errors=True)
-                os.makedirs(source.temp_downloads, exist_ok=True)
-                # Files are copied one by one because of an edge case where the destination directory
-                # wasn't completely deleted (potentially when util.rmtree has ignore_errors=True)
-                for i in Path(link).glob("*"):
-                    ii = source.temp_downloads.joinpath(i.name)
-                    os.makedirs(ii.parent, exist_ok=True)
-
-                    if i.is_file():
-                        shutil.copy(i, ii)
-                    else:
-                        shutil.copytree(i, ii)
+        ltype, link = [
+            (i, j)
+            for (i, j) in {
+                "git": source.git_source,
+                "url": source.url_source,
+                "path": source.path_source,
+            }.items()
+            if j is not None
+        ][0]
 
-            # Do the unpacking thing
-            util.unpack_globs(source.glob_extract, source.temp_downloads)
+        if ltype == "git" and source.git_export and not source.glob_extract:
+            # Only the selected files are read from the repository, nothing is checked out
+            with span("git_export"):
+                files = git_export(
+                    link, source.git_rev, source.glob_include, source.glob_exclude
+                )
+                count(files=len(files), bytes_read=sum(map(len, files.values())))
+            source._tree = VirtualTree.from_data(files)
+        else:
+            with span(f"fetch_{ltype}"):
+                Config._download_source(source, ltype, link)
 
             # Include/Exclude patterns
-            file_matches = util.get_matching_file_patterns(
-                source.temp_downloads, source.glob_include, source.glob_exclude
+            with span("glob"):
+                file_matches = util.get_matching_file_patterns(
+                    source.temp_downloads, source.glob_include, source.glob_exclude
+                )
+                count(files=len(file_matches))
+
+            # From here on the files are transformed in memory
+            source._tree = VirtualTree.from_files(source.temp_downloads, file_matches)
+
+        # mid process
+        if source.mid_process is not None:
+            with span("mid_process"):
+                source._run_hook(source.mid_process)
+
+        source._fingerprint = None
+        source._reused = False
+        if incremental:
+            with span("fingerprint"):
+                count(files=len(source._tree))
+                source._fingerprint = source_fingerprint(
+                    source._transform_options(), source._tree
+                )
+                if source._fingerprint is not None:
+                    tree = load_transformed(
+                        source._incremental_dir, source._fingerprint
+                    )
+                    if tree is not None:
+                        source._tree = tree
+                        source._reused = True
+
+    @staticmethod
+    def _download_source(source: Source, ltype: str, link):
+        """
+        Put the files of the source in `source.temp_downloads` and unpack the archives in it.
+        """
+        # Get the files from the sources, copied out of the artifact store (as reflinks where possible). Hooks and
+        # tools may edit these files in place, which mustn't change the store or the user's files.
+        if ltype == "git":
+            link_tree(git_tree(link, source.git_rev), source.temp_downloads)
+
+        elif ltype == "url":
+            name = source.temp_downloads.name
+            archive, digests = url_artifact(
+                link, name, source.url_md5, source.url_sha256
             )
+            if source.url_md5 is None and source.url_sha256 is None:
+                print(
+                    f"MD5 {digests['md5']} SHA256 {digests['sha256']} for link {link}"
+                )
 
-            util.rmtree(source.temp_transformed, ignore_errors=True)
-            os.makedirs(source.temp_transformed, exist_ok=True)
-            for i in file_matches:
-                reli = i.resolve().relative_to(source.temp_downloads.resolve())
-                dst = source.temp_transformed.joinpath(reli)
-                os.makedirs(dst.parent, exist_ok=True)
-                shutil.copy2(i, source.temp_transformed.joinpath(reli))
-
-            # mid process
-            if source.mid_process is not None:
-                source.mid_process(source)
-
-            renames = deepcopy(source.rename_overwrites)
-            if renames is None:
-                renames = {}
-
-            # Do variable renaming
-            rename_transform = NameTransformer(renames)
-
-            if source.auto_cls_rename:
-                d = cls_renaming_dict(source.temp_transformed, rename_transform)
+            # Archive sensitive unpacking
+            if not name.lower().endswith(archive_suffixes):
+                util.rmtree(source.temp_downloads, ignore_errors=True)
+                os.makedirs(source.temp_downloads, exist_ok=True)
+                link_file(archive, source.temp_downloads.joinpath(name))
+
+            else:
+                # Only the selected files, and the archives to unpack further, are extracted
+                globs = [source.glob_include, source.glob_exclude, source.glob_extract]
+                selected = util.path_matcher(source.glob_include, source.glob_exclude)
+                extract = util.path_matcher(source.glob_extract)
+                key = hashlib.md5(settings_fingerprint(globs).encode()).hexdigest()
+
+                def populate(tmp):
+                    with span("extract"):
+                        extracted = extract_archive(
+                            archive, tmp, lambda x: selected(x) or extract(x), name
+                        )
+                        count(files=len(extracted))
+
+                link_tree(
+                    stored_tree(f"{archive.name}-{key[:8]}", populate),
+                    source.temp_downloads,
+                )
 
-                if isinstance(renames, dict):
-                    renames.update(d)
+        elif ltype == "path":
+            util.rmtree(source.temp_downloads, ignore_errors=True)
+            os.makedirs(source.temp_downloads, exist_ok=True)
+            # Files are copied one by one because of an edge case where the destination directory
+            # wasn't completely deleted (potentially when util.rmtree has ignore_errors=True)
+            for i in Path(link).glob("*"):
+                ii = source.temp_downloads.joinpath(i.name)
+                os.makedirs(ii.parent, exist_ok=True)
+
+                if i.is_file():
+                    link_file(i, ii)
                 else:
-                    renames = list(renames) + [(i, j) for (i, j) in d.items()]
-
-                rename_transform = NameTransformer(renames)
-
-            do_renaming(source.temp_transformed, rename_transform)
-
-            if source.combine_bas_files:
-                name = (
-                    source.combine_bas_files
-                    if isinstance(source.combine_bas_files, str)
-                    else None
+                    link_tree(i, ii)
+
+        # Do the unpacking thing
+        if source.glob_extract:
+            with span("unpack"):
+                util.unpack_globs(
+                    source.glob_extract,
+                    source.temp_downloads,
+                    source.glob_extract_depth,
                 )
-                sources = {}
-                for f in Path(source.temp_transformed).rglob("*.bas"):
-                    sources[f] = util.read_txt(f)
-
-                if len(sources):
-                    txt = compile_bas_sources_into_single_file(
-                        sources, module_name=name
-                    )
-                    for i in sources:
-                        i.unlink()
-
-                    util.write_txt(first(sources), txt)
-
-            if source.auto_bas_namespace:
-                bas_create_namespaced_classes(source.temp_transformed)
-
-            if source.git_add_version_comment or source.git_add_version_comment is None:
-                fix_repo_history_comment(source.temp_transformed)
-                if ltype == "git":
-                    add_repo_history_comment(
-                        source.temp_transformed, link, str(source.git_rev)
-                    )
-
-            # post process
-            if source.post_process is not None:
-                source.post_process(source)
 
+    def _output(self, output_dir) -> TreeChanges:
         if output_dir is None and self.output_dir is None:
             self.output_dir = Path(tempfile.gettempdir()).joinpath(
                 "zebra-vba-packager", self.caller_id[:8], "output"
@@ -293,23 +576,17 @@ class Config:
 
         output_dir = Path(output_dir)
 
-        util.rmtree(output_dir, ignore_errors=True)
-        os.makedirs(output_dir, exist_ok=True)
-
-        for source in self.sources:
-            for i in source.temp_transformed.rglob("*"):
-                if i.is_dir():
-                    continue
-
-                reli = i.resolve().relative_to(source.temp_transformed.resolve())
-                if str(reli).lower()[-4:] in (".cls", ".bas"):
-                    modname = vba_module_name(tokenize(util.read_txt(i)))
-                    dst = output_dir.joinpath(modname + str(reli).lower()[-4:])
-                else:
-                    dst = output_dir.joinpath(reli)
-
-                os.makedirs(dst.parent, exist_ok=True)
-                shutil.copy2(i, dst)
+        output = VirtualTree()
+        with span("collect"):
+            for source in self.sources:
+                for reli in source._tree:
+                    file = source._tree[reli]
+                    if str(reli).lower()[-4:] in (".cls", ".bas"):
+                        modname = vba_module_name(file.tokens)
+                        output.add(modname + str(reli).lower()[-4:], file.copy())
+                    else:
+                        output.add(reli, file.copy())
+            count(files=len(output))
 
         # Write namespace declarations
         namespace_declarations = [
@@ -318,16 +595,19 @@ class Config:
         ]
         namespace_declarations_not_empty = False
 
-        fix_module_name_length_limitation(output_dir)
+        with span("module_name_length"):
+            fix_module_name_length_limitation(output)
 
-        fix_repo_history_comment(output_dir)
+        with span("history_comment"):
+            fix_repo_history_comment(output)
 
         if self.casing is not None or self.casing_overwrites is not None:
-            fix_casing(output_dir, self.casing, self.casing_overwrites)
+            with span("casing"):
+                fix_casing(output, self.casing, self.casing_overwrites)
 
-        for i in output_dir.rglob("*.cls"):
+        for i in output.paths(".cls"):
             if i.name.startswith("z__") and i.name.lower().endswith(".cls"):
-                txt = util.read_txt(i)
+                txt = output.read_text(i)
 
                 namespace_declarations_not_empty = True
                 mpair = _ModnamePair.from_str(txt)
@@ -337,7 +617,13 @@ class Config:
                 )
 
         if namespace_declarations_not_empty:
-            write_tokens(
-                output_dir.joinpath("z__NameSpaces.bas"),
-                tokenize("\n".join(namespace_declarations)),
+            output.write_tokens(
+                "z__NameSpaces.bas",
+                cached_tokenize_stream("\n".join(namespace_declarations)),
             )
+
+        # The only time the output is written to disk
+        with span("write_output"):
+            changes = output.sync_to(output_dir)
+            count(files=len(changes.added) + len(changes.changed))
+        return changes